@@ -0,0 +1,85 @@
+import zlib
+
+from backend.op_code import Compressor
+
+# compression level used for zlib, same default as MongoDB's `zlibCompressionLevel`
+ZLIB_COMPRESSION_LEVEL = 6
+
+
+def _noop_decompress(data, max_length):
+    if len(data) > max_length:
+        raise ValueError(f"Message body of {len(data)} bytes is larger than {max_length}")
+    return bytes(data)
+
+
+def _zlib_decompress(data, max_length):
+    # bounded: a small message can't inflate to more than the announced size
+    decompressor = zlib.decompressobj()
+    # one extra byte room so that the end of the stream is read when the size is exact
+    body = decompressor.decompress(data, max_length + 1)
+    if decompressor.unconsumed_tail or len(body) > max_length:
+        raise ValueError(f"Decompressed message is larger than {max_length} bytes")
+    if not decompressor.eof:
+        raise ValueError("Failed to decompress message: incomplete or truncated stream")
+    return body
+
+
+# name used in the `compression` field of hello -> (compressorId, compress, decompress)
+# decompress: function(data, max_length) raising ValueError when the data inflates past max_length
+SUPPORTED_COMPRESSORS = {
+    "noop": (Compressor.NOOP, bytes, _noop_decompress),
+    "zlib": (
+        Compressor.ZLIB,
+        lambda data: zlib.compress(data, ZLIB_COMPRESSION_LEVEL),
+        _zlib_decompress
+    ),
+}
+
+_COMPRESSORS_BY_ID = {
+    compressor_id: (name, compress, decompress)
+    for name, (compressor_id, compress, decompress) in SUPPORTED_COMPRESSORS.items()
+}
+
+# commands which negotiate the compressors of a connection
+HANDSHAKE_COMMANDS = {"hello", "ismaster", "isMaster"}
+
+# the handshake and authentication commands must never be compressed
+UNCOMPRESSED_COMMANDS = {
+    "hello", "ismaster", "isMaster", "saslStart", "saslContinue", "getnonce",
+    "authenticate", "createUser", "updateUser", "copydbSaslStart", "copydbgetnonce", "copydb",
+}
+
+
+def negotiate_compressors(requested):
+    """
+    Pick the compressors offered by the client in hello which the server supports.
+    :param requested: `compression` field sent by the client, in order of preference
+    :return: list of compressor names kept in the client order
+    """
+    if not requested:
+        return []
+    return [name for name in requested if name in SUPPORTED_COMPRESSORS and name != "noop"]
+
+
+def compressor_name(compressor_id):
+    if compressor_id not in _COMPRESSORS_BY_ID:
+        raise ValueError(f"Unsupported compressor id: {compressor_id}")
+    return _COMPRESSORS_BY_ID[compressor_id][0]
+
+
+def compress(compressor_id, data):
+    if compressor_id not in _COMPRESSORS_BY_ID:
+        raise ValueError(f"Unsupported compressor id: {compressor_id}")
+    return _COMPRESSORS_BY_ID[compressor_id][1](data)
+
+
+def decompress(compressor_id, data, max_length):
+    """
+    :param max_length: size announced by the message, decompressing stops past it
+    """
+    if compressor_id not in _COMPRESSORS_BY_ID:
+        raise ValueError(f"Unsupported compressor id: {compressor_id}")
+    try:
+        return _COMPRESSORS_BY_ID[compressor_id][2](data, max_length)
+    except zlib.error as e:
+        raise ValueError(f"Failed to decompress message: {e}") from e
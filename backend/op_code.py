@@ -24,5 +24,28 @@ class OpCode:
 class ErrorCode:
 
     CommandNotFound = 59
+    Unauthorized = 13
+    CursorNotFound = 43
+    BadValue = 2
+    FailedToParse = 9
+    HostUnreachable = 6
+    DuplicateKey = 11000
+    IndexNotFound = 27
+    CannotCreateIndex = 67
+    InvalidOptions = 72
+    IndexOptionsConflict = 85
+    InvalidPipelineOperator = 168
+    UnrecognizedPipelineStage = 40324
+    ProjectionPathCollision = 31250
+    ProjectionInclusionInExclusion = 31253
+    ProjectionExclusionInInclusion = 31254
+    InternalError = 1
     UnknownError = 0
 
+
+class Compressor:
+    # compressorId carried by OP_COMPRESSED
+    NOOP = 0
+    SNAPPY = 1
+    ZLIB = 2
+    ZSTD = 3
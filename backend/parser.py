@@ -5,9 +5,13 @@ from typing import List
 import bson
 
 
+from backend.compression import compress, decompress
 from backend.op_code import OpCode
 from utils.logger import server_logger
 
+# same value as `maxMessageSizeBytes` reported in hello
+MAX_MESSAGE_SIZE = 48000000
+
 def crc32_checksum(raw_data, checksum):
     """
     Calculate the CRC32 checksum of the given data and compare it with the given checksum.
@@ -43,16 +47,14 @@ def flag2array(flag):
 def byte2string(data, offset):
     """
     Convert byte data to string.
-    :param data: byte data
+    :param data: byte data, `bytes` or `bytearray`
     :param offset: pointer to the start of the string
     :return: pointer to the end of the string and the string
     """
-    full_str = ""
-    # cstring end with b'\0'
-    while data[offset] != 0:
-        full_str += chr(data[offset])
-        offset += 1
-    return offset+1, full_str
+    # cstring end with b'\0', search for it in C instead of walking byte by byte
+    end = data.index(b"\x00", offset)
+    full_str = str(memoryview(data)[offset:end], "utf-8")
+    return end+1, full_str
 
 def byte2int32(data, offset):
     """
@@ -61,7 +63,7 @@ def byte2int32(data, offset):
     :param offset: pointer to the start of the integer
     :return: pointer to the end of the integer and the integer
     """
-    integer = struct.unpack("<i", data[offset:offset+4])[0]
+    integer = struct.unpack_from("<i", data, offset)[0]
     return offset+4, integer
 
 def byte2int64(data, offset):
@@ -71,7 +73,7 @@ def byte2int64(data, offset):
     :param offset: pointer to the start of the integer
     :return: pointer to the end of the integer and the integer
     """
-    integer = struct.unpack("<q", data[offset:offset+8])[0]
+    integer = struct.unpack_from("<q", data, offset)[0]
     return offset+8, integer
 
 def byte2document(data, offset):
@@ -81,8 +83,9 @@ def byte2document(data, offset):
     :param offset: pointer to the start of the document
     :return: offset and decoded document result
     """
-    doc_length = struct.unpack("<i", data[offset: offset+4])[0]
-    document = bson.decode(data[offset: offset+doc_length])
+    doc_length = struct.unpack_from("<i", data, offset)[0]
+    # slicing a memoryview does not copy the document bytes
+    document = bson.decode(memoryview(data)[offset: offset+doc_length])
     offset += doc_length
     return offset, document
 
@@ -93,14 +96,21 @@ def byte2uint32(data, offset):
     :param offset: pointer to the start of the integer
     :return: pointer to the end of the integer and the integer
     """
-    integer = struct.unpack("<I", data[offset:offset+4])[0]
+    integer = struct.unpack_from("<I", data, offset)[0]
     return offset+4, integer
 
 def byte2sections(data, offset):
+    """
+    Convert a document sequence (kind 1 section of OP_MSG) to dict object.
+    :param data: byte data
+    :param offset: pointer to the start of the section size
+    :return: pointer to the end of the section and {identifier: [documents]}
+    """
     current_offset = offset
     current_offset, section_size = byte2int32(data, current_offset)
-    section_name = byte2string(data, current_offset)
+    current_offset, section_name = byte2string(data, current_offset)
     documents = []
+    # the section size includes itself
     while current_offset < offset + section_size:
         current_offset, document = byte2document(data, current_offset)
         documents.append(document)
@@ -111,10 +121,10 @@ def byte2sections(data, offset):
 
 class HeadParser:
 
-    def do_decode(self, data):
+    def do_decode(self, data, offset=0):
         # MongoDB message header
         # 16 bytes in total, 4 bytes each: (message length), (request id), (response to), (op code)
-        header = struct.unpack("<iiii", data[:16])
+        header = struct.unpack_from("<iiii", data, offset)
         return {
             "message_length": header[0],
             "request_id": header[1],
@@ -285,10 +295,50 @@ class QueryParser(MongoDBParser):
 
         # construct the complete message
         message = flags_byte + collection_name_byte + number_to_skip_byte + number_to_return_byte + query_bson
+        if payload_dict.get("returnFieldsSelector"):
+            message += bson.encode(payload_dict["returnFieldsSelector"])
         return message
 
 class CompressedParser(MongoDBParser):
-    pass
+
+    def __init__(self):
+        super().__init__()
+        self.op_code = OpCode.OP_COMPRESSED
+        self.supported_version = 3.4
+
+    def do_decode(self, data):
+        offset = 16
+        header = HeadParser().do_decode(data)
+        offset, original_opcode = byte2int32(data, offset)
+        offset, uncompressed_size = byte2int32(data, offset)
+        compressor_id = data[offset]
+        offset += 1
+        if uncompressed_size < 0 or uncompressed_size > MAX_MESSAGE_SIZE - 16:
+            # checked before decompressing, a few bytes could otherwise inflate to gigabytes
+            raise ValueError(f"Invalid uncompressed size {uncompressed_size}")
+        message_body = decompress(compressor_id, memoryview(data)[offset:header["message_length"]],
+                                  uncompressed_size)
+        if len(message_body) != uncompressed_size:
+            raise ValueError(f"Decompressed size {len(message_body)} does not match {uncompressed_size}")
+        # rebuild the original message so that it can be handled like an uncompressed one
+        original_header = struct.pack(
+            "<iiii", 16 + uncompressed_size, header["request_id"], header["response_to"], original_opcode
+        )
+        return {
+            "originalOpcode": original_opcode,
+            "uncompressedSize": uncompressed_size,
+            "compressorId": compressor_id,
+            "message": original_header + message_body
+        }
+
+    def do_encode(self, payload_dict):
+        message_body = payload_dict["message"]
+        compressed_body = compress(payload_dict["compressorId"], message_body)
+        return b"".join([
+            struct.pack("<ii", payload_dict["originalOpcode"], len(message_body)),
+            struct.pack("<B", payload_dict["compressorId"]),
+            compressed_body
+        ])
 
 class MSGParser(MongoDBParser):
 
@@ -304,18 +354,18 @@ class MSGParser(MongoDBParser):
         if flag_bits & 0x01:
             message_length -= 4
             # The message ends with 4 bytes containing a CRC-32C
-            checksum = struct.unpack("<i", data[message_length:message_length+4])[0]
+            checksum = struct.unpack_from("<I", data, message_length)[0]
             # compute all data include head
             print(f"CRC-32C checksum: {checksum}")
-            if not crc32_checksum(data[:-4], checksum):
+            if not crc32_checksum(memoryview(data)[:message_length], checksum):
                 server_logger.warning("CRC-32C checksum failed, discard the message.")
                 return {}
         # with open("hello_next.bin", "wb") as f:
         #     f.write(data[16:])
         sections = []
-        while offset < len(data):
+        while offset < message_length:
             # one 8-bit number represents one kind of section
-            kind = struct.unpack("<b", data[offset:offset+1])[0]
+            kind = data[offset]
             offset += 1
             # print(f"kind = {kind}")
             if kind == 0:
@@ -327,29 +377,27 @@ class MSGParser(MongoDBParser):
                 offset, section = byte2sections(data, offset)
                 sections.append(section)
             elif kind == 2:
-                # This section is used for internal purposes.
-                pass
+                # This section is used for internal purposes, skip it by its size.
+                _, section_size = byte2int32(data, offset)
+                offset += section_size
             else:
                 server_logger.warning("Unknown section type: {}".format(kind))
+                break
         return {
             "flagBits": flag_bits,
             "sections": sections
         }
 
     def do_encode(self, payload_dict):
-        message_body = b''
+        # collect the parts and join them once instead of growing one bytes object
+        message_parts = [struct.pack("<I", payload_dict["flagBits"])]
         for section in payload_dict["sections"]:
             document_type = 0
-            kind = struct.pack("<b", document_type)
-            message_body += kind
-            section_bson = bson.encode(section)
-            message_body += section_bson
-
-        flags_byte = struct.pack("<I", payload_dict["flagBits"])
+            message_parts.append(struct.pack("<b", document_type))
+            message_parts.append(bson.encode(section))
 
         # construct the complete message
-        message = flags_byte + message_body
-        return message
+        return b"".join(message_parts)
 
 
 
@@ -357,7 +405,7 @@ class ReplyParser(MongoDBParser):
 
     def do_decode(self, data):
         offset = 16
-        flags, cursor_id, starting_from, number_returned = struct.unpack('<iqii', data[offset:offset+20])
+        flags, cursor_id, starting_from, number_returned = struct.unpack_from('<iqii', data, offset)
         documents = []
         offset += 20
         for i in range(number_returned):
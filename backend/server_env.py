@@ -22,15 +22,17 @@ def get_base_env():
     return result
 
 def get_host_info():
+    mem_size_mb = round(psutil.virtual_memory().total / (1024 ** 2))
+    num_cores = psutil.cpu_count(logical=True)
     result = {
         "system": {
             'currentTime': datetime.datetime.now(),
             'hostname': platform.node(),
             'cpuAddrSize': int(platform.architecture()[0][0:2]),
-            'memSizeMB': round(psutil.virtual_memory().total / (1024 ** 2)),
-            'memLimitMB': round(psutil.virtual_memory().total / (1024 ** 2)),
-            'numCores': psutil.cpu_count(logical=True),
-            'numCoresAvailableToProcess': psutil.cpu_count(logical=True),  # 逻辑核心数
+            'memSizeMB': mem_size_mb,
+            'memLimitMB': mem_size_mb,
+            'numCores': num_cores,
+            'numCoresAvailableToProcess': num_cores,  # 逻辑核心数
             'numPhysicalCores': psutil.cpu_count(logical=False),
             'numCpuSockets': 1,
             'cpuArch': platform.machine(),
@@ -50,6 +52,25 @@ def get_host_info():
     }
     return result
 
+def get_process_memory():
+    # "mem" section of serverStatus, in MB like MongoDB
+    memory = psutil.Process().memory_info()
+    return {
+        'bits': int(platform.architecture()[0][0:2]),
+        'resident': memory.rss // (1024 ** 2),
+        'virtual': memory.vms // (1024 ** 2),
+        'supported': True
+    }
+
+def get_max_connections():
+    # a connection takes a file descriptor, the soft limit bounds the number of connections
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    return None if soft_limit == resource.RLIM_INFINITY else soft_limit
+
 def get_build_info():
     result = {
         'version': '8.0.4',
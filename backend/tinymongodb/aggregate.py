@@ -0,0 +1,407 @@
+# aggregation pipeline: every stage is a generator over the documents of the previous one,
+# so the documents flow one at a time and only $sort and $group hold more than one of them
+import copy
+
+from itertools import islice
+
+from backend.op_code import ErrorCode
+from backend.tinymongodb.projection import Projection, ProjectionError
+from backend.tinymongodb.query import (
+    _MISSING, get_field, hashable, normalize_sort, set_field, sort_documents, sort_key, unset_field
+)
+
+# documents buffered by a $sort followed by a $limit before they are cut down to the limit
+TOP_K_BUFFER_FACTOR = 2
+
+
+class AggregationError(Exception):
+
+    def __init__(self, message, code=ErrorCode.BadValue):
+        super().__init__(message)
+        self.code = code
+
+
+def _compare(operator, left, right):
+    left, right = sort_key(left), sort_key(right)
+    if operator == "$eq":
+        return left == right
+    if operator == "$ne":
+        return left != right
+    if operator == "$gt":
+        return left > right
+    if operator == "$gte":
+        return left >= right
+    if operator == "$lt":
+        return left < right
+    return left <= right
+
+
+def _numbers(operator, values):
+    for value in values:
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise AggregationError(f"{operator} only supports numeric types, not {type(value).__name__}")
+    return values
+
+
+def _arithmetic(operator, values):
+    values = _numbers(operator, values)
+    if any(value is None for value in values):
+        return None
+    if operator == "$add":
+        return sum(values)
+    if operator == "$multiply":
+        result = 1
+        for value in values:
+            result *= value
+        return result
+    left, right = values
+    if operator == "$subtract":
+        return left - right
+    if right == 0:
+        raise AggregationError(f"can't {operator[1:]} by zero")
+    if operator == "$divide":
+        return left / right
+    return left % right
+
+
+def _truthy(value):
+    # MongoDB's boolean conversion: null, false, 0 and missing values are false
+    return value not in (None, False, 0, _MISSING)
+
+
+def _operator(operator, argument, document):
+    if operator == "$literal":
+        return argument
+    args = argument if isinstance(argument, list) else [argument]
+    if operator == "$cond":
+        if isinstance(argument, dict):
+            args = [argument.get("if"), argument.get("then"), argument.get("else")]
+        condition, then, otherwise = args
+        return evaluate(then if _truthy(evaluate(condition, document)) else otherwise, document)
+    if operator == "$ifNull":
+        for arg in args:
+            value = evaluate(arg, document)
+            if value is not None:
+                return value
+        return None
+    values = [evaluate(arg, document) for arg in args]
+    if operator in ("$add", "$subtract", "$multiply", "$divide", "$mod"):
+        return _arithmetic(operator, values)
+    if operator in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+        return _compare(operator, values[0], values[1])
+    if operator == "$and":
+        return all(_truthy(value) for value in values)
+    if operator == "$or":
+        return any(_truthy(value) for value in values)
+    if operator == "$not":
+        return not _truthy(values[0])
+    if operator == "$concat":
+        if any(value is None for value in values):
+            return None
+        return "".join(values)
+    if operator == "$toUpper":
+        return "" if values[0] is None else str(values[0]).upper()
+    if operator == "$toLower":
+        return "" if values[0] is None else str(values[0]).lower()
+    if operator == "$size":
+        if not isinstance(values[0], list):
+            raise AggregationError("The argument to $size must be an array")
+        return len(values[0])
+    raise AggregationError(f"Unrecognized expression '{operator}'", ErrorCode.InvalidPipelineOperator)
+
+
+def evaluate(expression, document):
+    """
+    Value of an aggregation expression: "$field.path", an operator like {"$add": [...]},
+    a document of expressions or a constant.
+    """
+    if isinstance(expression, str) and expression.startswith("$"):
+        if expression == "$$ROOT":
+            return document
+        return get_field(document, expression[1:])
+    if isinstance(expression, dict):
+        if len(expression) == 1 and next(iter(expression)).startswith("$"):
+            operator, argument = next(iter(expression.items()))
+            return _operator(operator, argument, document)
+        return {key: evaluate(value, document) for key, value in expression.items()}
+    if isinstance(expression, list):
+        return [evaluate(item, document) for item in expression]
+    return expression
+
+
+class _Accumulator:
+    """
+    Value of one field of a $group, fed with the documents of the group.
+    """
+
+    def __init__(self, operator, expression):
+        self.operator = operator
+        self.expression = expression
+        self.value = None
+        self.count = 0
+        self.seen = set()
+
+    def add(self, document):
+        if self.operator == "$count":
+            self.count += 1
+            return
+        value = evaluate(self.expression, document)
+        if self.operator == "$sum":
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.value = (self.value or 0) + value
+        elif self.operator == "$avg":
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.value = (self.value or 0) + value
+                self.count += 1
+        elif self.operator in ("$min", "$max"):
+            if value is None:
+                return
+            if self.value is None or (sort_key(value) < sort_key(self.value)) == (self.operator == "$min"):
+                self.value = value
+        elif self.operator == "$push":
+            if self.value is None:
+                self.value = []
+            self.value.append(value)
+        elif self.operator == "$addToSet":
+            if self.value is None:
+                self.value = []
+            if hashable(value) not in self.seen:
+                self.seen.add(hashable(value))
+                self.value.append(value)
+        elif self.operator == "$first":
+            if not self.count:
+                self.value = value
+            self.count += 1
+        elif self.operator == "$last":
+            self.value = value
+
+    def result(self):
+        if self.operator == "$count":
+            return self.count
+        if self.operator == "$sum":
+            return self.value or 0
+        if self.operator == "$avg":
+            return self.value / self.count if self.count else None
+        if self.operator in ("$push", "$addToSet"):
+            return self.value or []
+        return self.value
+
+
+ACCUMULATORS = ("$sum", "$avg", "$min", "$max", "$count", "$push", "$addToSet", "$first", "$last")
+
+
+def _group(documents, spec):
+    if not isinstance(spec, dict) or "_id" not in spec:
+        raise AggregationError("a group specification must include an _id", ErrorCode.FailedToParse)
+    fields = {}
+    for field, accumulator in spec.items():
+        if field == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1 or next(iter(accumulator)) not in ACCUMULATORS:
+            raise AggregationError(f"The field '{field}' must be an accumulator object", ErrorCode.FailedToParse)
+        fields[field] = next(iter(accumulator.items()))
+    return _grouped(documents, spec["_id"], fields)
+
+
+def _grouped(documents, group_expression, fields):
+    # key -> (_id, accumulators), only one entry per group is kept in memory
+    groups = {}
+    for document in documents:
+        group_id = evaluate(group_expression, document)
+        key = hashable(group_id)
+        if key not in groups:
+            groups[key] = (group_id, {field: _Accumulator(operator, expression)
+                                      for field, (operator, expression) in fields.items()})
+        for accumulator in groups[key][1].values():
+            accumulator.add(document)
+    for group_id, accumulators in groups.values():
+        yield {"_id": group_id, **{field: accumulator.result() for field, accumulator in accumulators.items()}}
+
+
+def _project(documents, spec):
+    try:
+        projection = Projection(spec, evaluate=evaluate)
+    except ProjectionError as e:
+        raise AggregationError(str(e), e.code)
+    return (projection.apply(document) for document in documents)
+
+
+def _add_fields(documents, spec):
+    if not isinstance(spec, dict):
+        raise AggregationError("$addFields specification must be an object", ErrorCode.FailedToParse)
+    return _added_fields(documents, spec)
+
+
+def _added_fields(documents, spec):
+    for document in documents:
+        # the documents may be the cached ones of the storage, they are never modified in place
+        added = copy.deepcopy(document)
+        for field, expression in spec.items():
+            set_field(added, field, evaluate(expression, document))
+        yield added
+
+
+def _unwind(documents, spec):
+    if isinstance(spec, str):
+        spec = {"path": spec}
+    path = spec.get("path")
+    if not isinstance(path, str) or not path.startswith("$"):
+        raise AggregationError("$unwind path must be prefixed by a '$'", ErrorCode.FailedToParse)
+    return _unwound(documents, path[1:], spec.get("includeArrayIndex"), spec.get("preserveNullAndEmptyArrays", False))
+
+
+def _unwound(documents, path, index_field, preserve):
+    for document in documents:
+        value = get_field(document, path, _MISSING)
+        if isinstance(value, list) and value:
+            for idx, item in enumerate(value):
+                unwound = copy.deepcopy(document)
+                set_field(unwound, path, item)
+                if index_field:
+                    set_field(unwound, index_field, idx)
+                yield unwound
+        elif isinstance(value, list) or value is _MISSING or value is None:
+            if preserve:
+                unwound = copy.deepcopy(document)
+                if isinstance(value, list):
+                    unset_field(unwound, path)
+                if index_field:
+                    set_field(unwound, index_field, None)
+                yield unwound
+        else:
+            # a value which is not an array is a single element array
+            unwound = copy.deepcopy(document) if index_field else document
+            if index_field:
+                set_field(unwound, index_field, None)
+            yield unwound
+
+
+def _sort(documents, spec, limit=0):
+    if not normalize_sort(spec):
+        raise AggregationError("$sort key specification must be an object", ErrorCode.FailedToParse)
+    return _sorted(documents, spec, limit)
+
+
+def _sorted(documents, spec, limit):
+    if not limit:
+        yield from sort_documents(documents, spec)
+        return
+    # top-k: followed by a $limit, the sort only keeps the best documents seen so far
+    kept = []
+    for document in documents:
+        kept.append(document)
+        if len(kept) >= limit * TOP_K_BUFFER_FACTOR:
+            kept = sort_documents(kept, spec)[:limit]
+    yield from sort_documents(kept, spec)[:limit]
+
+
+def _count(documents, field):
+    if not isinstance(field, str) or not field or field.startswith("$") or "." in field:
+        raise AggregationError("the count field must be a non-empty string without '$' or '.'",
+                               ErrorCode.FailedToParse)
+    return _counted(documents, field)
+
+
+def _counted(documents, field):
+    n = sum(1 for _ in documents)
+    if n:
+        yield {field: n}
+
+
+def _non_negative(stage, value):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise AggregationError(f"invalid argument to {stage} stage: {value!r}", ErrorCode.FailedToParse)
+    return value
+
+
+def _match(documents, query, matcher):
+    if not isinstance(query, dict):
+        raise AggregationError("the match filter must be an expression in an object", ErrorCode.FailedToParse)
+    if not query:
+        return documents
+    return _matched(documents, matcher(query))
+
+
+def _matched(documents, condition):
+    for document in documents:
+        try:
+            if condition is not None and condition(document):
+                yield document
+        except (AttributeError, TypeError, KeyError):
+            continue
+
+
+def _stage(stage):
+    if not isinstance(stage, dict) or len(stage) != 1:
+        raise AggregationError("A pipeline stage specification object must contain exactly one field.",
+                               ErrorCode.FailedToParse)
+    return next(iter(stage.items()))
+
+
+def split_pipeline(pipeline):
+    """
+    Take the leading stages which can be answered by the query of the collection scan or
+    an index: the $match stages, merged into one query, and a $sort following them.
+    :return: query, sort, limit needed from the query (0 if unknown) and the other stages
+    """
+    stages = [_stage(stage) for stage in pipeline]
+    queries = []
+    while stages and stages[0][0] == "$match":
+        if not isinstance(stages[0][1], dict):
+            raise AggregationError("the match filter must be an expression in an object", ErrorCode.FailedToParse)
+        queries.append(stages.pop(0)[1])
+    queries = [query for query in queries if query]
+    query = {}
+    for match in queries:
+        if set(match) & set(query):
+            # the same field in two $match stages, both conditions must hold
+            query = {"$and": queries}
+            break
+        query.update(match)
+    sort = None
+    if stages and stages[0][0] == "$sort" and isinstance(stages[0][1], dict):
+        sort = stages[0][1]
+    # documents needed when the pipeline starts with [$sort,] [$skip,] $limit
+    limit = 0
+    rest = stages[1:] if sort is not None else stages
+    skip = rest[0][1] if rest and rest[0][0] == "$skip" and isinstance(rest[0][1], int) else 0
+    following = rest[1:] if skip else rest
+    if following and following[0][0] == "$limit" and isinstance(following[0][1], int):
+        limit = skip + following[0][1]
+    return query, sort, limit, stages
+
+
+def run_pipeline(documents, stages, matcher):
+    """
+    Chain the stage generators over the documents, nothing is read before the first
+    document is asked for.
+    :param stages: list of (stage name, specification) given by `split_pipeline`
+    :param matcher: function(query) -> predicate of the documents matching a query
+    """
+    for position, (name, spec) in enumerate(stages):
+        if name == "$match":
+            documents = _match(documents, spec, matcher)
+        elif name == "$project":
+            documents = _project(documents, spec)
+        elif name in ("$addFields", "$set"):
+            documents = _add_fields(documents, spec)
+        elif name == "$group":
+            documents = _group(documents, spec)
+        elif name == "$sort":
+            following = stages[position + 1] if position + 1 < len(stages) else None
+            limit = following[1] if following and following[0] == "$limit" else 0
+            documents = _sort(documents, spec, limit=_non_negative("$limit", limit))
+        elif name == "$skip":
+            documents = islice(documents, _non_negative(name, spec), None)
+        elif name == "$limit":
+            if not _non_negative(name, spec):
+                raise AggregationError("the limit must be positive", ErrorCode.FailedToParse)
+            documents = islice(documents, spec)
+        elif name == "$unwind":
+            documents = _unwind(documents, spec)
+        elif name == "$count":
+            documents = _count(documents, spec)
+        else:
+            raise AggregationError(f"Unrecognized pipeline stage name: '{name}'",
+                                   ErrorCode.UnrecognizedPipelineStage)
+    return documents
@@ -0,0 +1,64 @@
+from collections import namedtuple
+
+# kinds of commands, "read" and "write" commands work on the documents of a collection
+COMMAND_KINDS = ("read", "write", "admin")
+
+# handler: function(backend, payload) -> list of the reply sections
+Command = namedtuple("Command", ["name", "handler", "kind", "admin_only", "cacheable", "cache_ttl"])
+
+
+class CommandRegistry:
+    """
+    OP_MSG commands by name, the command is the first key of the command document
+    and its value (1, true, 1.0, a collection name, ...) doesn't select the handler.
+
+    Plugins register their commands on `command_registry`:
+
+        @command_registry.command("myCommand", kind="read")
+        def handle_my_command(backend, payload):
+            return [{"ok": 1.0}]
+    """
+
+    def __init__(self):
+        self._commands = {}
+
+    def register(self, name, handler, kind="read", admin_only=False, cacheable=False, cache_ttl=None, aliases=()):
+        """
+        :param kind: one of `COMMAND_KINDS`
+        :param admin_only: the command can only be run against the "admin" database
+        :param cacheable: the reply only depends on the command document, it can be sent again
+        :param cache_ttl: seconds a cached reply stays valid, None if the reply never changes
+        :param aliases: other names of the command, like the legacy "isMaster" of "hello"
+        """
+        if kind not in COMMAND_KINDS:
+            raise ValueError(f"unknown command kind: {kind}")
+        for command_name in (name,) + tuple(aliases):
+            self._commands[command_name] = Command(command_name, handler, kind, admin_only, cacheable,
+                                                   cache_ttl)
+        return handler
+
+    def command(self, name, **metadata):
+        # decorator version of `register`
+        def decorator(handler):
+            return self.register(name, handler, **metadata)
+
+        return decorator
+
+    def unregister(self, name):
+        self._commands.pop(name, None)
+
+    def get(self, name):
+        return self._commands.get(name)
+
+    def names(self):
+        return sorted(self._commands)
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def __len__(self):
+        return len(self._commands)
+
+
+# commands of all the backends, the built-in commands are registered by the handler module
+command_registry = CommandRegistry()
@@ -0,0 +1,159 @@
+import random
+import threading
+import time
+
+# first batch size used when the client does not ask for one, same as MongoDB
+DEFAULT_BATCH_SIZE = 101
+# batch size of getMore when the client does not ask for one
+DEFAULT_GET_MORE_BATCH_SIZE = 1000
+# idle cursors are closed after 10 minutes, same as MongoDB's `cursorTimeoutMillis`
+DEFAULT_CURSOR_TIMEOUT = 600
+
+
+class CursorNotFound(Exception):
+    pass
+
+
+class ServerCursor:
+    """
+    A cursor opened by a query, it holds a lazy iterator over the matching documents
+    so that only one batch is materialized at a time.
+    """
+
+    def __init__(self, cursor_id, namespace, documents, limit=0):
+        self.cursor_id = cursor_id
+        self.namespace = namespace
+        self.documents = iter(documents)
+        # 0 means no limit
+        self.limit = limit
+        # number of documents returned to the client so far
+        self.returned = 0
+        self.last_used = time.monotonic()
+        self.exhausted = False
+
+    def next_batch(self, batch_size):
+        """
+        :param batch_size: maximum number of documents in this batch
+        :return: list of documents, empty when the cursor is exhausted
+        """
+        if self.limit:
+            if self.returned >= self.limit:
+                self.exhausted = True
+                return []
+            batch_size = min(batch_size, self.limit - self.returned)
+        if batch_size <= 0:
+            # an empty first batch only opens the cursor
+            return []
+        batch = []
+        for document in self.documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                break
+        else:
+            self.exhausted = True
+        self.returned += len(batch)
+        if self.limit and self.returned >= self.limit:
+            self.exhausted = True
+        self.last_used = time.monotonic()
+        return batch
+
+
+class CursorManager:
+    """
+    Registry of the open cursors of the server. Cursors are created by queries, read by
+    getMore and closed when exhausted, killed or idle for longer than `timeout` seconds.
+    """
+
+    def __init__(self, timeout=DEFAULT_CURSOR_TIMEOUT, reap_interval=60):
+        self.timeout = timeout
+        self._cursors = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        if reap_interval:
+            reaper = threading.Thread(target=self._reap_loop, args=(reap_interval,), daemon=True)
+            reaper.start()
+
+    def _new_cursor_id(self):
+        # cursor ids are positive int64, 0 means "no cursor"
+        while True:
+            cursor_id = random.getrandbits(63)
+            if cursor_id and cursor_id not in self._cursors:
+                return cursor_id
+
+    def create(self, namespace, documents, batch_size, limit=0, single_batch=False):
+        """
+        Open a cursor and take its first batch.
+        :param namespace: "db.collection" of the query
+        :param documents: iterable over the matching documents, consumed lazily
+        :param batch_size: number of documents in the first batch
+        :param limit: maximum number of documents returned by the cursor, 0 means no limit
+        :param single_batch: close the cursor after the first batch
+        :return: first batch and the cursor id, which is 0 if the cursor is already closed
+        """
+        with self._lock:
+            cursor = ServerCursor(self._new_cursor_id(), namespace, documents, limit)
+        batch = cursor.next_batch(batch_size)
+        if single_batch or cursor.exhausted:
+            return batch, 0
+        with self._lock:
+            self._cursors[cursor.cursor_id] = cursor
+        return batch, cursor.cursor_id
+
+    def get_more(self, cursor_id, batch_size, namespace=None):
+        """
+        Take the next batch of a cursor.
+        :return: batch, cursor id (0 once the cursor is exhausted) and the number of
+            documents returned before this batch
+        """
+        with self._lock:
+            # the cursor is checked out while the batch is built
+            cursor = self._cursors.pop(cursor_id, None)
+        if cursor is None or (namespace is not None and cursor.namespace != namespace):
+            if cursor is not None:
+                self._check_in(cursor)
+            raise CursorNotFound(f"cursor id {cursor_id} not found")
+        starting_from = cursor.returned
+        batch = cursor.next_batch(batch_size)
+        if cursor.exhausted:
+            return batch, 0, starting_from
+        self._check_in(cursor)
+        return batch, cursor.cursor_id, starting_from
+
+    def _check_in(self, cursor):
+        with self._lock:
+            self._cursors[cursor.cursor_id] = cursor
+
+    def kill(self, cursor_ids):
+        """
+        :return: list of killed cursor ids and list of cursor ids which were not found
+        """
+        killed, not_found = [], []
+        with self._lock:
+            for cursor_id in cursor_ids:
+                if self._cursors.pop(cursor_id, None) is None:
+                    not_found.append(cursor_id)
+                else:
+                    killed.append(cursor_id)
+        return killed, not_found
+
+    def reap_idle(self):
+        """
+        Close the cursors which have not been used for `timeout` seconds.
+        :return: number of closed cursors
+        """
+        deadline = time.monotonic() - self.timeout
+        with self._lock:
+            idle_ids = [cursor_id for cursor_id, cursor in self._cursors.items() if cursor.last_used < deadline]
+            for cursor_id in idle_ids:
+                del self._cursors[cursor_id]
+        return len(idle_ids)
+
+    def _reap_loop(self, interval):
+        while not self._stop_event.wait(interval):
+            self.reap_idle()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def __len__(self):
+        return len(self._cursors)
@@ -1,34 +1,109 @@
-import random
+import os
 import sys
+import threading
 import time
 import uuid
 
+from contextlib import nullcontext
 from datetime import datetime, timezone
+from itertools import islice
 from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from tinydb.database import Document
 
+from backend.compression import negotiate_compressors
 from backend.op_code import get_code_name, ErrorCode
 from backend.parser import *
-from backend.server_env import get_base_env, get_build_info, get_host_info
-from tinymongo import TinyMongoClient
+from backend.server_env import (
+    get_base_env, get_build_info, get_host_info, get_max_connections, get_process_memory
+)
+from backend.tinymongodb.aggregate import AggregationError, run_pipeline, split_pipeline
+from backend.tinymongodb.commands import command_registry
+from backend.tinymongodb.cursor import (
+    CursorManager, CursorNotFound, DEFAULT_BATCH_SIZE, DEFAULT_GET_MORE_BATCH_SIZE
+)
+from backend.tinymongodb.index import (
+    DuplicateKeyError, IndexCatalog, IndexOptionsConflict, IndexSpecError, default_index_name, ID_INDEX_NAME
+)
+from backend.tinymongodb.locks import READ, WRITE, NamespaceLocks
+from backend.tinymongodb.planner import ExecutionStats, PlanError, QueryPlanner
+from backend.tinymongodb.profiler import (
+    DEFAULT_SLOW_MS, PROFILE_COLLECTION, PROFILE_MAX_DOCUMENTS, PROFILE_OPS, Profiler
+)
+from backend.tinymongodb.projection import ProjectionError, compile_projection
+from backend.tinymongodb.query import sort_documents
+from backend.tinymongodb.unacknowledged import DEFAULT_QUEUE_SIZE, UnacknowledgedWrite, UnacknowledgedWriter
+from backend.tinymongodb.storage import STORAGE_ENGINES, BSONTinyMongoClient, fetch_documents
+from backend.tinymongodb.update import UpdateError, apply_update, upsert_document
 from utils.logger import server_logger
+from utils.metrics import ServerMetrics
+from utils.top import WRITE_OPS, TopCounters, empty_namespace_stats
+
+# `top` operation type of the legacy operations, they all start with the collection name
+LEGACY_TOP_OPS = {
+    OpCode.OP_QUERY: "queries",
+    OpCode.OP_GET_MORE: "getmore",
+    OpCode.OP_INSERT: "insert",
+    OpCode.OP_UPDATE: "update",
+    OpCode.OP_DELETE: "remove",
+}
+# `top` operation type of the OP_MSG commands, the other commands are counted as "commands"
+MSG_TOP_OPS = {
+    "find": "queries",
+    "getMore": "getmore",
+    "insert": "insert",
+    "update": "update",
+    "delete": "remove",
+}
+
+# seconds a cached reply carrying the server time (`localTime` of hello) is sent again
+LOCAL_TIME_TTL = 1.0
+# seconds a cached `hostInfo` reply is sent again
+HOST_INFO_TTL = 10.0
 
 
 class TinyMongoDBBackend:
 
-    def __init__(self, hostname, port, connection_id=0):
+    def __init__(self, hostname, port, connection_id=0, storage="json", shared=False, profile=0,
+                 slow_ms=DEFAULT_SLOW_MS, unacknowledged_queue_size=DEFAULT_QUEUE_SIZE):
         # get an instance of database in tinymongo
         # see example in https://github.com/schapman1974/tinymongo
         self.logger = server_logger
-        self.backend = TinyMongoClient()
+        # BSON types sent by the drivers are kept as Extended JSON in the table files
+        self.backend = BSONTinyMongoClient(storage=storage, shared=shared)
+        # databases already recorded in "admin.database"
+        self._known_databases = set()
+        # in-memory indexes, the specs of the secondary indexes are kept in "admin.indexes"
+        self.indexes = IndexCatalog(self._load_table_documents, self._load_index_specs)
+        self.planner = QueryPlanner()
+        # OP_MSG commands, shared with the plugins
+        self.commands = command_registry
+
+        # time and count of the operations per namespace, reported by `top`
+        self.top = TopCounters()
+        # reader-writer lock of every collection, the backend is shared by the connection threads
+        self.locks = NamespaceLocks()
+        # counters of serverStatus, the requests are recorded by the server
+        self.metrics = ServerMetrics()
+        # `profile` command, the entries are written to "db.system.profile" by a background thread
+        self.profiler = Profiler(self._write_profile, level=profile, slow_ms=slow_ms)
+        # `ExecutionStats` of the profiled operation running on the thread, ticket of its unacknowledged write
+        self._operation = threading.local()
+        # writes nobody waits for (w:0), executed in batches by a background thread
+        self.unacknowledged = UnacknowledgedWriter(self._insert_unacknowledged, max_queued=unacknowledged_queue_size)
+        self.metrics.add_section("unacknowledgedWrites", self.unacknowledged.stats)
+        self.start_time = time.monotonic()
 
         self.allowed_commands = {
-            OpCode.OP_INSERT: self.handle_insert,
-            OpCode.OP_UPDATE: self.handle_update,
-            OpCode.OP_DELETE: self.handle_delete,
-            # OpCode.OP_GET_MORE: self.handle_get_more,
-            # OpCode.OP_KILL_CURSORS: self.handle_kill_cursors,
-            OpCode.OP_QUERY: self.handle_query,
+            OpCode.OP_INSERT: self._submit_legacy(OpCode.OP_INSERT, self._timed(OpCode.OP_INSERT, self.handle_insert)),
+            OpCode.OP_UPDATE: self._submit_legacy(OpCode.OP_UPDATE, self._timed(OpCode.OP_UPDATE, self.handle_update)),
+            OpCode.OP_DELETE: self._submit_legacy(OpCode.OP_DELETE, self._timed(OpCode.OP_DELETE, self.handle_delete)),
+            OpCode.OP_GET_MORE: self._timed(OpCode.OP_GET_MORE, self.handle_get_more),
+            OpCode.OP_KILL_CURSORS: self.handle_kill_cursors,
+            OpCode.OP_QUERY: self._timed(OpCode.OP_QUERY, self.handle_query),
+            # the operation inside is timed when it is dispatched again
             OpCode.OP_COMPRESSED: self.handle_compressed,
+            # timed per command in `handle_msg`
             OpCode.OP_MSG: self.handle_msg,
         }
 
@@ -44,31 +119,119 @@ class TinyMongoDBBackend:
         }
         self.connection_id = connection_id
         self.object_id = ObjectId()
+        # cursors opened by queries, read by getMore
+        self.cursor_manager = CursorManager()
         # fill up fundamental data in the database
         self.server_database_setup()
         self.hostname = hostname
         self.port = port
 
+    def _timed(self, op_code, handler):
+        """
+        Wrap the handler of a legacy operation to record its time in `top` and the profiler.
+        """
+        op_type = LEGACY_TOP_OPS[op_code]
+
+        def timed_handler(data):
+            # fullCollectionName follows the 4 bytes of flags after the header
+            _, namespace = byte2string(data, 20)
+            if ".$cmd" in namespace:
+                return handler(data)
+            db_name = namespace.split(".", 1)[0]
+            profiled = self._start_profiling(db_name)
+            start = time.perf_counter_ns()
+            try:
+                with self._namespace_lock(namespace, write=op_type in WRITE_OPS):
+                    reply = handler(data)
+            finally:
+                micros = (time.perf_counter_ns() - start) // 1000
+                self.top.record(namespace, op_type, micros)
+            if profiled:
+                # the message is only decoded again by the profiler thread
+                self._profile(db_name, namespace, op_type, lambda: self.handle_decode(op_code, data), reply, micros)
+            return reply
+
+        return timed_handler
+
+    @staticmethod
+    def _command_namespace(command, command_name):
+        # "db.collection" of a command, None for the commands which are not about a collection
+        collection = command.get("collection") if command_name == "getMore" else command.get(command_name)
+        if isinstance(collection, str) and "$db" in command:
+            return f"{command['$db']}.{collection}"
+        return None
+
+    def _namespace_lock(self, namespace, write=False):
+        if namespace is None:
+            return nullcontext()
+        return self.locks.write(namespace) if write else self.locks.read(namespace)
+
+    def _record_command(self, command, command_name, micros):
+        # commands which are not about a collection are not reported by `top`
+        namespace = self._command_namespace(command, command_name)
+        if namespace is not None:
+            self.top.record(namespace, MSG_TOP_OPS.get(command_name, "commands"), micros)
+
+    def _start_profiling(self, db_name):
+        """
+        Set up the `ExecutionStats` of an operation on a database with profiling enabled.
+        :return: the operation is profiled
+        """
+        profiled = db_name is not None and self.profiler.enabled(db_name)
+        self._operation.stats = ExecutionStats() if profiled else None
+        return profiled
+
+    def _profile(self, db_name, namespace, op_type, command, reply, micros):
+        stats = self._operation.stats
+        self._operation.stats = None
+        self.profiler.record(db_name, namespace, PROFILE_OPS.get(op_type, op_type), command, reply, micros // 1000,
+                             stats if stats.plan_summary is not None else None)
+
+    def _write_profile(self, db_name, documents):
+        """
+        Append profile entries to "db.system.profile", the oldest entries above
+        `PROFILE_MAX_DOCUMENTS` are removed like in a capped collection.
+        """
+        namespace = f"{db_name}.{PROFILE_COLLECTION}"
+        self._register_database(db_name)
+        # TinyMongo only matches the documents with an `_id`
+        documents = [{"_id": ObjectId(), **document} for document in documents]
+        storage, table_name = self._table_storage(namespace)
+        with self.locks.write(namespace), self._write_lock(namespace):
+            indexes = self.indexes.get(namespace)
+            doc_ids = storage.insert_multiple(table_name, documents)
+            for doc_id, document in zip(doc_ids, documents):
+                indexes.add(doc_id, document)
+            doc_ids = sorted(map(int, storage.read_table(table_name)))
+            expired = doc_ids[:len(doc_ids) - PROFILE_MAX_DOCUMENTS]
+            if expired:
+                storage.remove(table_name, expired)
+                for doc_id in expired:
+                    indexes.remove(doc_id)
+
     def server_database_setup(self):
         # create a database named "admin", "config", "local"
         required_databases = [
             "admin.database",
+            "admin.indexes",  # specs of the secondary indexes
             "config.system",  # configuration parameters
             "local.startup_log"  # logs
         ]
-        for db_str in required_databases:
-            database_strs = db_str.split(".")
-            collection_name, table_name = database_strs
-            # the database will be created automatically when we access it if it doesn't exist
-            collection = getattr(self.backend, collection_name)
-            table = getattr(collection, table_name)
-            table.find()
-        admin_table = self.backend.admin.database
-        # ignore admin as it is an `inner` database controlled by program
-        admin_table.insert_many([
-            {"name": "config"},
-            {"name": "local"}
-        ])
+        # the worker processes start at the same time
+        with self.backend.metadata_transaction():
+            for db_str in required_databases:
+                database_strs = db_str.split(".")
+                collection_name, table_name = database_strs
+                # the database will be created automatically when we access it if it doesn't exist
+                collection = getattr(self.backend, collection_name)
+                table = getattr(collection, table_name)
+                table.find()
+            # ignore admin as it is an `inner` database controlled by program
+            for db_name in ["config", "local"]:
+                self._register_database(db_name)
+        # rebuild the secondary indexes from the table files
+        for namespace in {spec["ns"] for spec in self.backend.admin.indexes.find()}:
+            self.indexes.get(namespace)
 
     def _get_all_databases(self):
         admin_table = self.backend.admin.database
@@ -76,26 +239,311 @@ class TinyMongoDBBackend:
         all_databases = [db_doc["name"] for db_doc in query_result]
         return all_databases
 
-    def _get_db_stats(self, database_name):
-        # calculate the stats of a specific database
-        db = getattr(self.backend, database_name)
-        collection_names = db.collection_names()
-        # TODO: implementations
+    def _collection_names(self, database_name):
+        # the tables of the database file, TinyDB always has a "_default" table
+        tables = self.backend.table_names(database_name)
+        return sorted(table for table in tables if table != "_default")
+
+    def _namespace_exists(self, full_collection_name):
+        # checked before reading the stats so that polling a missing collection doesn't create it
+        db_name, table_name = full_collection_name.split(".", 1)
+        if db_name != "admin" and db_name not in self._get_all_databases():
+            return False
+        return table_name in self._collection_names(db_name)
+
+    @staticmethod
+    def _stats_scale(command):
+        scale = command.get("scale", 1)
+        if isinstance(scale, bool) or not isinstance(scale, (int, float)) or scale < 1:
+            raise ValueError("scale has to be >= 1")
+        return int(scale)
+
+    def _get_collection_stats(self, full_collection_name, scale=1):
+        # the counters are kept up to date by the write paths, no document is read
+        if self._namespace_exists(full_collection_name):
+            indexes = self.indexes.get(full_collection_name)
+            count, data_size, index_sizes = indexes.document_count(), indexes.data_size, indexes.index_sizes()
+        else:
+            count, data_size, index_sizes = 0, 0, {}
+        total_index_size = sum(index_sizes.values())
+        return {
+            "ns": full_collection_name,
+            "size": data_size // scale,
+            "count": count,
+            "avgObjSize": data_size // count if count else 0,
+            # documents of all the collections are stored in the same file
+            "storageSize": data_size // scale,
+            "nindexes": len(index_sizes),
+            "indexSizes": {name: size // scale for name, size in index_sizes.items()},
+            "totalIndexSize": total_index_size // scale,
+            "totalSize": (data_size + total_index_size) // scale,
+            "scaleFactor": scale
+        }
+
+    def _get_db_stats(self, database_name, scale=1):
+        # calculate the stats of a specific database from the stats of its collections
+        collection_names = []
+        if database_name == "admin" or database_name in self._get_all_databases():
+            collection_names = self._collection_names(database_name)
+        objects = data_size = num_indexes = index_size = 0
+        for table_name in collection_names:
+            indexes = self.indexes.get(f"{database_name}.{table_name}")
+            objects += indexes.document_count()
+            data_size += indexes.data_size
+            num_indexes += len(indexes)
+            index_size += sum(indexes.index_sizes().values())
+        storage_size = self.backend.database_file_size(database_name)
+        disk = self.backend.disk_usage()
         return {
             "db": database_name,
             "collections": len(collection_names),
-            "objects": 1,
-            "avgObjSize": 59.0,
-            "dataSize": 59.0,
-            "storageSize": 20480.0,
-            "indexes": 1,
-            "indexSize": 20480.0,
-            "totalSize": 40960.0,
-            "scaleFactor": 1,
-            "fsUsedSize": 160507240448.0,
-            "fsTotalSize": 858992406528.0
+            "views": 0,
+            "objects": objects,
+            "avgObjSize": data_size / objects if objects else 0.0,
+            "dataSize": float(data_size // scale),
+            "storageSize": float(storage_size // scale),
+            "indexes": num_indexes,
+            "indexSize": float(index_size // scale),
+            "totalSize": float((storage_size + index_size) // scale),
+            "scaleFactor": scale,
+            "fsUsedSize": float(disk.used // scale),
+            "fsTotalSize": float(disk.total // scale)
+        }
+
+    def _register_database(self, db_name):
+        # record a new database in "admin.database" so that listDatabases reports it
+        if db_name in self._known_databases or db_name == "admin":
+            return
+        with self.backend.metadata_transaction():
+            # another worker process may have registered it
+            self._known_databases = set(self._get_all_databases())
+            if db_name not in self._known_databases:
+                self.backend.admin.database.insert_one({"name": db_name})
+                self.indexes.discard("admin.database")
+                self._known_databases.add(db_name)
+
+    def _write_lock(self, full_collection_name):
+        # the other databases have a single writer, the "admin" database is written by every worker
+        if full_collection_name.split(".", 1)[0] == "admin":
+            return self.backend.metadata_transaction()
+        return nullcontext()
+
+    def _get_table(self, full_collection_name):
+        # collection_name like "db.collection", the collection name itself may contain dots
+        db_name, table_name = full_collection_name.split(".", 1)
+        collection = self.backend[db_name]
+        return collection[table_name]
+
+    def _table_storage(self, full_collection_name):
+        """
+        The storage of a collection and its table name, a whole batch is written at once
+        instead of the document by document writes of TinyMongo.
+        """
+        db_name, table_name = full_collection_name.split(".", 1)
+        return self.backend.database_storage(db_name), table_name
+
+    def _load_table_documents(self, full_collection_name):
+        # mapping of doc_id -> document, read with a single access to the table file
+        storage, table_name = self._table_storage(full_collection_name)
+        return {int(doc_id): Document(document, int(doc_id))
+                for doc_id, document in list(storage.read_table(table_name).items())}
+
+    def _load_index_specs(self, full_collection_name):
+        return list(self.backend.admin.indexes.find({"ns": full_collection_name}))
+
+    def _find_documents(self, full_collection_name, query, sort=None, limit=0, hint=None, stats=None):
+        """
+        Iterate over the documents matching a query, sorted if `sort` is given.
+        The query planner chooses between a collection scan and the indexes.
+        :param limit: number of documents needed (skip + limit), used by the planner only
+        :param hint: index forced by the client
+        :param stats: `ExecutionStats` filled while the documents are read
+        """
+        plan, stats = self._plan_query(full_collection_name, query, sort=sort, limit=limit, hint=hint, stats=stats)
+        return self._execute_plan(plan, full_collection_name, query, sort=sort, stats=stats)
+
+    def _plan_query(self, full_collection_name, query, sort=None, limit=0, hint=None, stats=None):
+        plan = self.planner.plan(self.indexes.get(full_collection_name), query, sort=sort, limit=limit, hint=hint)
+        if stats is None:
+            # the stats of a profiled operation, shared by all the queries it runs
+            stats = getattr(self._operation, "stats", None) or ExecutionStats()
+        stats.plan_summary = plan.summary()
+        return plan, stats
+
+    def _execute_plan(self, plan, full_collection_name, query, sort=None, stats=None):
+        documents = self._match_documents(self._get_table(full_collection_name), plan.doc_ids(stats), query, stats)
+        if sort and not plan.ordered:
+            return iter(sort_documents(documents, sort))
+        # documents read in index order are streamed, skip and limit only walk the part they need
+        return documents
+
+    def _explain_find(self, full_collection_name, query, sort=None, skip=0, limit=0, hint=None):
+        """
+        Run a query with all its candidate plans costed and report the winning one
+        with the execution statistics, in the format of MongoDB's `explain`.
+        """
+        stats = ExecutionStats()
+        needed = skip + limit if limit else 0
+        plans = self.planner.candidates(self.indexes.get(full_collection_name), query, sort=sort, limit=needed,
+                                        hint=hint)
+        documents = self._execute_plan(plans[0], full_collection_name, query, sort=sort, stats=stats)
+        stats.n_returned = sum(1 for _ in islice(documents, skip, needed or None))
+        return {
+            "explainVersion": "1",
+            "queryPlanner": {
+                "namespace": full_collection_name,
+                "indexFilterSet": False,
+                "parsedQuery": query or {},
+                "winningPlan": plans[0].describe(query, sort),
+                "rejectedPlans": [plan.describe(query, sort) for plan in plans[1:]]
+            },
+            "executionStats": stats.to_dict(),
+            "serverInfo": {"host": self.hostname, "port": self.port},
+            "ok": 1.0
+        }
+
+    def _match_documents(self, collection, doc_ids, query, stats):
+        """
+        Check documents against the whole query.
+        :param doc_ids: candidates given by an index, None to scan the collection
+        """
+        condition = collection.parse_query(query or {})
+        if condition is None:
+            # same as TinyMongo, nothing matches a query it can't parse
+            return
+        for document in fetch_documents(collection, doc_ids):
+            stats.docs_examined += 1
+            try:
+                if condition(document):
+                    yield document
+            except (AttributeError, TypeError):
+                # values which can't be compared with the query do not match
+                continue
+
+    def _projected(self, full_collection_name, documents, projection):
+        """
+        Apply the projection of a query to the documents of its cursor, as the batches are taken.
+        """
+        if projection is None:
+            return documents
+        return self._project_documents(self.indexes.get(full_collection_name), documents, projection)
+
+    def _project_documents(self, indexes, documents, projection):
+        for document in documents:
+            # encoded once here: its size gives the bytes saved and the reply embeds the raw bytes
+            projected = RawBSONDocument(bson.encode(projection.apply(document)))
+            stored_size = indexes.stored_size(getattr(document, "doc_id", None))
+            if stored_size is not None:
+                self.metrics.record_projection(max(stored_size - len(projected.raw), 0))
+            yield projected
+
+    def _duplicate_key_error(self, index, full_collection_name, error):
+        return {
+            "index": index,
+            "code": ErrorCode.DuplicateKey,
+            "keyPattern": dict(error.index.key),
+            "keyValue": error.key_value,
+            "errmsg": f"E11000 duplicate key error collection: {full_collection_name} {error}"
         }
 
+    def _insert_documents(self, full_collection_name, documents, ordered=True):
+        """
+        Insert a batch of documents with a single write to the table file.
+        :param full_collection_name: "db.collection"
+        :param documents: documents to insert, `_id` is generated when missing
+        :param ordered: stop at the first error instead of skipping the failed documents
+        :return: number of inserted documents and the list of write errors
+        """
+        self._register_database(full_collection_name.split(".", 1)[0])
+        indexes = self.indexes.get(full_collection_name)
+        accepted = []
+        write_errors = []
+        # unique keys used by the accepted documents
+        pending = {}
+        for idx, document in enumerate(documents):
+            if "_id" not in document:
+                # `_id` is the first field, same as MongoDB
+                document = {"_id": ObjectId(), **document}
+            try:
+                indexes.claim_unique_keys(document, pending)
+            except DuplicateKeyError as e:
+                write_errors.append(self._duplicate_key_error(idx, full_collection_name, e))
+                if ordered:
+                    break
+                continue
+            accepted.append(document)
+        if accepted:
+            with self._write_lock(full_collection_name):
+                storage, table_name = self._table_storage(full_collection_name)
+                doc_ids = storage.insert_multiple(table_name, accepted)
+            for doc_id, document in zip(doc_ids, accepted):
+                indexes.add(doc_id, document)
+        return len(accepted), write_errors
+
+    def _update_documents(self, full_collection_name, query, update, multi=False, upsert=False):
+        """
+        Update the documents matching a query with a single write to the table file.
+        :return: number of matched documents, number of modified documents and
+            the `_id` of the upserted document (or None)
+        """
+        matched = self._find_documents(full_collection_name, query)
+        if not multi:
+            matched = islice(matched, 1)
+        matched = list(matched)
+        if not matched:
+            if not upsert:
+                return 0, 0, None
+            document = upsert_document(query, update)
+            if "_id" not in document:
+                document = {"_id": ObjectId(), **document}
+            _, write_errors = self._insert_documents(full_collection_name, [document])
+            if write_errors:
+                raise UpdateError(write_errors[0]["errmsg"], code=ErrorCode.DuplicateKey)
+            return 0, 0, document["_id"]
+
+        indexes = self.indexes.get(full_collection_name)
+        # `$pull` conditions are matched like the queries of find
+        matcher = self._get_table(full_collection_name).parse_query
+        pending = {}
+        updated_documents = []
+        doc_ids = []
+        for document in matched:
+            updated = apply_update(document, update, matcher=matcher)
+            if updated != document:
+                try:
+                    indexes.claim_unique_keys(updated, pending, doc_id=document.doc_id)
+                except DuplicateKeyError as e:
+                    raise UpdateError(f"E11000 duplicate key error collection: {full_collection_name} {e}",
+                                      code=ErrorCode.DuplicateKey)
+                updated_documents.append(updated)
+                doc_ids.append(document.doc_id)
+        if doc_ids:
+            with self._write_lock(full_collection_name):
+                storage, table_name = self._table_storage(full_collection_name)
+                storage.update(table_name, dict(zip(doc_ids, updated_documents)))
+            for doc_id, document in zip(doc_ids, updated_documents):
+                indexes.replace(doc_id, document)
+        return len(matched), len(doc_ids), None
+
+    def _delete_documents(self, full_collection_name, query, limit=0):
+        """
+        Remove the documents matching a query with a single write to the table file.
+        :param limit: 0 removes all matching documents, 1 removes the first one
+        :return: number of removed documents
+        """
+        matched = self._find_documents(full_collection_name, query)
+        if limit:
+            matched = islice(matched, limit)
+        doc_ids = [document.doc_id for document in matched]
+        if doc_ids:
+            with self._write_lock(full_collection_name):
+                storage, table_name = self._table_storage(full_collection_name)
+                storage.remove(table_name, doc_ids)
+            indexes = self.indexes.get(full_collection_name)
+            for doc_id in doc_ids:
+                indexes.remove(doc_id)
+        return len(doc_ids)
+
     def handle_decode(self, op_code, data):
         # used for testing only
         # decode the data and return the result
@@ -103,72 +551,72 @@ class TinyMongoDBBackend:
 
     def handle_insert(self, data):
         payload = self.op_parser_mapping[OpCode.OP_INSERT].do_decode(data)
-        self.logger.info(f"Insert Operation: {payload}")
-        flags = payload["responseFlags"]
-
-        full_collection_name = payload["fullCollectionName"]
-        # collection_name like "db.collection"
-        db_name, table_name = full_collection_name.split(".")
-        collection = getattr(self.backend, db_name)
-        table = getattr(collection, table_name)
-        documents = payload["documents"]
-        record_id = table.insert_multiple(documents)
+        flags = payload["flags"]
+        # bit 0: ContinueOnError
+        ordered = not (flags & 1)
+        self._insert_documents(payload["fullCollectionName"], payload["documents"], ordered=ordered)
+        # OP_INSERT has no reply
         return {}
 
     def handle_update(self, data):
         payload = self.op_parser_mapping[OpCode.OP_UPDATE].do_decode(data)
         flags = payload["responseFlags"]
-        full_collection_name = payload["fullCollectionName"]
-        db_name, table_name = full_collection_name.split(".")
-        collection = getattr(self.backend, db_name)
-        table = getattr(collection, table_name)
-        selector = payload["selector"]
-        update = payload["update"]
-        if flags == 1:
-            # update or insert
-            if len(self.backend.find(selector)) == 0:
-                # insert
-                table.insert_one(update)
-        elif flags == (1 << 1):
-            # It seems that TinyMongo may not support multi-update
-            table.update(selector, update, multi=True)
-        else:
-            table.update(selector, update)
+        # bit 0: Upsert, bit 1: MultiUpdate
+        self._update_documents(
+            payload["fullCollectionName"],
+            payload["selector"],
+            payload["update"],
+            multi=bool(flags & (1 << 1)),
+            upsert=bool(flags & 1)
+        )
         return {}
 
     def handle_delete(self, data):
         payload = self.op_parser_mapping[OpCode.OP_DELETE].do_decode(data)
-        flag = payload["responseFlags"]
-        full_collection_name = payload["fullCollectionName"]
-        db_name, table_name = full_collection_name.split(".")
-        collection = getattr(self.backend, db_name)
-        table = getattr(collection, table_name)
-        documents = payload["documents"]
-        for document in documents:
-            table.remove(document, multi=bool(flag))
+        flags = payload["flags"]
+        # bit 0: SingleRemove
+        limit = 1 if flags & 1 else 0
+        for selector in payload["documents"]:
+            self._delete_documents(payload["fullCollectionName"], selector, limit=limit)
         return {}
 
     def handle_get_more(self, data):
         payload = self.op_parser_mapping[OpCode.OP_GET_MORE].do_decode(data)
-        raise NotImplementedError("Don't support GetMore operation yet for TinyMongo backend.")
+        batch_size = abs(payload["numberToReturn"]) or DEFAULT_GET_MORE_BATCH_SIZE
+        try:
+            documents, cursor_id, starting_from = self.cursor_manager.get_more(
+                payload["cursorID"], batch_size, namespace=payload["fullCollectionName"]
+            )
+        except CursorNotFound:
+            # bit 0 of responseFlags: CursorNotFound
+            return {
+                "responseFlags": array2flag([1]),
+                "cursorID": 0,
+                "startingFrom": 0,
+                "documents": []
+            }
+        return {
+            "responseFlags": 0,
+            "cursorID": cursor_id,
+            "startingFrom": starting_from,
+            "documents": documents
+        }
 
     def handle_kill_cursors(self, data):
         payload = self.op_parser_mapping[OpCode.OP_KILL_CURSORS].do_decode(data)
-        raise NotImplementedError("Don't support KillCursors operation yet for TinyMongo backend.")
+        self.cursor_manager.kill(payload["cursorIDs"])
+        # OP_KILL_CURSORS has no reply
+        return {}
 
     def handle_query(self, data):
         payload = self.op_parser_mapping[OpCode.OP_QUERY].do_decode(data)
         # query success
         response_flags = 0
-        ### ????
         cursor_id = 0
         starting_from = 0
         query_result_list = []
 
         full_collection_name = payload["fullCollectionName"]
-        db_name, table_name = full_collection_name.split(".")
-        collection = getattr(self.backend, db_name)
-        table = getattr(collection, table_name)
         query = payload["query"]
 
         if "ismaster" in query and query["ismaster"] == 1:
@@ -178,17 +626,36 @@ class TinyMongoDBBackend:
         order_by = query.get("$orderby", None)
 
         skip = payload["numberToSkip"]
-        limit = payload["numberToReturn"]
-        ### ????
-        explain = query.get("$explain", None)
+        # numberToReturn is the size of the first batch,
+        # a negative value (or 1) asks for a single batch and closes the cursor
+        number_to_return = payload["numberToReturn"]
+        single_batch = number_to_return < 0 or number_to_return == 1
+        batch_size = abs(number_to_return) or DEFAULT_BATCH_SIZE
+        explain = query.get("$explain", False)
         hint = query.get("$hint", None)
-        # ignored return fields selector
         try:
-            query_result = table.find(filter=actual_query, sort=order_by, limit=limit, skip=skip)
-            query_result_list = [query_result[i] for i in range(query_result.count())]
+            projection = compile_projection(payload["returnFieldsSelector"])
+            if explain:
+                query_result_list = [self._explain_find(
+                    full_collection_name, actual_query, sort=order_by, skip=skip,
+                    limit=batch_size if single_batch else 0, hint=hint
+                )]
+            else:
+                documents = self._find_documents(
+                    full_collection_name, actual_query, sort=order_by,
+                    limit=skip + batch_size if single_batch else 0, hint=hint
+                )
+                query_result_list, cursor_id = self.cursor_manager.create(
+                    full_collection_name,
+                    self._projected(full_collection_name, islice(documents, skip, None), projection),
+                    batch_size,
+                    single_batch=single_batch
+                )
         except Exception as e:
             # query failed
+            self.logger.error(f"Query on {full_collection_name} failed: {e}")
             response_flags = array2flag([0, 1, 0, 0])
+            query_result_list = [{"$err": str(e), "code": ErrorCode.BadValue}]
         return {
             "responseFlags": response_flags,
             "cursorID": cursor_id,
@@ -197,74 +664,411 @@ class TinyMongoDBBackend:
         }
 
     def handle_compressed(self, data):
-        pass
+        # decompress the message and handle it as the original operation
+        payload = self.op_parser_mapping[OpCode.OP_COMPRESSED].do_decode(data)
+        original_opcode = payload["originalOpcode"]
+        if original_opcode not in self.allowed_commands or original_opcode == OpCode.OP_COMPRESSED:
+            self.logger.warning(f"Unsupported compressed operation: {original_opcode}")
+            return {}
+        return self.allowed_commands[original_opcode](payload["message"])
 
     def handle_msg(self, data):
         payload = self.op_parser_mapping[OpCode.OP_MSG].do_decode(data)
         return_flags = 0
-        self.logger.info(f"Received MSG payload:{payload}")
         if "flagBits" in payload:
             is_checksumPresent = payload["flagBits"] & 1
             is_moreToCome = (payload["flagBits"] >> 1) & 1
             is_exhaustAllowed = (payload["flagBits"] >> 16) & 1
             if is_checksumPresent:
                 return_flags += 1
-            if is_exhaustAllowed:
+            sections0 = payload["sections"][0]
+            # the command name is the first key of the command document, whatever its value is
+            command_name = next(iter(sections0), None)
+            if is_moreToCome or self._unacknowledged_command(command_name, sections0):
+                # w:0, the command is executed by the background writer
+                self._submit_command(payload, command_name)
+                if is_moreToCome:
+                    # the client doesn't read any reply
+                    return {}
+                return {"flagBits": return_flags, "sections": [{"ok": 1.0}]}
+            return_sections = self._run_command(payload, command_name)
+            if is_exhaustAllowed and self._streamed_reply(command_name, sections0, return_sections):
                 return_flags += (1 << 1)
-            if is_moreToCome:
-                # more to come, return None
-                return {}
-            else:
-                sections = payload["sections"]
-                sections0 = sections[0]
-                # no more to come, handle the payload
-                # handle admin & hello command
-                if sections0.get("hello", None) == 1:
-                    return_sections = self.handle_msg_hello(payload)
-                elif sections0.get("ping", None) == 1:
-                    return_sections = [{"ok": 1.0}]
-                elif sections0.get("top", None) == 1:
-                    return_sections = self.handle_top(payload)
-                elif sections0.get("buildInfo", None) == 1:
-                    return_sections = self.handle_buildInfo(payload)
-                elif sections0.get("hostInfo", None) == 1:
-                    return_sections = self.handle_hostInfo(payload)
-                elif sections0.get("atlasVersion", None) == 1:
-                    return_sections = self.handle_error("no such command: 'atlasVersion'", 59)
-                elif sections0.get("connectionStatus", None) == 1:
-                    return_sections = self.handle_authInfo(payload)
-                elif sections0.get("getParameter", None) == 1:
-                    return_sections = self.handle_getParameter(payload)
-                elif sections0.get("listDatabases", None) == 1:
-                    return_sections = self.handle_listDatabases(payload)
-                elif sections0.get("dbStats", None) == 1:
-                    return_sections = self.handle_dbStats(payload)
-                elif sections0.get("aggregate", None) == 1:
-                    return_sections = self.handle_agg(payload)
+            return {
+                "flagBits": return_flags,
+                "sections": return_sections
+            }
+        else:
+            self.logger.warning("Skipping payload without flagBits.")
+            return {}
+
+    def _run_command(self, payload, command_name):
+        """
+        Execute an OP_MSG command under the lock of its collection, timed for `top` and the profiler.
+        :return: the reply sections
+        """
+        sections0 = payload["sections"][0]
+        command = self.commands.get(command_name)
+        db_name = sections0.get("$db")
+        profiled = self._start_profiling(db_name)
+        start = time.perf_counter_ns()
+        if command is None:
+            return_sections = self.handle_error(f"no such command: '{command_name}'",
+                                                ErrorCode.CommandNotFound)
+        elif command.admin_only and sections0.get("$db") != "admin":
+            return_sections = self.handle_error(
+                f"{command_name} may only be run against the admin database.", ErrorCode.Unauthorized
+            )
+        else:
+            try:
+                if command.kind in ("read", "write"):
+                    namespace = self._command_namespace(sections0, command_name)
+                    with self._namespace_lock(namespace, write=command.kind == "write"):
+                        return_sections = command.handler(self, payload)
                 else:
-                    return_sections = self.handle_error("Unknown", 0)
+                    return_sections = command.handler(self, payload)
+            except Exception as e:
+                # a failing handler gets an error reply instead of dropping the connection
+                self.logger.exception(f"Command {command_name} failed: {e}")
+                return_sections = self.handle_error(str(e), ErrorCode.InternalError)
+        micros = (time.perf_counter_ns() - start) // 1000
+        self._record_command(sections0, command_name, micros)
+        if profiled:
+            namespace = self._command_namespace(sections0, command_name) or f"{db_name}.$cmd"
+            self._profile(db_name, namespace, MSG_TOP_OPS.get(command_name, "commands"), sections0,
+                          return_sections, micros)
+        return return_sections
+
+    def _unacknowledged_command(self, command_name, command):
+        # a write with writeConcern {w: 0}, the client doesn't wait for its result
+        registered = self.commands.get(command_name)
+        write_concern = command.get("writeConcern")
+        return registered is not None and registered.kind == "write" and isinstance(write_concern, dict) \
+            and write_concern.get("w") == 0
+
+    @staticmethod
+    def unacknowledged_request(op_code, payload):
+        """
+        The request is executed by the background writer: legacy writes, OP_MSG with moreToCome.
+        """
+        if op_code in (OpCode.OP_INSERT, OpCode.OP_UPDATE, OpCode.OP_DELETE):
+            return True
+        if op_code == OpCode.OP_MSG:
+            return bool(payload.get("flagBits", 0) & (1 << 1))
+        return False
 
-                return {
-                    "flagBits": return_flags,
-                    "sections": return_sections
-                }
+    def _submit(self, write):
+        # the ticket is taken by the server, the next request of the connection waits for the write
+        self._operation.ticket = self.unacknowledged.submit(write)
+
+    def take_unacknowledged_ticket(self):
+        """
+        :return: ticket of the write submitted by the request handled on this thread, None without
+        """
+        ticket = getattr(self._operation, "ticket", None)
+        self._operation.ticket = None
+        return ticket
+
+    def _submit_command(self, payload, command_name):
+        command = payload["sections"][0]
+        if command_name == "insert" and "$db" in command:
+            # inserts are merged into batches by the writer
+            self._submit(UnacknowledgedWrite(f"{command['$db']}.{command['insert']}",
+                                             self._command_documents(payload, "documents"), None,
+                                             ordered=command.get("ordered", True)))
         else:
-            self.logger.warning("Skipping payload without flagBits.")
+            self._submit(UnacknowledgedWrite(None, None, lambda: self._run_command(payload, command_name)))
+
+    def _submit_legacy(self, op_code, handler):
+        """
+        Legacy writes have no reply, they are executed by the background writer.
+        """
+
+        def submit(data):
+            if op_code == OpCode.OP_INSERT:
+                payload = self.op_parser_mapping[OpCode.OP_INSERT].do_decode(data)
+                # bit 0: ContinueOnError
+                self._submit(UnacknowledgedWrite(payload["fullCollectionName"], payload["documents"], None,
+                                                 ordered=not (payload["flags"] & 1)))
+            else:
+                self._submit(UnacknowledgedWrite(None, None, lambda: handler(data)))
             return {}
 
+        return submit
+
+    def _insert_unacknowledged(self, full_collection_name, documents, ordered):
+        # a batch of the background writer, the errors are not reported to the client
+        start = time.perf_counter_ns()
+        with self._namespace_lock(full_collection_name, write=True):
+            _, write_errors = self._insert_documents(full_collection_name, documents, ordered=ordered)
+        self.top.record(full_collection_name, "insert", (time.perf_counter_ns() - start) // 1000)
+        return write_errors
+
+    @staticmethod
+    def _streamed_reply(command_name, command, return_sections):
+        """
+        The reply is followed by other replies without request (moreToCome): the next batches
+        of an exhaust cursor, or the next hello of a driver monitor streaming the topology.
+        """
+        reply = return_sections[0]
+        if reply.get("ok") != 1:
+            return False
+        if command_name == "getMore":
+            return reply.get("cursor", {}).get("id", 0) != 0
+        # awaitable hello, the server sends it again every maxAwaitTimeMS
+        return command_name in ("hello", "isMaster", "ismaster") and "topologyVersion" in command \
+            and "maxAwaitTimeMS" in command
+
     def handle_msg_hello(self, payload):
         base_env_info = get_base_env()
 
         base_env_info["isWritablePrimary"] = True
+        if "hello" not in payload["sections"][0]:
+            base_env_info["ismaster"] = True
         base_env_info["topologyVersion"] = {
             "processId": self.object_id,
             "counter": bson.int64.Int64(0)
         }
         base_env_info["connectionId"] = self.connection_id
+        compressors = negotiate_compressors(payload["sections"][0].get("compression"))
+        if compressors:
+            base_env_info["compression"] = compressors
         base_env_info["ok"] = 1.0
 
         return [base_env_info]
 
+    def _command_documents(self, payload, identifier):
+        """
+        Documents of a command argument, carried either in the command document or in
+        kind 1 document sequence sections with the same identifier.
+        """
+        sections = payload["sections"]
+        documents = list(sections[0].get(identifier, []))
+        for section in sections[1:]:
+            documents.extend(section.get(identifier, []))
+        return documents
+
+    def handle_msg_find(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['find']}"
+        limit = command.get("limit", 0)
+        skip = command.get("skip", 0)
+        batch_size = command.get("batchSize", DEFAULT_BATCH_SIZE)
+        try:
+            projection = compile_projection(command.get("projection"))
+        except ProjectionError as e:
+            return self.handle_error(str(e), e.code)
+        try:
+            documents = self._find_documents(
+                namespace, command.get("filter", {}), sort=command.get("sort"),
+                limit=skip + abs(limit) if limit else 0, hint=command.get("hint")
+            )
+            first_batch, cursor_id = self.cursor_manager.create(
+                namespace,
+                self._projected(namespace, islice(documents, skip, None), projection),
+                batch_size,
+                limit=abs(limit),
+                single_batch=command.get("singleBatch", False) or limit < 0
+            )
+        except Exception as e:
+            self.logger.error(f"Find on {namespace} failed: {e}")
+            return self.handle_error(str(e), ErrorCode.BadValue)
+        return [{
+            "cursor": {
+                "firstBatch": first_batch,
+                "id": bson.int64.Int64(cursor_id),
+                "ns": namespace
+            },
+            "ok": 1.0
+        }]
+
+    def handle_msg_insert(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['insert']}"
+        # the whole message is written as one batch
+        documents = self._command_documents(payload, "documents")
+        inserted, write_errors = self._insert_documents(namespace, documents, ordered=command.get("ordered", True))
+        result = {"n": inserted}
+        if write_errors:
+            result["writeErrors"] = write_errors
+        result["ok"] = 1.0
+        return [result]
+
+    def handle_msg_update(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['update']}"
+        ordered = command.get("ordered", True)
+        n_matched, n_modified = 0, 0
+        upserted, write_errors = [], []
+        for idx, statement in enumerate(self._command_documents(payload, "updates")):
+            try:
+                if isinstance(statement["u"], list):
+                    raise UpdateError("Pipeline updates are not supported")
+                matched, modified, upserted_id = self._update_documents(
+                    namespace,
+                    statement.get("q", {}),
+                    statement["u"],
+                    multi=statement.get("multi", False),
+                    upsert=statement.get("upsert", False)
+                )
+            except UpdateError as e:
+                write_errors.append({"index": idx, "code": e.code, "errmsg": str(e)})
+                if ordered:
+                    break
+                continue
+            n_matched += matched
+            n_modified += modified
+            if upserted_id is not None:
+                upserted.append({"index": idx, "_id": upserted_id})
+        # `n` counts the matched and the upserted documents
+        result = {"n": n_matched + len(upserted), "nModified": n_modified}
+        if upserted:
+            result["upserted"] = upserted
+        if write_errors:
+            result["writeErrors"] = write_errors
+        result["ok"] = 1.0
+        return [result]
+
+    def handle_msg_delete(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['delete']}"
+        deleted = 0
+        for statement in self._command_documents(payload, "deletes"):
+            deleted += self._delete_documents(namespace, statement.get("q", {}), limit=statement.get("limit", 0))
+        return [{"n": deleted, "ok": 1.0}]
+
+    def handle_create_indexes(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['createIndexes']}"
+        self._register_database(command["$db"])
+        indexes = self.indexes.get(namespace)
+        num_before = len(indexes)
+        documents = self._load_table_documents(namespace)
+        for spec in command.get("indexes", []):
+            try:
+                name = spec.get("name") or default_index_name(spec["key"])
+                created = indexes.create(name, spec["key"], documents,
+                                         unique=bool(spec.get("unique", False)), sparse=bool(spec.get("sparse", False)))
+            except IndexOptionsConflict as e:
+                return self.handle_error(str(e), ErrorCode.IndexOptionsConflict)
+            except IndexSpecError as e:
+                return self.handle_error(str(e), ErrorCode.CannotCreateIndex)
+            except DuplicateKeyError as e:
+                return self.handle_error(f"Index build failed: E11000 duplicate key error collection: "
+                                         f"{namespace} {e}", ErrorCode.DuplicateKey)
+            if created:
+                self.planner.invalidate(namespace)
+                with self.backend.metadata_transaction():
+                    self.backend.admin.indexes.insert_one({
+                        "ns": namespace,
+                        "name": name,
+                        "key": dict(spec["key"]),
+                        "unique": bool(spec.get("unique", False)),
+                        "sparse": bool(spec.get("sparse", False))
+                    })
+                self.indexes.discard("admin.indexes")
+        result = {
+            "numIndexesBefore": num_before,
+            "numIndexesAfter": len(indexes),
+            "createdCollectionAutomatically": False,
+            "ok": 1.0
+        }
+        if num_before == len(indexes):
+            result["note"] = "all indexes already exist"
+        return [result]
+
+    def handle_list_indexes(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['listIndexes']}"
+        return [{
+            "cursor": {
+                "firstBatch": self.indexes.get(namespace).specs(),
+                "id": bson.int64.Int64(0),
+                "ns": f"{command['$db']}.$cmd.listIndexes.{command['listIndexes']}"
+            },
+            "ok": 1.0
+        }]
+
+    def handle_drop_indexes(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['dropIndexes']}"
+        indexes = self.indexes.get(namespace)
+        num_before = len(indexes)
+        target = command.get("index", "*")
+        # the indexes are given by name, by key pattern, by a list of names or "*" for all of them
+        if target == "*":
+            names = [name for name in indexes.indexes if name != ID_INDEX_NAME]
+        elif isinstance(target, dict):
+            name = indexes.find(target)
+            if name is None:
+                return self.handle_error(f"can't find index with key: {target}", ErrorCode.IndexNotFound)
+            names = [name]
+        else:
+            names = [target] if isinstance(target, str) else list(target)
+        for name in names:
+            try:
+                indexes.drop(name)
+            except IndexSpecError as e:
+                return self.handle_error(str(e), ErrorCode.InvalidOptions)
+            except KeyError:
+                return self.handle_error(f"index not found with name [{name}]", ErrorCode.IndexNotFound)
+            self.planner.invalidate(namespace)
+            with self.backend.metadata_transaction():
+                self.backend.admin.indexes.delete_many({"ns": namespace, "name": name})
+            self.indexes.discard("admin.indexes")
+        return [{"nIndexesWas": num_before, "ok": 1.0}]
+
+    def handle_explain(self, payload):
+        command = payload["sections"][0]
+        explained = command["explain"]
+        if not isinstance(explained, dict) or "find" not in explained:
+            return self.handle_error("Explain is only supported for the find command", ErrorCode.CommandNotFound)
+        namespace = f"{command['$db']}.{explained['find']}"
+        try:
+            return [self._explain_find(
+                namespace,
+                explained.get("filter", {}),
+                sort=explained.get("sort"),
+                skip=explained.get("skip", 0),
+                limit=abs(explained.get("limit", 0)),
+                hint=explained.get("hint")
+            )]
+        except PlanError as e:
+            return self.handle_error(str(e), ErrorCode.BadValue)
+
+    def handle_msg_get_more(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['collection']}"
+        batch_size = command.get("batchSize", 0) or DEFAULT_GET_MORE_BATCH_SIZE
+        try:
+            documents, cursor_id, _ = self.cursor_manager.get_more(
+                int(command["getMore"]), batch_size, namespace=namespace
+            )
+        except CursorNotFound as e:
+            return self.handle_error(str(e), ErrorCode.CursorNotFound)
+        except AggregationError as e:
+            # the stages of an aggregate cursor run while its batches are taken
+            return self.handle_error(str(e), e.code)
+        return [{
+            "cursor": {
+                "nextBatch": documents,
+                "id": bson.int64.Int64(cursor_id),
+                "ns": namespace
+            },
+            "ok": 1.0
+        }]
+
+    def handle_msg_kill_cursors(self, payload):
+        command = payload["sections"][0]
+        killed, not_found = self.cursor_manager.kill([int(cursor_id) for cursor_id in command.get("cursors", [])])
+        return [{
+            "cursorsKilled": [bson.int64.Int64(cursor_id) for cursor_id in killed],
+            "cursorsNotFound": [bson.int64.Int64(cursor_id) for cursor_id in not_found],
+            "cursorsAlive": [],
+            "cursorsUnknown": [],
+            "ok": 1.0
+        }]
+
     def handle_hello(self, payload):
         # hello-master do not support for TinyMongo backend
         # so we just return a fake response
@@ -274,6 +1078,9 @@ class TinyMongoDBBackend:
             "counter": bson.int64.Int64(0)
         }
         base_env_info["connectionId"] = self.connection_id
+        compressors = negotiate_compressors(payload["query"].get("compression"))
+        if compressors:
+            base_env_info["compression"] = compressors
         base_env_info["ok"] = 1.0
         base_env_info["helloOk"] = True
         base_env_info["ismaster"] = True
@@ -285,6 +1092,52 @@ class TinyMongoDBBackend:
             "documents": [base_env_info]
         }
 
+    def handle_ping(self, payload):
+        return [{"ok": 1.0}]
+
+    def server_status(self):
+        status = {
+            "host": f"{self.hostname}:{self.port}",
+            "version": get_build_info()["version"],
+            "process": "tinymongo",
+            "pid": bson.int64.Int64(os.getpid()),
+            "uptime": float(int(time.monotonic() - self.start_time)),
+            "uptimeMillis": bson.int64.Int64(int((time.monotonic() - self.start_time) * 1000)),
+            "localTime": datetime.now(timezone.utc),
+        }
+        status.update(self.metrics.snapshot(available_connections=get_max_connections()))
+        status["locks"] = {"Collection": self.locks.totals()}
+        status["mem"] = get_process_memory()
+        status["storageEngine"] = {
+            "name": self.backend.storage_engine,
+            "persistent": STORAGE_ENGINES[self.backend.storage_engine].persistent,
+        }
+        # one section per engine in use, like the "wiredTiger" section of MongoDB
+        status.update(self.backend.engine_stats())
+        return status
+
+    def handle_profile(self, payload):
+        """
+        `profile: -1` reads the settings of the database, 0, 1 and 2 set its level,
+        `slowms` and `sampleRate` apply to every database.
+        """
+        command = payload["sections"][0]
+        level = command["profile"]
+        if isinstance(level, bool) or not isinstance(level, (int, float)) or level not in (-1, 0, 1, 2):
+            return self.handle_error(f"Invalid profiling level: {level}", ErrorCode.BadValue)
+        sample_rate = command.get("sampleRate")
+        if sample_rate is not None and not 0 <= sample_rate <= 1:
+            return self.handle_error("'sampleRate' must be between 0.0 and 1.0 inclusive", ErrorCode.BadValue)
+        previous = {"slowms": self.profiler.slow_ms, "sampleRate": self.profiler.sample_rate}
+        was = self.profiler.set_level(command.get("$db", "admin"), int(level), slow_ms=command.get("slowms"),
+                                      sample_rate=sample_rate)
+        return [{"was": was, **previous, "ok": 1.0}]
+
+    def handle_serverStatus(self, payload):
+        status = self.server_status()
+        status["ok"] = 1.0
+        return [status]
+
     def handle_buildInfo(self, payload):
         build_info = get_build_info()
         build_info["ok"] = 1.0
@@ -296,37 +1149,25 @@ class TinyMongoDBBackend:
         return [host_info]
 
     def handle_top(self, payload):
-        databases = self._get_all_databases()
+        recorded = self.top.snapshot()
         return_sections = {
             "totals": {
                 "note": "all times in microseconds",
             }
         }
-        for db_name in databases:
-            collection = getattr(self.backend, db_name)
-            for table_name in collection.collection_names():
-                # table = getattr(collection, table_name)
-                # TODO: do something for time testing
+        for db_name in self._get_all_databases():
+            for table_name in self._collection_names(db_name):
                 result_key = f"{db_name}.{table_name}"
-                result_value = {}
-                for op_name in ["queries", "getmore", "insert", "update", "remove", "commands"]:
-                    result_value[op_name] = {
-                        "time": 0,
-                        "count": 0
-                    }
-                result_value["readLock"] = {
-                    "time": random.randint(800, 1200),
-                    "count": random.randint(10, 100)
-                }
-                result_value["writeLock"] = {
-                    "time": random.randint(800, 1200),
-                    "count": random.randint(10, 100)
-                }
-                result_value["total"] = {
-                    "time": result_value["writeLock"]["time"] + result_value["readLock"]["time"],
-                    "count": result_value["writeLock"]["count"] + result_value["readLock"]["count"]
-                }
-                return_sections["totals"][result_key] = result_value
+                return_sections["totals"][result_key] = recorded.pop(result_key, None) or empty_namespace_stats()
+        # namespaces which were used but have no table, like a query on a missing collection
+        return_sections["totals"].update(recorded)
+        for namespace, lock_stats in self.locks.stats().items():
+            stats = return_sections["totals"].get(namespace)
+            if stats is None:
+                continue
+            for name, mode in (("readLockWait", READ), ("writeLockWait", WRITE)):
+                stats[name] = {"time": lock_stats["timeAcquiringMicros"][mode],
+                               "count": lock_stats["acquireWaitCount"][mode]}
         return_sections["ok"] = 1.0
         return [return_sections]
 
@@ -355,10 +1196,45 @@ class TinyMongoDBBackend:
         }]
 
     def handle_dbStats(self, payload):
-        return_section = self._get_db_stats("admin")
+        command = payload["sections"][0]
+        try:
+            return_section = self._get_db_stats(command.get("$db", "admin"), self._stats_scale(command))
+        except ValueError as e:
+            return self.handle_error(str(e), ErrorCode.BadValue)
+        return_section["ok"] = 1.0
+        return [return_section]
+
+    def handle_coll_stats(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['collStats']}"
+        try:
+            return_section = self._get_collection_stats(namespace, self._stats_scale(command))
+        except ValueError as e:
+            return self.handle_error(str(e), ErrorCode.BadValue)
         return_section["ok"] = 1.0
         return [return_section]
 
+    def handle_count(self, payload):
+        command = payload["sections"][0]
+        namespace = f"{command['$db']}.{command['count']}"
+        query = command.get("query") or {}
+        skip = command.get("skip", 0)
+        limit = abs(command.get("limit", 0))
+        if not self._namespace_exists(namespace):
+            return [{"n": 0, "ok": 1.0}]
+        if not query:
+            # the number of documents is known without reading them
+            n = max(self.indexes.get(namespace).document_count() - skip, 0)
+            return [{"n": min(n, limit) if limit else n, "ok": 1.0}]
+        try:
+            documents = self._find_documents(namespace, query, limit=skip + limit if limit else 0,
+                                             hint=command.get("hint"))
+            n = sum(1 for _ in islice(documents, skip, skip + limit if limit else None))
+        except Exception as e:
+            self.logger.error(f"Count on {namespace} failed: {e}")
+            return self.handle_error(str(e), ErrorCode.BadValue)
+        return [{"n": n, "ok": 1.0}]
+
     def handle_authInfo(self, payload):
         # still confusing
         return [{
@@ -371,6 +1247,44 @@ class TinyMongoDBBackend:
         }]
 
     def handle_agg(self, payload):
+        command = payload["sections"][0]
+        if command["aggregate"] == 1:
+            return self._current_op(payload)
+        if not isinstance(command["aggregate"], str):
+            return self.handle_error("aggregate must be a collection name or 1", ErrorCode.BadValue)
+        namespace = f"{command['$db']}.{command['aggregate']}"
+        pipeline = command.get("pipeline")
+        if not isinstance(pipeline, list):
+            return self.handle_error("'pipeline' option must be specified as an array", ErrorCode.FailedToParse)
+        batch_size = command.get("cursor", {}).get("batchSize", DEFAULT_BATCH_SIZE)
+        try:
+            # the leading $match is the query of the collection scan or an index
+            query, sort, limit, stages = split_pipeline(pipeline)
+            plan, stats = self._plan_query(namespace, query, sort=sort, limit=limit, hint=command.get("hint"))
+            if sort is not None and plan.ordered:
+                # the index returns the documents in the order of the $sort
+                stages = stages[1:]
+            documents = self._execute_plan(plan, namespace, query, stats=stats)
+            collection = self._get_table(namespace)
+            documents = run_pipeline(documents, stages, collection.parse_query)
+            first_batch, cursor_id = self.cursor_manager.create(namespace, documents, batch_size)
+        except AggregationError as e:
+            return self.handle_error(str(e), e.code)
+        except PlanError as e:
+            return self.handle_error(str(e), ErrorCode.BadValue)
+        except Exception as e:
+            self.logger.error(f"Aggregate on {namespace} failed: {e}")
+            return self.handle_error(str(e), ErrorCode.BadValue)
+        return [{
+            "cursor": {
+                "firstBatch": first_batch,
+                "id": bson.int64.Int64(cursor_id),
+                "ns": namespace
+            },
+            "ok": 1.0
+        }]
+
+    def _current_op(self, payload):
         # client_str = f"{payload['client_address'][0]}:{payload['client_address'][1]}"
         result = {
             "cursor": {
@@ -388,7 +1302,7 @@ class TinyMongoDBBackend:
                         # ???
                         "opid": 37888,
                         "lsid": {
-                            "id": payload["lsid"]["id"],
+                            "id": payload["sections"][0].get("lsid", {}).get("id"),
                             "uid": bson.Binary.from_uuid(uuid.uuid4())
                         },
                         "secs_running": bson.int64.Int64(0),
@@ -420,6 +1334,40 @@ class TinyMongoDBBackend:
                 ],
                 "id": bson.int64.Int64(0),
                 "ns": "admin.$cmd.aggregate"
-            }
+            },
+            "ok": 1.0
         }
-        return result
\ No newline at end of file
+        return [result]
+
+
+def register_builtin_commands(registry):
+    backend = TinyMongoDBBackend
+    registry.register("hello", backend.handle_msg_hello, kind="admin", cacheable=True, cache_ttl=LOCAL_TIME_TTL,
+                      aliases=("isMaster", "ismaster"))
+    registry.register("ping", backend.handle_ping, kind="admin", cacheable=True)
+    registry.register("buildInfo", backend.handle_buildInfo, kind="admin", cacheable=True, aliases=("buildinfo",))
+    registry.register("hostInfo", backend.handle_hostInfo, kind="admin", cacheable=True, cache_ttl=HOST_INFO_TTL)
+    registry.register("connectionStatus", backend.handle_authInfo, kind="admin", cacheable=True)
+    registry.register("getParameter", backend.handle_getParameter, kind="admin", admin_only=True, cacheable=True)
+    registry.register("listDatabases", backend.handle_listDatabases, kind="admin", admin_only=True)
+    registry.register("top", backend.handle_top, kind="admin", admin_only=True)
+    registry.register("serverStatus", backend.handle_serverStatus, kind="admin", aliases=("serverstatus",))
+    # "read" like dbStats, so that the workers forward it to the owner of the database
+    registry.register("profile", backend.handle_profile, kind="read")
+    registry.register("dbStats", backend.handle_dbStats, kind="read")
+    registry.register("collStats", backend.handle_coll_stats, kind="read")
+    registry.register("count", backend.handle_count, kind="read")
+    registry.register("aggregate", backend.handle_agg, kind="read")
+    registry.register("find", backend.handle_msg_find, kind="read")
+    registry.register("getMore", backend.handle_msg_get_more, kind="read")
+    registry.register("killCursors", backend.handle_msg_kill_cursors, kind="read")
+    registry.register("explain", backend.handle_explain, kind="read")
+    registry.register("listIndexes", backend.handle_list_indexes, kind="read")
+    registry.register("insert", backend.handle_msg_insert, kind="write")
+    registry.register("update", backend.handle_msg_update, kind="write")
+    registry.register("delete", backend.handle_msg_delete, kind="write")
+    registry.register("createIndexes", backend.handle_create_indexes, kind="write")
+    registry.register("dropIndexes", backend.handle_drop_indexes, kind="write")
+
+
+register_builtin_commands(command_registry)
@@ -0,0 +1,577 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from itertools import product
+
+import bson
+from bson.errors import InvalidDocument
+
+from backend.tinymongodb.query import get_field, hashable, sort_key, split_path
+
+# every collection has a unique index on `_id`, it can not be dropped
+ID_INDEX_NAME = "_id_"
+# key directions accepted by `createIndexes`, "hashed" indexes only answer equality predicates
+INDEX_DIRECTIONS = (1, -1, "hashed")
+# operators of the range predicates answered by sorted indexes
+RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+_MISSING = object()
+# estimated size of the record id stored with each index key
+RECORD_ID_SIZE = 8
+
+
+class IndexSpecError(Exception):
+    pass
+
+
+class IndexOptionsConflict(IndexSpecError):
+    pass
+
+
+class DuplicateKeyError(Exception):
+
+    def __init__(self, index, document):
+        self.index = index
+        # values of the indexed fields, reported as `keyValue`
+        self.key_value = {field: get_field(document, field) for field in index.fields}
+        key_str = ", ".join(f"{field}: {value!r}" for field, value in self.key_value.items())
+        super().__init__(f"index: {index.name} dup key: {{ {key_str} }}")
+
+
+def normalize_key(key):
+    """
+    :param key: {"field": 1, ...} or [("field", 1), ...]
+    :return: list of (field, direction)
+    """
+    items = list(key.items() if isinstance(key, dict) else key)
+    if not items:
+        raise IndexSpecError("Index keys cannot be empty")
+    normalized = []
+    for field, direction in items:
+        if isinstance(direction, float) and direction.is_integer():
+            direction = int(direction)
+        if direction not in INDEX_DIRECTIONS or isinstance(direction, bool):
+            raise IndexSpecError(f"Unsupported index type for field '{field}': {direction!r}")
+        normalized.append((field, direction))
+    return normalized
+
+
+def default_index_name(key):
+    # same naming as MongoDB: {"a": 1, "b": -1} -> "a_1_b_-1"
+    return "_".join(f"{field}_{direction}" for field, direction in normalize_key(key))
+
+
+def _path_values(value, parts):
+    # values reached by a field path, arrays met on the way are expanded
+    if not parts:
+        return [value]
+    if isinstance(value, dict):
+        if parts[0] not in value:
+            return [_MISSING]
+        return _path_values(value[parts[0]], parts[1:])
+    if isinstance(value, list):
+        values = []
+        if parts[0].isdigit() and int(parts[0]) < len(value):
+            values.extend(_path_values(value[int(parts[0])], parts[1:]))
+        for item in value:
+            if isinstance(item, (dict, list)):
+                values.extend(_path_values(item, parts))
+        return values or [_MISSING]
+    return [_MISSING]
+
+
+def _field_values(document, path):
+    """
+    Values indexed for one field of a document.
+    :return: list of values and whether an array was met, i.e. the index is multikey
+    """
+    values = []
+    multikey = False
+    for value in _path_values(document, split_path(path)):
+        if value is _MISSING:
+            # missing fields are indexed as null, same as MongoDB
+            values.append(None)
+            continue
+        values.append(value)
+        if isinstance(value, list):
+            # multikey: an array is indexed by its elements as well
+            multikey = True
+            values.extend(value)
+            if not value:
+                values.append(None)
+    return values, multikey or len(values) > 1
+
+
+def _is_missing(document, path):
+    return all(value is _MISSING for value in _path_values(document, split_path(path)))
+
+
+class _Top:
+    # compares greater than any index key, used to build exclusive bounds
+
+    def __eq__(self, other):
+        return other is self
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return other is not self
+
+    __hash__ = object.__hash__
+
+
+_TOP = _Top()
+
+
+class _Descending:
+    # sort key of a field indexed in descending order
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return isinstance(other, _Descending) and self.key == other.key
+
+    def __lt__(self, other):
+        if not isinstance(other, _Descending):
+            return NotImplemented
+        return other.key < self.key
+
+    def __gt__(self, other):
+        if not isinstance(other, _Descending):
+            return NotImplemented
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+def _ordered_key(value, direction):
+    key = sort_key(value)
+    return _Descending(key) if direction == -1 else key
+
+
+def range_bounds(condition):
+    """
+    Bounds of a range predicate like {"$gte": 1, "$lt": 5} on the sort keys of the values.
+    Like MongoDB the range only covers values of the same type as the bound.
+    :return: (lower, upper), both are (sort key, inclusive), or None if the condition is not a range
+    """
+    if not isinstance(condition, dict) or not condition:
+        return None
+    lower = upper = None
+    for operator, value in condition.items():
+        if operator not in RANGE_OPERATORS or not is_scalar(value):
+            return None
+        bound = (sort_key(value), operator in ("$gte", "$lte"))
+        if operator in ("$gt", "$gte"):
+            if lower is None or bound[0] > lower[0] or (bound[0] == lower[0] and not bound[1]):
+                lower = bound
+        elif upper is None or bound[0] < upper[0] or (bound[0] == upper[0] and not bound[1]):
+            upper = bound
+    rank = (lower or upper)[0][0]
+    if upper is not None and lower is not None and upper[0][0] != rank:
+        # bounds of different types, nothing matches
+        return lower, (lower[0], False)
+    if lower is None:
+        lower = ((rank,), True)
+    if upper is None:
+        upper = ((rank, _TOP), False)
+    return lower, upper
+
+
+def _value_size(value):
+    # estimated BSON size of a key value, `hashable` turns sub-documents and arrays into tuples
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, (str, bytes)):
+        return len(value) + 5
+    if isinstance(value, tuple):
+        return sum(_value_size(item) for item in value) + 5
+    # ObjectId, datetime, ...
+    return 12
+
+
+def key_size(key):
+    # estimated size of an index entry
+    return RECORD_ID_SIZE + sum(_value_size(value) for value in key)
+
+
+def document_size(document):
+    # BSON size of a document, as reported by `collStats`
+    try:
+        return len(bson.encode(document))
+    except (InvalidDocument, TypeError):
+        return len(str(document))
+
+
+def is_scalar(value):
+    # values which can be looked up in a hash index, sub-documents, arrays and
+    # regular expressions are compared by the full query instead
+    return not isinstance(value, (dict, list)) and not hasattr(value, "pattern")
+
+
+class HashIndex:
+    """
+    Map of index key -> TinyDB doc_ids, the keys of each document are kept as well
+    so that a document can be removed without reading it again.
+    """
+
+    def __init__(self, name, key, unique=False, sparse=False):
+        self.name = name
+        self.key = normalize_key(key)
+        self.fields = [field for field, _ in self.key]
+        self.unique = unique
+        self.sparse = sparse
+        self.entries = {}
+        self._document_keys = {}
+        # estimated size of the entries in bytes, kept up to date by `add` and `remove`
+        self.size = 0
+
+    def keys(self, document):
+        """
+        Index keys of a document, one tuple per combination of the values of the fields.
+        """
+        if self.sparse and all(_is_missing(document, field) for field in self.fields):
+            return set()
+        return set(product(*({hashable(value) for value in _field_values(document, field)[0]}
+                             for field in self.fields)))
+
+    def add(self, doc_id, document):
+        keys = self.keys(document)
+        for key in keys:
+            self.entries.setdefault(key, set()).add(doc_id)
+            self.size += key_size(key)
+        self._document_keys[doc_id] = keys
+
+    def remove(self, doc_id):
+        for key in self._document_keys.pop(doc_id, ()):
+            self.size -= key_size(key)
+            doc_ids = self.entries.get(key)
+            if doc_ids is not None:
+                doc_ids.discard(doc_id)
+                if not doc_ids:
+                    del self.entries[key]
+
+    def lookup(self, values):
+        """
+        :param values: one value per indexed field
+        :return: set of doc_ids
+        """
+        return self.entries.get(tuple(hashable(value) for value in values), set())
+
+    def doc_ids(self):
+        # all indexed documents in natural order
+        return sorted(self._document_keys)
+
+    def conflict(self, document, doc_id=None, pending=None):
+        """
+        Find a key of the document already used by another document of a unique index.
+        :param doc_id: the document itself, ignored when it is updated
+        :param pending: keys used by the documents of the same batch, not yet written
+        :return: the conflicting key or None
+        """
+        if not self.unique:
+            return None
+        for key in self.keys(document):
+            if self.entries.get(key, set()) - {doc_id}:
+                return key
+            if pending is not None and key in pending:
+                return key
+        return None
+
+    def spec(self):
+        spec = {"v": 2, "key": dict(self.key), "name": self.name}
+        if self.unique and self.name != ID_INDEX_NAME:
+            spec["unique"] = True
+        if self.sparse:
+            spec["sparse"] = True
+        return spec
+
+    def __len__(self):
+        # number of distinct keys
+        return len(self.entries)
+
+
+class SortedIndex(HashIndex):
+    """
+    Hash index which also keeps its keys in order, for range predicates and sorts.
+    The ordered keys are tuples of the sort keys of the fields followed by the doc_id,
+    kept in a sorted list.
+    """
+
+    def __init__(self, name, key, unique=False, sparse=False):
+        super().__init__(name, key, unique=unique, sparse=sparse)
+        self.ordered = []
+        self._document_ordered_keys = {}
+        # an array was indexed, the index order is not the order of a sort on the field
+        self.multikey = False
+        # changed by every write, an open scan finds its place again when it moved
+        self._version = 0
+
+    def ordered_keys(self, document):
+        if self.sparse and all(_is_missing(document, field) for field in self.fields):
+            return set()
+        fields_keys = []
+        for field, direction in self.key:
+            values, multikey = _field_values(document, field)
+            self.multikey = self.multikey or multikey
+            fields_keys.append({_ordered_key(value, direction) for value in values})
+        return set(product(*fields_keys))
+
+    def add(self, doc_id, document):
+        super().add(doc_id, document)
+        ordered_keys = [key + (doc_id,) for key in self.ordered_keys(document)]
+        for key in ordered_keys:
+            insort(self.ordered, key)
+        self._document_ordered_keys[doc_id] = ordered_keys
+        self._version += 1
+
+    def remove(self, doc_id):
+        super().remove(doc_id)
+        for key in self._document_ordered_keys.pop(doc_id, ()):
+            idx = bisect_left(self.ordered, key)
+            if idx < len(self.ordered) and self.ordered[idx] == key:
+                del self.ordered[idx]
+        self._version += 1
+
+    def _position(self, bound, upper):
+        # position of a bound of the first field in the ordered keys
+        key, inclusive = bound
+        key = _Descending(key) if self.key[0][1] == -1 else key
+        after = inclusive == upper
+        return bisect_left(self.ordered, (key, _TOP) if after else (key,))
+
+    def _range(self, lower, upper):
+        if self.key[0][1] == -1:
+            # the first field is kept in descending order, the bounds are swapped
+            lower, upper = upper, lower
+        start = 0 if lower is None else self._position(lower, upper=False)
+        end = len(self.ordered) if upper is None else self._position(upper, upper=True)
+        return start, max(start, end)
+
+    def count(self, lower=None, upper=None):
+        """
+        Number of keys between the bounds of the first field, see `scan`.
+        """
+        start, end = self._range(lower, upper)
+        return end - start
+
+    def scan(self, lower=None, upper=None, reverse=False, stats=None):
+        """
+        Iterate over the doc_ids in index order.
+        :param lower: (sort key, inclusive) lower bound of the first field, None for no bound
+        :param upper: (sort key, inclusive) upper bound of the first field, None for no bound
+        :param reverse: walk from the last key to the first one
+        :param stats: `keys_examined` of this object is increased for each key
+        """
+        version = self._version
+        start, end = self._range(lower, upper)
+        idx = end - 1 if reverse else start
+        # the walk is resumed by getMore batches, the index may change in between
+        last_key = None
+        # a document has several keys only in a multikey index
+        seen = set()
+        while True:
+            if self._version != version:
+                # keys were added or removed, the positions moved: bisect from the last key again
+                version = self._version
+                start, end = self._range(lower, upper)
+                if last_key is None:
+                    idx = end - 1 if reverse else start
+                elif reverse:
+                    idx = min(bisect_left(self.ordered, last_key) - 1, end - 1)
+                else:
+                    idx = max(bisect_right(self.ordered, last_key), start)
+            if (idx < start) if reverse else (idx >= end):
+                return
+            last_key = self.ordered[idx]
+            idx += -1 if reverse else 1
+            if stats is not None:
+                stats.keys_examined += 1
+            doc_id = last_key[-1]
+            if self.multikey:
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+            yield doc_id
+
+    def sort_order(self, sort, prefix=0):
+        """
+        :param sort: list of (field, direction)
+        :param prefix: number of leading fields of the index with a single value
+            in the scanned range, the sort may start after them
+        :return: None if the index can't give this order, else whether to walk it in reverse
+        """
+        key = self.key[prefix:]
+        if not sort or self.multikey or self.sparse or len(sort) > len(key):
+            return None
+        reverse = None
+        for (field, direction), (index_field, index_direction) in zip(sort, key):
+            if field != index_field:
+                return None
+            same = direction == index_direction
+            if reverse is None:
+                reverse = not same
+            elif reverse == same:
+                return None
+        return reverse
+
+
+def make_index(name, key, unique=False, sparse=False):
+    # "hashed" indexes only answer equality predicates
+    if any(direction == "hashed" for _, direction in normalize_key(key)):
+        return HashIndex(name, key, unique=unique, sparse=sparse)
+    return SortedIndex(name, key, unique=unique, sparse=sparse)
+
+
+class CollectionIndexes:
+    """
+    Indexes of one collection, kept in memory and rebuilt from the table at startup.
+    The BSON size of the documents is tracked on the same write paths for `collStats`.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.indexes = {ID_INDEX_NAME: SortedIndex(ID_INDEX_NAME, {"_id": 1}, unique=True)}
+        self.data_size = 0
+        self._document_sizes = {}
+
+    def build(self, documents):
+        """
+        :param documents: mapping of TinyDB doc_id -> document
+        """
+        for doc_id, document in documents.items():
+            self.add(doc_id, document)
+
+    def create(self, name, key, documents, unique=False, sparse=False):
+        """
+        Build a new index over the existing documents.
+        :return: False if an identical index already exists
+        """
+        index = make_index(name, key, unique=unique, sparse=sparse)
+        existing = self.indexes.get(name)
+        if existing is not None:
+            if existing.spec() != index.spec():
+                raise IndexOptionsConflict(f"An index with name '{name}' already exists with a different spec")
+            return False
+        for other in self.indexes.values():
+            if other.key == index.key:
+                if other.spec() != dict(index.spec(), name=other.name):
+                    raise IndexOptionsConflict(f"An index with the same key already exists: '{other.name}'")
+                return False
+        for doc_id, document in documents.items():
+            if index.conflict(document) is not None:
+                raise DuplicateKeyError(index, document)
+            index.add(doc_id, document)
+        self.indexes[name] = index
+        return True
+
+    def drop(self, name):
+        if name == ID_INDEX_NAME:
+            raise IndexSpecError("cannot drop _id index")
+        if name not in self.indexes:
+            raise KeyError(name)
+        del self.indexes[name]
+
+    def find(self, key):
+        """
+        :param key: key pattern of an index
+        :return: the index name or None
+        """
+        key = normalize_key(key)
+        for index in self.indexes.values():
+            if index.key == key:
+                return index.name
+        return None
+
+    def add(self, doc_id, document):
+        for index in self.indexes.values():
+            index.add(doc_id, document)
+        size = document_size(document)
+        self._document_sizes[doc_id] = size
+        self.data_size += size
+
+    def remove(self, doc_id):
+        for index in self.indexes.values():
+            index.remove(doc_id)
+        self.data_size -= self._document_sizes.pop(doc_id, 0)
+
+    def replace(self, doc_id, document):
+        self.remove(doc_id)
+        self.add(doc_id, document)
+
+    def stored_size(self, doc_id):
+        # BSON size of a document, None if it is not in the collection
+        return self._document_sizes.get(doc_id)
+
+    def claim_unique_keys(self, document, pending, doc_id=None):
+        """
+        Check the unique indexes for a document which is about to be written,
+        its keys are added to `pending` so that the next documents of the batch are checked against it.
+        :param pending: dict of index name -> keys used by the batch
+        :raise DuplicateKeyError: if a key is used by another document
+        """
+        for index in self.indexes.values():
+            if not index.unique:
+                continue
+            used = pending.setdefault(index.name, set())
+            if index.conflict(document, doc_id=doc_id, pending=used) is not None:
+                raise DuplicateKeyError(index, document)
+        for index in self.indexes.values():
+            if index.unique:
+                pending[index.name].update(index.keys(document))
+
+    def specs(self):
+        return [index.spec() for index in self.indexes.values()]
+
+    def document_count(self):
+        # every document is in the `_id` index
+        return len(self.indexes[ID_INDEX_NAME]._document_keys)
+
+    def index_sizes(self):
+        return {name: index.size for name, index in self.indexes.items()}
+
+    def __len__(self):
+        return len(self.indexes)
+
+
+class IndexCatalog:
+    """
+    Indexes of all collections, built on first use.
+    """
+
+    def __init__(self, load_documents, load_specs):
+        """
+        :param load_documents: function(namespace) -> mapping of doc_id -> document
+        :param load_specs: function(namespace) -> list of index specs persisted for the namespace
+        """
+        self._load_documents = load_documents
+        self._load_specs = load_specs
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace):
+        indexes = self._collections.get(namespace)
+        if indexes is not None:
+            return indexes
+        with self._lock:
+            indexes = self._collections.get(namespace)
+            if indexes is None:
+                indexes = CollectionIndexes(namespace)
+                documents = self._load_documents(namespace)
+                indexes.build(documents)
+                for spec in self._load_specs(namespace):
+                    indexes.create(spec["name"], spec["key"], documents,
+                                   unique=spec.get("unique", False), sparse=spec.get("sparse", False))
+                self._collections[namespace] = indexes
+        return indexes
+
+    def discard(self, namespace):
+        # the table was written without going through the indexes, they are built again on next use
+        with self._lock:
+            self._collections.pop(namespace, None)
@@ -0,0 +1,140 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+# lock modes, named like the modes of MongoDB in serverStatus
+READ = "r"
+WRITE = "w"
+
+
+class RWLock:
+    """
+    Reader-writer lock: readers share the lock, a writer holds it alone. Waiting writers
+    stop new readers from entering so that a stream of queries can't starve the writes.
+
+    The writer may take the lock again, in either mode, while it holds it.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+        # mode -> number of acquisitions, of acquisitions which waited, microseconds waited
+        self.acquire_count = {READ: 0, WRITE: 0}
+        self.wait_count = {READ: 0, WRITE: 0}
+        self.wait_micros = {READ: 0, WRITE: 0}
+
+    def _wait(self, mode, can_enter):
+        # called with the condition held
+        if can_enter():
+            return
+        start = time.perf_counter_ns()
+        while not can_enter():
+            self._condition.wait()
+        self.wait_count[mode] += 1
+        self.wait_micros[mode] += (time.perf_counter_ns() - start) // 1000
+
+    def acquire_read(self):
+        with self._condition:
+            if self._writer == threading.get_ident():
+                self._writer_depth += 1
+                return
+            self._wait(READ, lambda: self._writer is None and not self._waiting_writers)
+            self._readers += 1
+            self.acquire_count[READ] += 1
+
+    def release_read(self):
+        with self._condition:
+            if self._writer == threading.get_ident():
+                self._writer_depth -= 1
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            self._waiting_writers += 1
+            try:
+                self._wait(WRITE, lambda: self._writer is None and not self._readers)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+            self.acquire_count[WRITE] += 1
+
+    def release_write(self):
+        with self._condition:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "acquireCount": dict(self.acquire_count),
+                "acquireWaitCount": dict(self.wait_count),
+                "timeAcquiringMicros": dict(self.wait_micros),
+            }
+
+
+class NamespaceLocks:
+    """
+    One reader-writer lock per collection: queries on a collection run in parallel, writes
+    to a collection are serialized, and collections don't wait for each other.
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace):
+        lock = self._locks.get(namespace)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(namespace, RWLock())
+        return lock
+
+    @contextmanager
+    def read(self, namespace):
+        lock = self.get(namespace)
+        lock.acquire_read()
+        try:
+            yield
+        finally:
+            lock.release_read()
+
+    @contextmanager
+    def write(self, namespace):
+        lock = self.get(namespace)
+        lock.acquire_write()
+        try:
+            yield
+        finally:
+            lock.release_write()
+
+    def stats(self):
+        """
+        :return: dict of namespace -> lock stats, see `RWLock.stats`
+        """
+        with self._lock:
+            locks = dict(self._locks)
+        return {namespace: lock.stats() for namespace, lock in locks.items()}
+
+    def totals(self):
+        # stats of all the collections summed, the "Collection" entry of serverStatus.locks
+        totals = {"acquireCount": {READ: 0, WRITE: 0}, "acquireWaitCount": {READ: 0, WRITE: 0},
+                  "timeAcquiringMicros": {READ: 0, WRITE: 0}}
+        for stats in self.stats().values():
+            for key, counters in stats.items():
+                for mode, value in counters.items():
+                    totals[key][mode] += value
+        return totals
@@ -0,0 +1,182 @@
+import os
+import threading
+
+from tinydb.storages import Storage
+
+
+class MemoryDatabase:
+    """
+    Tables of one database kept in the process, in the layout of the parsed JSON file:
+    table name -> {doc_id as a string: document}.
+
+    Every change is a record {"t": table, "s": {doc_id: document}, "r": [doc_id]} (or
+    {"t": table, "d": True} to drop a table) applied by `_log`, which engines with a log
+    extend to make the change durable.
+
+    A table handed to a scan is copy-on-write: the next change applies to a copy which
+    replaces it, so the scan keeps iterating the table as it was.
+    """
+
+    _databases = {}
+    _databases_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path):
+        """
+        The database of a table file path, created once per process.
+        """
+        path = os.path.abspath(path)
+        with cls._databases_lock:
+            database = cls._databases.get(path)
+            if database is None:
+                database = cls._databases[path] = cls(path)
+        return database
+
+    @classmethod
+    def opened(cls, path):
+        return cls._databases.get(os.path.abspath(path))
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        self._last_ids = {}
+        # names of the tables held by a scan, copied before their next change
+        self._shared = set()
+        self._lock = threading.Lock()
+
+    def _apply(self, record):
+        name = record["t"]
+        if record.get("d"):
+            self.tables.pop(name, None)
+            self._last_ids.pop(name, None)
+            self._shared.discard(name)
+            return
+        table = self.tables.setdefault(name, {})
+        if name in self._shared:
+            table = self.tables[name] = dict(table)
+            self._shared.discard(name)
+        documents = record.get("s", {})
+        table.update(documents)
+        for doc_id in record.get("r", ()):
+            table.pop(doc_id, None)
+        if documents:
+            self._last_ids[name] = max(self._last_ids.get(name, 0), max(map(int, documents)))
+
+    def _log(self, record):
+        with self._lock:
+            self._apply(record)
+
+    def read(self):
+        # tables are replaced by TinyDB before it writes them back, only the top level is copied
+        with self._lock:
+            return dict(self.tables)
+
+    def read_table(self, table_name):
+        # changed in place, only for lookups by doc_id
+        return self.tables.get(table_name, {})
+
+    def snapshot_table(self, table_name):
+        """
+        The table as of now, not changed by the next writes.
+        """
+        with self._lock:
+            table = self.tables.get(table_name)
+            if table is None:
+                return {}
+            self._shared.add(table_name)
+            return table
+
+    def table_names(self):
+        return list(self.tables)
+
+    def write_tables(self, data):
+        """
+        Apply the difference between the tables written back by TinyDB and the current ones.
+        """
+        with self._lock:
+            current = dict(self.tables)
+        for name, table in data.items():
+            old = current.get(name)
+            if old is table:
+                continue
+            old = old if old is not None else {}
+            table = {str(doc_id): document for doc_id, document in table.items()}
+            changed = {doc_id: document for doc_id, document in table.items() if old.get(doc_id) != document}
+            removed = [doc_id for doc_id in old if doc_id not in table]
+            if changed or removed or name not in current:
+                self._log({"t": name, "s": changed, "r": removed})
+        for name in current:
+            if name not in data:
+                self._log({"t": name, "d": True})
+
+    def insert_multiple(self, table_name, documents):
+        with self._lock:
+            first = self._last_ids.get(table_name, 0) + 1
+            # the ids are reserved, `_apply` keeps the maximum
+            self._last_ids[table_name] = first + len(documents) - 1
+        doc_ids = list(range(first, first + len(documents)))
+        self._log({"t": table_name, "s": {str(doc_id): document for doc_id, document in zip(doc_ids, documents)}})
+        return doc_ids
+
+    def update(self, table_name, documents):
+        self._log({"t": table_name, "s": {str(doc_id): document for doc_id, document in documents.items()}})
+
+    def remove(self, table_name, doc_ids):
+        self._log({"t": table_name, "r": [str(doc_id) for doc_id in doc_ids]})
+
+
+class MemoryStorage(Storage):
+    """
+    TinyDB storage of the in-memory engine, selected with `--storage memory`: nothing is
+    read from or written to disk and the data is lost when the process exits.
+    """
+
+    # data survives a restart of the server
+    persistent = False
+    database_class = MemoryDatabase
+
+    def __init__(self, path, **kwargs):
+        super().__init__()
+        self._database = self.database_class.open(path)
+
+    @classmethod
+    def database_table_names(cls, path):
+        database = cls.database_class.opened(path)
+        return database.table_names() if database is not None else []
+
+    @staticmethod
+    def database_size(path):
+        return 0
+
+    @classmethod
+    def stats(cls):
+        databases = list(cls.database_class._databases.values())
+        return {
+            "databases": len(databases),
+            "documents": sum(len(table) for database in databases for table in list(database.tables.values())),
+        }
+
+    def read(self):
+        return self._database.read()
+
+    def write(self, data):
+        self._database.write_tables(data)
+
+    def read_table(self, table_name):
+        return self._database.read_table(table_name)
+
+    def snapshot_table(self, table_name):
+        return self._database.snapshot_table(table_name)
+
+    def insert_multiple(self, table_name, documents):
+        return self._database.insert_multiple(table_name, documents)
+
+    def update(self, table_name, documents):
+        self._database.update(table_name, documents)
+
+    def remove(self, table_name, doc_ids):
+        self._database.remove(table_name, doc_ids)
+
+    def close(self):
+        # the database is shared by all the TinyDB objects of the process
+        pass
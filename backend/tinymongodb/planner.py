@@ -0,0 +1,300 @@
+import threading
+import time
+from itertools import product
+from math import log2
+
+from backend.tinymongodb.index import SortedIndex, is_scalar, range_bounds
+from backend.tinymongodb.query import normalize_sort
+
+# number of query shapes whose winning plan is kept
+PLAN_CACHE_SIZE = 1024
+
+
+class PlanError(Exception):
+    pass
+
+
+class ExecutionStats:
+    """
+    Counters filled while a plan is executed, reported by `explain` and the profiler.
+    """
+
+    def __init__(self):
+        self.keys_examined = 0
+        self.docs_examined = 0
+        self.n_returned = 0
+        # `QueryPlan.summary()` of the last plan executed
+        self.plan_summary = None
+        self.started = time.perf_counter()
+
+    def to_dict(self):
+        return {
+            "executionSuccess": True,
+            "nReturned": self.n_returned,
+            "executionTimeMillis": int((time.perf_counter() - self.started) * 1000),
+            "totalKeysExamined": self.keys_examined,
+            "totalDocsExamined": self.docs_examined
+        }
+
+
+def query_predicates(query):
+    """
+    Predicates of the top level fields of a query which can be answered by an index.
+    :return: dict of field -> list of equality values, dict of field -> (lower, upper) range bounds
+    """
+    equalities, ranges = {}, {}
+    if not isinstance(query, dict):
+        return equalities, ranges
+    for field, condition in query.items():
+        if field.startswith("$"):
+            continue
+        if is_scalar(condition):
+            equalities[field] = [condition]
+        elif isinstance(condition, dict) and len(condition) == 1 and next(iter(condition)) in ("$eq", "$in"):
+            operator, value = next(iter(condition.items()))
+            if operator == "$eq" and is_scalar(value):
+                equalities[field] = [value]
+            elif operator == "$in" and isinstance(value, list) and all(is_scalar(item) for item in value):
+                equalities[field] = value
+        else:
+            bounds = range_bounds(condition)
+            if bounds is not None:
+                ranges[field] = bounds
+    return equalities, ranges
+
+
+def query_shape(value):
+    """
+    Shape of a query: its fields and operators without the values, queries with the same
+    shape get the same plan.
+    """
+    if isinstance(value, dict):
+        return tuple((key, query_shape(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return ("[]",) + tuple(query_shape(item) for item in value if isinstance(item, dict))
+    return None
+
+
+def _range_str(condition):
+    # index bounds of a predicate as shown by MongoDB, like "[1, 5)"
+    if not isinstance(condition, dict):
+        return f"[{condition!r}, {condition!r}]"
+    if "$in" in condition:
+        return ", ".join(f"[{value!r}, {value!r}]" for value in condition["$in"])
+    lower, upper = "[MinKey", "MaxKey]"
+    for operator, value in condition.items():
+        if operator in ("$gt", "$gte", "$eq"):
+            lower = ("(" if operator == "$gt" else "[") + repr(value)
+        if operator in ("$lt", "$lte", "$eq"):
+            upper = repr(value) + (")" if operator == "$lt" else "]")
+    return f"{lower}, {upper}"
+
+
+class QueryPlan:
+    """
+    A way to read the documents of a query, a collection scan or a scan of one index:
+    - "equality": look up the equality values in the index
+    - "range": walk the keys between the bounds of the first field
+    - "full": walk all the keys of the index
+    """
+
+    def __init__(self, index=None, kind="collscan", lookups=None, bounds=None, reverse=False, ordered=False,
+                 keys=0):
+        self.index = index
+        self.kind = kind
+        self.lookups = lookups
+        self.bounds = bounds
+        self.reverse = reverse
+        # the doc_ids already follow the sort of the query
+        self.ordered = ordered
+        # number of keys, or documents for a collection scan, expected to be examined
+        self.keys = keys
+        self.cost = 0
+        self.from_cache = False
+
+    @property
+    def index_name(self):
+        return None if self.index is None else self.index.name
+
+    def doc_ids(self, stats):
+        """
+        :return: iterator over the doc_ids of the documents to examine, None for a collection scan
+        """
+        if self.index is None:
+            return None
+        if self.kind == "equality":
+            doc_ids = set()
+            for values in self.lookups:
+                matched = self.index.lookup(values)
+                stats.keys_examined += len(matched)
+                doc_ids.update(matched)
+            return iter(sorted(doc_ids))
+        if isinstance(self.index, SortedIndex):
+            lower, upper = self.bounds or (None, None)
+            return self.index.scan(lower, upper, reverse=self.reverse, stats=stats)
+        doc_ids = self.index.doc_ids()
+        stats.keys_examined += len(doc_ids)
+        return iter(doc_ids)
+
+    def summary(self):
+        """
+        Plan summary of the profiler and the logs, "COLLSCAN" or "IXSCAN { field: 1 }".
+        """
+        if self.index is None:
+            return "COLLSCAN"
+        fields = ", ".join(f"{field}: {direction}" for field, direction in self.index.key)
+        return f"IXSCAN {{ {fields} }}"
+
+    def describe(self, query, sort):
+        """
+        Plan stages in the format of MongoDB's explain output.
+        """
+        if self.index is None:
+            stage = {"stage": "COLLSCAN", "filter": query or {}, "direction": "forward"}
+        else:
+            fields = self.index.fields
+            if self.kind == "equality":
+                bounds = {field: sorted({f"[{values[idx]!r}, {values[idx]!r}]" for values in self.lookups})
+                          for idx, field in enumerate(fields)}
+            else:
+                bounds = {field: ["[MinKey, MaxKey]"] for field in fields}
+                if self.kind == "range":
+                    bounds[fields[0]] = [_range_str(query[fields[0]])]
+            stage = {
+                "stage": "FETCH",
+                "filter": query or {},
+                "inputStage": {
+                    "stage": "IXSCAN",
+                    "keyPattern": dict(self.index.key),
+                    "indexName": self.index.name,
+                    "isMultiKey": getattr(self.index, "multikey", False),
+                    "isUnique": self.index.unique,
+                    "isSparse": self.index.sparse,
+                    "direction": "backward" if self.reverse else "forward",
+                    "indexBounds": bounds
+                }
+            }
+        if sort and not self.ordered:
+            stage = {"stage": "SORT", "sortPattern": dict(normalize_sort(sort)), "inputStage": stage}
+        return stage
+
+
+class QueryPlanner:
+    """
+    Choose between a collection scan and the indexes of a collection by the number of keys
+    each plan would examine, the winning plan is cached per query shape.
+    """
+
+    def __init__(self, cache_size=PLAN_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, namespace):
+        # the indexes of the collection changed
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == namespace]:
+                del self._cache[key]
+
+    def _index_plans(self, index, equalities, ranges, sort):
+        plans = []
+        if not index.sparse and all(field in equalities for field in index.fields):
+            lookups = list(product(*(equalities[field] for field in index.fields)))
+            keys = sum(len(index.lookup(values)) for values in lookups)
+            plans.append(QueryPlan(index, "equality", lookups=lookups, keys=keys))
+        if not isinstance(index, SortedIndex):
+            return plans
+        first = index.fields[0]
+        bounds = ranges.get(first)
+        prefix = 0
+        if bounds is None and len(equalities.get(first, ())) == 1:
+            # a single value of the first field, the sort can use the next fields
+            key = range_bounds({"$gte": equalities[first][0], "$lte": equalities[first][0]})
+            bounds, prefix = key, 1
+        if bounds is not None and not index.sparse:
+            reverse = index.sort_order(sort, prefix=prefix)
+            if reverse is None and prefix:
+                reverse = index.sort_order(sort)
+            plans.append(QueryPlan(index, "range", bounds=bounds, reverse=bool(reverse),
+                                   ordered=reverse is not None, keys=index.count(*bounds)))
+        reverse = index.sort_order(sort)
+        if reverse is not None:
+            plans.append(QueryPlan(index, "full", reverse=reverse, ordered=True, keys=len(index.ordered)))
+        return plans
+
+    def _cost(self, plan, query, sort, limit, used_fields):
+        cost = plan.keys
+        if sort and not plan.ordered:
+            # the matching documents are sorted in memory
+            cost += plan.keys * log2(plan.keys + 1) / 4
+        elif limit and (plan.ordered or not sort) and set(query or {}) <= used_fields:
+            # every key matches, the walk stops at the limit
+            cost = min(cost, limit)
+        return cost
+
+    def candidates(self, indexes, query, sort=None, limit=0, hint=None):
+        """
+        All the plans of a query, the cheapest first.
+        :param indexes: `CollectionIndexes` of the collection
+        :param limit: number of documents needed (skip + limit), 0 for all of them
+        :param hint: index name, key pattern or {"$natural": 1} forcing the plan
+        """
+        equalities, ranges = query_predicates(query)
+        sort = normalize_sort(sort)
+        n_documents = indexes.document_count()
+        collscan = QueryPlan(keys=n_documents)
+        if hint is not None and hint != {} and hint != "":
+            if isinstance(hint, dict) and "$natural" in hint:
+                return [collscan]
+            name = hint if isinstance(hint, str) else indexes.find(hint)
+            if name not in indexes.indexes:
+                raise PlanError("error processing query: planner returned error :: caused by :: "
+                                "hint provided does not correspond to an existing index")
+            index = indexes.indexes[name]
+            plans = self._index_plans(index, equalities, ranges, sort)
+            if not plans:
+                # a hinted index is walked entirely when it can't bound the query
+                plans = [QueryPlan(index, "full", keys=n_documents)]
+        else:
+            plans = [collscan]
+            for index in indexes.indexes.values():
+                plans.extend(self._index_plans(index, equalities, ranges, sort))
+        for plan in plans:
+            used_fields = set()
+            if plan.kind == "equality":
+                used_fields = set(plan.index.fields)
+            elif plan.kind == "range":
+                used_fields = {plan.index.fields[0]}
+            plan.cost = self._cost(plan, query, sort, limit, used_fields)
+        # an index is preferred to a collection scan of the same cost
+        plans.sort(key=lambda plan: (plan.cost, plan.index is None))
+        return plans
+
+    def plan(self, indexes, query, sort=None, limit=0, hint=None):
+        """
+        The winning plan of a query, cached for the queries of the same shape.
+        """
+        if hint is not None:
+            return self.candidates(indexes, query, sort=sort, limit=limit, hint=hint)[0]
+        cache_key = (indexes.namespace, query_shape(query), query_shape(sort), bool(limit))
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            index_name, kind = cached
+            if index_name is None:
+                plan = QueryPlan(keys=indexes.document_count())
+                plan.from_cache = True
+                return plan
+            index = indexes.indexes.get(index_name)
+            if index is not None:
+                equalities, ranges = query_predicates(query)
+                for plan in self._index_plans(index, equalities, ranges, normalize_sort(sort)):
+                    if plan.kind == kind:
+                        plan.from_cache = True
+                        return plan
+        plan = self.candidates(indexes, query, sort=sort, limit=limit)[0]
+        with self._lock:
+            if len(self._cache) >= self.cache_size:
+                # the oldest shape is evicted
+                del self._cache[next(iter(self._cache))]
+            self._cache[cache_key] = (plan.index_name, plan.kind)
+        return plan
@@ -0,0 +1,197 @@
+import queue
+import random
+import threading
+
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import bson
+
+from utils.logger import server_logger, truncated
+
+PROFILE_COLLECTION = "system.profile"
+# documents kept in the system.profile collection of a database, the oldest are removed
+PROFILE_MAX_DOCUMENTS = 1000
+# operations slower than this are recorded at level 1, same default as MongoDB
+DEFAULT_SLOW_MS = 100
+# commands larger than this are recorded as a truncated string, same as MongoDB
+PROFILE_COMMAND_MAX_SIZE = 50 * 1024
+# events waiting for the writer, new events are dropped when it falls behind
+PROFILE_QUEUE_SIZE = 10000
+PROFILE_BATCH_SIZE = 256
+# seconds the writer waits for more events before writing a batch
+PROFILE_FLUSH_INTERVAL = 0.05
+
+# "op" of a profile document from the `top` operation type
+PROFILE_OPS = {"queries": "query", "commands": "command"}
+
+# raw material of a profile document, turned into the document by the writer thread:
+# command: command document, or a function() decoding the legacy message
+# reply: reply payload (sections of OP_MSG or fields of OP_REPLY), None without reply
+# examined: (keysExamined, docsExamined, planSummary) when the operation ran a query, else None
+ProfileEvent = namedtuple("ProfileEvent", ["db", "ns", "op", "command", "reply", "millis", "examined", "ts"])
+
+
+def _reply_counts(op, reply):
+    # counters of a profile document read from the reply
+    counts = {}
+    if not reply:
+        return counts
+    if isinstance(reply, dict):
+        # OP_REPLY
+        counts["nreturned"] = len(reply.get("documents", ()))
+        return counts
+    section = reply[0]
+    cursor = section.get("cursor")
+    if isinstance(cursor, dict):
+        counts["nreturned"] = len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+    elif op == "insert":
+        counts["ninserted"] = section.get("n", 0)
+    elif op == "remove":
+        counts["ndeleted"] = section.get("n", 0)
+    elif op == "update":
+        counts["nMatched"] = section.get("n", 0)
+        counts["nModified"] = section.get("nModified", 0)
+    return counts
+
+
+def _reply_length(reply):
+    if not reply:
+        return 0
+    if isinstance(reply, dict):
+        return sum(len(bson.encode(document)) for document in reply.get("documents", ()))
+    return sum(len(bson.encode(section)) for section in reply)
+
+
+def profile_document(event):
+    """
+    Document of the system.profile collection, in the format of MongoDB.
+    """
+    command = event.command() if callable(event.command) else event.command
+    if len(bson.encode(command)) > PROFILE_COMMAND_MAX_SIZE:
+        command = {"$truncated": str(truncated(command))}
+    document = {
+        "op": event.op,
+        "ns": event.ns,
+        "command": command,
+    }
+    if event.examined is not None:
+        keys_examined, docs_examined, plan_summary = event.examined
+        document["keysExamined"] = keys_examined
+        document["docsExamined"] = docs_examined
+        if plan_summary is not None:
+            document["planSummary"] = plan_summary
+    document.update(_reply_counts(event.op, event.reply))
+    document["responseLength"] = _reply_length(event.reply)
+    document["millis"] = event.millis
+    document["ts"] = event.ts
+    return document
+
+
+class Profiler:
+    """
+    Database profiler set by the `profile` command: level 0 is off, level 1 records the
+    operations slower than `slowms`, level 2 records every operation. The level is set per
+    database, `slowms` and `sampleRate` apply to all of them, same as MongoDB.
+
+    Requests only put an event in a queue, a writer thread builds the documents and writes
+    them in batches to the capped system.profile collection of each database.
+    """
+
+    def __init__(self, write_documents, level=0, slow_ms=DEFAULT_SLOW_MS, sample_rate=1.0):
+        """
+        :param write_documents: function(db, documents) writing profile documents to a database
+        :param level: level of the databases which were not set by the `profile` command
+        """
+        self._write_documents = write_documents
+        self.default_level = level
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self._levels = {}
+        self._queue = queue.Queue(PROFILE_QUEUE_SIZE)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self.dropped = 0
+
+    def level(self, db):
+        return self._levels.get(db, self.default_level)
+
+    def set_level(self, db, level, slow_ms=None, sample_rate=None):
+        """
+        :return: the previous level of the database
+        """
+        was = self.level(db)
+        if level >= 0:
+            self._levels[db] = level
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        return was
+
+    def enabled(self, db):
+        # checked before a request, the request collects its execution stats only if profiled
+        return bool(self._levels.get(db, self.default_level))
+
+    def record(self, db, ns, op, command, reply, millis, stats):
+        """
+        Queue an operation of a database with profiling enabled, if it qualifies.
+        :param command: command document, or function() -> command document called by the writer
+        :param reply: reply payload, encoded by the writer to get `responseLength`
+        :param stats: `ExecutionStats` of the operation, None if it ran no query
+        """
+        if ns.endswith("." + PROFILE_COLLECTION):
+            # the profiler would profile the queries on its own results
+            return
+        level = self.level(db)
+        if level == 1 and millis < self.slow_ms:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        # a cursor keeps filling the stats on getMore, the counters of this operation are copied now
+        examined = None if stats is None else (stats.keys_examined, stats.docs_examined, stats.plan_summary)
+        self._start_writer()
+        try:
+            self._queue.put_nowait(ProfileEvent(db, ns, op, command, reply, millis, examined,
+                                                datetime.now(timezone.utc)))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_writer(self):
+        if self._writer is not None:
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="tinymongo-profiler", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            # wait a little for the events of the same burst, they are written together
+            try:
+                while len(batch) < PROFILE_BATCH_SIZE:
+                    batch.append(self._queue.get(timeout=PROFILE_FLUSH_INTERVAL))
+            except queue.Empty:
+                pass
+            self._write_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_batch(self, batch):
+        by_db = {}
+        for event in batch:
+            try:
+                by_db.setdefault(event.db, []).append(profile_document(event))
+            except Exception as e:
+                server_logger.error(f"Can't build the profile document of {event.ns}: {e}")
+        for db, documents in by_db.items():
+            try:
+                self._write_documents(db, documents)
+            except Exception as e:
+                server_logger.error(f"Can't write the profile of {db}: {e}")
+
+    def flush(self):
+        # wait until the queued events are written, used by tests
+        if self._writer is not None:
+            self._queue.join()
@@ -0,0 +1,140 @@
+# projections of find, OP_QUERY's returnFieldsSelector and the $project stage, applied to
+# the documents before they are encoded so that the dropped fields are never sent
+from backend.op_code import ErrorCode
+
+
+class ProjectionError(Exception):
+
+    def __init__(self, message, code=ErrorCode.BadValue):
+        super().__init__(message)
+        self.code = code
+
+
+class _Computed:
+    # field of an inclusion projection set to the value of an expression
+    __slots__ = ("expression",)
+
+    def __init__(self, expression):
+        self.expression = expression
+
+
+def _excluded(value):
+    return value is False or (not isinstance(value, bool) and isinstance(value, (int, float)) and value == 0)
+
+
+def _included(value):
+    return value is True or (not isinstance(value, bool) and isinstance(value, (int, float)) and value != 0)
+
+
+class Projection:
+    """
+    A compiled projection: the fields of the spec as a tree of their dotted paths, applied to
+    each document in one walk. An inclusion projection keeps the listed fields and `_id`
+    unless `_id: 0`, an exclusion projection removes the listed fields. A path going through
+    an array applies to the documents of the array, same as MongoDB.
+    """
+
+    def __init__(self, spec, evaluate=None):
+        """
+        :param spec: {"field.path": 0 or 1, ...}
+        :param evaluate: function(expression, document) of the computed fields, None if the
+            projection only takes 0 and 1
+        """
+        if not isinstance(spec, dict) or not spec:
+            raise ProjectionError("projection specification must be a non-empty object", ErrorCode.FailedToParse)
+        self.evaluate = evaluate
+        fields = [field for field in spec if field != "_id"] or list(spec)
+        self.inclusion = not _excluded(spec[fields[0]])
+        self.tree = {}
+        for field, value in spec.items():
+            if _excluded(value):
+                if self.inclusion and field != "_id":
+                    raise ProjectionError(f"Cannot do exclusion on field {field} in inclusion projection",
+                                          ErrorCode.ProjectionExclusionInInclusion)
+                if not self.inclusion:
+                    self._add(field, True)
+            elif not self.inclusion:
+                raise ProjectionError(f"Cannot do inclusion on field {field} in exclusion projection",
+                                      ErrorCode.ProjectionInclusionInExclusion)
+            elif _included(value):
+                self._add(field, True)
+            elif evaluate is not None:
+                self._add(field, _Computed(value))
+            else:
+                raise ProjectionError(f"Unsupported projection option: {field}: {value!r}")
+        if self.inclusion and not _excluded(spec.get("_id", True)):
+            # `_id` is kept unless the projection removes it
+            self.tree.setdefault("_id", True)
+
+    def _add(self, field, leaf):
+        node = self.tree
+        parts = field.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if not isinstance(node, dict):
+                raise ProjectionError(f"Path collision at {field}", ErrorCode.ProjectionPathCollision)
+        if parts[-1] in node:
+            raise ProjectionError(f"Path collision at {field}", ErrorCode.ProjectionPathCollision)
+        node[parts[-1]] = leaf
+
+    def apply(self, document):
+        """
+        :return: the projected document, a new one, the fields kept are not copied
+        """
+        if self.inclusion:
+            return self._include(document, self.tree, document)
+        return self._exclude(document, self.tree)
+
+    def _include(self, value, tree, root):
+        projected = {}
+        for key, item in value.items():
+            node = tree.get(key)
+            if node is True:
+                projected[key] = item
+            elif isinstance(node, dict) and isinstance(item, (dict, list)):
+                projected[key] = self._include_nested(item, node, root)
+        for key, node in tree.items():
+            if isinstance(node, _Computed):
+                projected[key] = self.evaluate(node.expression, root)
+            elif isinstance(node, dict) and key not in value and self._computes(node):
+                projected[key] = self._include({}, node, root)
+        return projected
+
+    def _include_nested(self, item, tree, root):
+        if isinstance(item, dict):
+            return self._include(item, tree, root)
+        # only the documents of an array can hold the included fields
+        return [self._include_nested(element, tree, root) for element in item if isinstance(element, (dict, list))]
+
+    def _computes(self, tree):
+        return any(isinstance(node, _Computed) or (isinstance(node, dict) and self._computes(node))
+                   for node in tree.values())
+
+    def _exclude(self, value, tree):
+        projected = {}
+        for key, item in value.items():
+            node = tree.get(key)
+            if node is None:
+                projected[key] = item
+            elif node is True:
+                continue
+            elif isinstance(item, (dict, list)):
+                projected[key] = self._exclude_nested(item, node)
+            else:
+                projected[key] = item
+        return projected
+
+    def _exclude_nested(self, item, tree):
+        if isinstance(item, dict):
+            return self._exclude(item, tree)
+        return [self._exclude_nested(element, tree) if isinstance(element, (dict, list)) else element
+                for element in item]
+
+
+def compile_projection(spec):
+    """
+    :return: the `Projection` of a find projection, None when nothing is projected
+    """
+    if spec is None or spec == {}:
+        return None
+    return Projection(spec)
@@ -0,0 +1,166 @@
+# helpers to evaluate MongoDB style field paths like "a.b.0.c" on documents
+import datetime
+
+from bson import Binary, Decimal128, ObjectId, Timestamp
+
+_MISSING = object()
+
+
+def split_path(path):
+    return path.split(".")
+
+
+def get_field(document, path, default=None):
+    """
+    Read the value of a dotted path.
+    :param document: dict object
+    :param path: field path like "a.b.0"
+    :param default: returned if the path does not exist
+    """
+    value = document
+    for part in split_path(path):
+        if isinstance(value, dict):
+            if part not in value:
+                return default
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit():
+            idx = int(part)
+            if idx >= len(value):
+                return default
+            value = value[idx]
+        else:
+            return default
+    return value
+
+
+def has_field(document, path):
+    return get_field(document, path, _MISSING) is not _MISSING
+
+
+def set_field(document, path, value):
+    """
+    Write the value of a dotted path, the missing sub-documents are created.
+    """
+    parts = split_path(path)
+    target = document
+    for part in parts[:-1]:
+        if isinstance(target, list) and part.isdigit():
+            idx = int(part)
+            while len(target) <= idx:
+                target.append(None)
+            if not isinstance(target[idx], (dict, list)):
+                target[idx] = {}
+            target = target[idx]
+        else:
+            if not isinstance(target.get(part), (dict, list)):
+                target[part] = {}
+            target = target[part]
+    last = parts[-1]
+    if isinstance(target, list) and last.isdigit():
+        idx = int(last)
+        while len(target) <= idx:
+            target.append(None)
+        target[idx] = value
+    else:
+        target[last] = value
+
+
+def unset_field(document, path):
+    """
+    Remove a dotted path, do nothing if it does not exist.
+    :return: the removed value, or `None`
+    """
+    parts = split_path(path)
+    parent = get_field(document, ".".join(parts[:-1])) if len(parts) > 1 else document
+    last = parts[-1]
+    if isinstance(parent, dict):
+        return parent.pop(last, None)
+    if isinstance(parent, list) and last.isdigit() and int(last) < len(parent):
+        # array elements are set to null instead of being removed, same as MongoDB
+        value, parent[int(last)] = parent[int(last)], None
+        return value
+    return None
+
+
+def hashable(value):
+    """
+    Convert a document value to a hashable key, used to compare `_id` and index keys.
+    """
+    if isinstance(value, dict):
+        return ("__dict__",) + tuple((key, hashable(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return ("__list__",) + tuple(hashable(item) for item in value)
+    return value
+
+
+def _type_rank(value):
+    # BSON comparison order, used to sort values of different types
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float, Decimal128)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, (bytes, Binary)):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    if isinstance(value, Timestamp):
+        return 10
+    return 11
+
+
+def sort_key(value):
+    """
+    Key which orders document values like MongoDB does: by type first, then by value.
+    """
+    rank = _type_rank(value)
+    if rank == 1:
+        return rank, 0
+    if rank == 2 and isinstance(value, Decimal128):
+        return rank, float(value.to_decimal())
+    if rank == 4:
+        return rank, tuple((key, sort_key(item)) for key, item in value.items())
+    if rank == 5:
+        return rank, tuple(sort_key(item) for item in value)
+    if rank == 9:
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return rank, value.timestamp()
+    if rank == 10:
+        return rank, (value.time, value.inc)
+    if rank == 11:
+        return rank, str(value)
+    return rank, value
+
+
+def normalize_sort(sort_spec):
+    """
+    :param sort_spec: {"field": 1, ...} or [("field", -1), ...]
+    :return: list of (field, direction)
+    """
+    if not sort_spec:
+        return []
+    items = sort_spec.items() if isinstance(sort_spec, dict) else sort_spec
+    # directions like {"$meta": "textScore"} are not supported and ignored
+    return [(field, -1 if direction < 0 else 1) for field, direction in items
+            if isinstance(direction, (int, float))]
+
+
+def sort_documents(documents, sort_spec):
+    """
+    Sort documents by several fields, missing fields are sorted like null.
+    """
+    documents = list(documents)
+    # stable sorts from the last key to the first one
+    for field, direction in reversed(normalize_sort(sort_spec)):
+        documents.sort(key=lambda document: sort_key(get_field(document, field)), reverse=direction < 0)
+    return documents
@@ -0,0 +1,317 @@
+import json
+import os
+import shutil
+import threading
+
+from contextlib import contextmanager
+
+from bson import json_util
+from tinydb.database import Document
+from tinydb.storages import JSONStorage
+from tinymongo import TinyMongoClient
+from tinymongo.tinymongo import TinyMongoDatabase
+
+from backend.tinymongodb.memory import MemoryStorage
+from backend.tinymongodb.wal import WALStorage
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks, the files are only used by one process
+    fcntl = None
+
+
+# parsed content of the table files: path -> ((mtime, size), data)
+_parsed_files = {}
+_parsed_files_lock = threading.Lock()
+# reads answered from the cache and reads which parsed the file, counted without a lock
+_parsed_files_stats = {"hits": 0, "misses": 0}
+# path -> lock of the read-modify-write of a table file by the threads of this process
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def _file_stamp(handle):
+    stat = os.fstat(handle.fileno())
+    return stat.st_mtime_ns, stat.st_size
+
+
+@contextmanager
+def _file_lock(handle, exclusive=False):
+    # the worker processes never read a file while another one rewrites it
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(handle.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    try:
+        yield
+    finally:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+def _read_parsed(path, handle):
+    """
+    Parsed content of a table file, from the cache while the file doesn't change.
+    :return: dict of table name -> table, None if the file is empty
+    """
+    with _file_lock(handle):
+        stamp = _file_stamp(handle)
+        if not stamp[1]:
+            # file is empty
+            return None
+        cached = _parsed_files.get(path)
+        if cached is not None and cached[0] == stamp:
+            _parsed_files_stats["hits"] += 1
+            return cached[1]
+        _parsed_files_stats["misses"] += 1
+        handle.seek(0)
+        data = json.load(handle, object_hook=json_util.object_hook)
+    with _parsed_files_lock:
+        _parsed_files[path] = (stamp, data)
+    return data
+
+
+class BSONJSONStorage(JSONStorage):
+    """
+    TinyDB JSON storage which keeps BSON types (ObjectId, datetime, Int64, ...) by writing
+    them as MongoDB Extended JSON, documents sent by the drivers can't be stored with
+    the plain `json` module.
+
+    TinyDB reads the whole file for every operation, the parsed content is kept until
+    the file changes so that an index lookup does not parse the whole table again.
+    """
+
+    # data survives a restart of the server
+    persistent = True
+
+    def __init__(self, path, **kwargs):
+        kwargs.setdefault("default", json_util.default)
+        super().__init__(path, **kwargs)
+        self._path = os.path.abspath(path)
+
+    def _parsed(self):
+        return _read_parsed(self._path, self._handle)
+
+    def read(self):
+        data = self._parsed()
+        if data is None:
+            return None
+        # TinyDB replaces the tables of the returned dict before writing it back but never
+        # changes a table in place, only the top level is copied
+        return dict(data)
+
+    def read_table(self, table_name):
+        """
+        Raw documents of a table keyed by doc_id as a string, shared with the cache and not copied.
+        """
+        data = self._parsed()
+        return data.get(table_name, {}) if data else {}
+
+    # the parsed tables are never changed, a write parses or builds new ones
+    snapshot_table = read_table
+
+    @staticmethod
+    def database_table_names(path):
+        # tables of a database read without opening it with TinyDB, which writes new files
+        try:
+            with open(path, encoding="utf-8") as handle:
+                return list(_read_parsed(path, handle) or {})
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def stats():
+        return {
+            "cachedFiles": len(_parsed_files),
+            "cacheHits": _parsed_files_stats["hits"],
+            "cacheMisses": _parsed_files_stats["misses"],
+        }
+
+    @staticmethod
+    def database_size(path):
+        # size of the table file, 0 if it was never written
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def write(self, data):
+        with _file_lock(self._handle, exclusive=True):
+            super().write(data)
+            stamp = _file_stamp(self._handle)
+        # the doc_ids are kept as strings, same as after parsing the file
+        parsed = {name: {str(doc_id): document for doc_id, document in table.items()}
+                  for name, table in data.items()}
+        with _parsed_files_lock:
+            _parsed_files[self._path] = (stamp, parsed)
+
+    def _write_table(self, table_name, change):
+        # read-modify-write of the whole file, the table is copied as the cache shares it;
+        # the file holds all the collections of the database, writers of other collections wait
+        with _write_locks_lock:
+            lock = _write_locks.setdefault(self._path, threading.Lock())
+        with lock:
+            data = self.read() or {}
+            table = dict(data.get(table_name, {}))
+            result = change(table)
+            data[table_name] = table
+            self.write(data)
+        return result
+
+    def insert_multiple(self, table_name, documents):
+        """
+        Write documents to a table, the doc_ids follow the largest one like in TinyDB.
+        :return: list of the doc_ids
+        """
+        def insert(table):
+            first = max(map(int, table), default=0) + 1
+            doc_ids = list(range(first, first + len(documents)))
+            table.update((str(doc_id), document) for doc_id, document in zip(doc_ids, documents))
+            return doc_ids
+        return self._write_table(table_name, insert)
+
+    def update(self, table_name, documents):
+        """
+        Replace documents of a table.
+        :param documents: dict of doc_id -> new document
+        """
+        self._write_table(table_name, lambda table: table.update(
+            (str(doc_id), document) for doc_id, document in documents.items()))
+
+    def remove(self, table_name, doc_ids):
+        def remove(table):
+            for doc_id in doc_ids:
+                table.pop(str(doc_id), None)
+        self._write_table(table_name, remove)
+
+
+def fetch_documents(collection, doc_ids=None):
+    """
+    Read documents of a TinyMongo collection by doc_id, without building
+    all the documents of the table like TinyDB does.
+    :param doc_ids: iterable of doc_ids, None for all the documents in natural order
+    """
+    storage = collection.parent.tinydb._storage
+    if doc_ids is None:
+        # the scan is consumed lazily by the cursor, the writes meanwhile don't change the snapshot
+        for doc_id, document in storage.snapshot_table(collection.tablename).items():
+            yield Document(document, int(doc_id))
+        return
+    table = storage.read_table(collection.tablename)
+    for doc_id in doc_ids:
+        document = table.get(str(doc_id))
+        if document is not None:
+            yield Document(document, doc_id)
+
+
+class MetadataLock:
+    """
+    Lock of the read-modify-write of the "admin" database, which is written by all the worker
+    processes: a thread lock and an exclusive lock on a file next to the tables.
+    """
+
+    def __init__(self, path=None):
+        # without a path the metadata is not shared with other processes, only the thread lock is used
+        self._path = path
+        self._thread_lock = threading.RLock()
+        self._handle = None
+        self._depth = 0
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0 and fcntl is not None and self._path is not None:
+            if self._handle is None:
+                self._handle = open(self._path, "a")
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth == 0 and self._handle is not None:
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
+# storage engines selected with `--storage`
+STORAGE_ENGINES = {
+    "json": BSONJSONStorage,
+    "wal": WALStorage,
+    "memory": MemoryStorage,
+}
+# metadata of the server, kept in the JSON files when they are shared by worker processes
+# or outlive the process
+SYSTEM_DATABASES = ("admin", "config", "local")
+
+
+class BSONTinyMongoClient(TinyMongoClient):
+
+    def __init__(self, foldername="tinydb", storage="json", shared=False):
+        """
+        :param storage: name of the storage engine in `STORAGE_ENGINES`
+        :param shared: the system databases are written by other worker processes
+        """
+        if storage not in STORAGE_ENGINES:
+            raise ValueError(f"unknown storage engine: {storage}")
+        self.storage_engine = storage
+        engine = STORAGE_ENGINES[storage]
+        # an in-memory server without workers never touches the disk
+        self._files = shared or engine.persistent
+        if self._files:
+            super().__init__(foldername)
+        else:
+            self._foldername = foldername
+        self.metadata_lock = MetadataLock(os.path.join(foldername, ".metadata.lock") if self._files else None)
+
+    @property
+    def _storage(self):
+        return BSONJSONStorage
+
+    def storage_class(self, database):
+        if database in SYSTEM_DATABASES and self._files:
+            return BSONJSONStorage
+        return STORAGE_ENGINES[self.storage_engine]
+
+    def __getitem__(self, database):
+        return TinyMongoDatabase(database, self._foldername, self.storage_class(database))
+
+    def __getattr__(self, name):
+        # TinyMongo opens a database for any attribute, private ones are real attribute errors
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def database_storage(self, database):
+        return self[database].tinydb._storage
+
+    def database_path(self, database):
+        return os.path.abspath(os.path.join(self._foldername, database + ".json"))
+
+    def table_names(self, database):
+        return self.storage_class(database).database_table_names(self.database_path(database))
+
+    @contextmanager
+    def metadata_transaction(self):
+        """
+        Hold the metadata lock, the "admin" database is read again from the file
+        as another worker process may have written it within the same mtime tick.
+        """
+        with self.metadata_lock:
+            with _parsed_files_lock:
+                _parsed_files.pop(self.database_path("admin"), None)
+            yield
+
+    def engine_stats(self):
+        """
+        :return: dict of engine name -> stats of the engines used by this client
+        """
+        engines = {self.storage_engine: STORAGE_ENGINES[self.storage_engine]}
+        if self._files:
+            engines["json"] = BSONJSONStorage
+        return {name: engine.stats() for name, engine in engines.items()}
+
+    def database_file_size(self, database):
+        return self.storage_class(database).database_size(self.database_path(database))
+
+    def disk_usage(self):
+        return shutil.disk_usage(self._foldername if self._files else os.getcwd())
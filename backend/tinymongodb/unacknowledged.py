@@ -0,0 +1,157 @@
+import queue
+import threading
+
+from collections import namedtuple
+
+from utils.logger import server_logger
+
+# writes waiting for the writer, `submit` blocks when the queue is full
+DEFAULT_QUEUE_SIZE = 10000
+# queued writes taken at once by the writer
+WRITE_BATCH_SIZE = 1000
+
+# namespace, documents and `ordered` of an insert, or `run`: function() executing any other write
+UnacknowledgedWrite = namedtuple("UnacknowledgedWrite", ["namespace", "documents", "run", "ordered"],
+                                 defaults=(True,))
+
+
+class UnacknowledgedWriter:
+    """
+    Background writer of the writes nobody waits for: OP_MSG requests with `moreToCome`,
+    commands with writeConcern `{w: 0}` and the legacy OP_INSERT, OP_UPDATE and OP_DELETE.
+
+    The writes are executed in order, consecutive inserts into one collection with the same
+    `ordered` are written with one `insert_multiple`. Every write gets a ticket, `wait(ticket)`
+    returns once it is written, so a connection can read its own writes.
+    """
+
+    def __init__(self, insert, max_queued=DEFAULT_QUEUE_SIZE):
+        """
+        :param insert: function(namespace, documents, ordered) writing a batch of documents,
+            returns the write errors with the `index` of the failed documents
+        :param max_queued: writes in the queue before `submit` blocks
+        """
+        self._insert = insert
+        self.max_queued = max_queued
+        self._queue = queue.Queue(max_queued)
+        # tickets are given in queue order
+        self._submit_lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._completed_changed = threading.Condition()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        # submits which waited for room in the queue
+        self.blocked = 0
+        self.batches = 0
+        self.documents = 0
+        self.errors = 0
+
+    def submit(self, write):
+        """
+        Queue a write, blocks while the queue is full so that the clients slow down
+        to the pace of the writer instead of growing the queue.
+        :return: ticket of the write
+        """
+        self._start()
+        with self._submit_lock:
+            self._submitted += 1
+            ticket = self._submitted
+            try:
+                self._queue.put_nowait((ticket, write))
+            except queue.Full:
+                self.blocked += 1
+                self._queue.put((ticket, write))
+        return ticket
+
+    def wait(self, ticket):
+        # block until the write of the ticket, and all the writes before it, are written
+        with self._completed_changed:
+            self._completed_changed.wait_for(lambda: self._completed >= ticket)
+
+    def flush(self):
+        self.wait(self._submitted)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_loop, name="tinymongo-unacknowledged",
+                                                daemon=True)
+                self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            items = [self._queue.get()]
+            # the writes queued meanwhile are written together
+            while len(items) < WRITE_BATCH_SIZE:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write([write for _, write in items])
+            with self._completed_changed:
+                self._completed = items[-1][0]
+                self._completed_changed.notify_all()
+
+    def _write(self, writes):
+        # consecutive inserts into one namespace with the same `ordered`
+        batch = []
+        for write in writes:
+            if write.run is None and batch and (write.namespace, write.ordered) == (batch[0].namespace,
+                                                                                   batch[0].ordered):
+                batch.append(write)
+                continue
+            self._write_documents(batch)
+            batch = []
+            if write.run is None:
+                batch = [write]
+            else:
+                self._run(write.run)
+        self._write_documents(batch)
+
+    def _write_documents(self, batch):
+        while batch:
+            documents = [document for write in batch for document in write.documents]
+            if not documents:
+                return
+            self.batches += 1
+            self.documents += len(documents)
+            namespace, ordered = batch[0].namespace, batch[0].ordered
+            write_errors = self._run(lambda: self._insert(namespace, documents, ordered))
+            if not write_errors:
+                return
+            self.errors += len(write_errors)
+            if not ordered:
+                return
+            # an ordered insert stops at its first error, the inserts of the next requests still run
+            failed = write_errors[0]["index"]
+            for position, write in enumerate(batch):
+                failed -= len(write.documents)
+                if failed < 0:
+                    batch = batch[position + 1:]
+                    break
+            else:
+                return
+
+    def _run(self, run):
+        try:
+            return run()
+        except Exception as e:
+            # nobody waits for the result, the error is only logged
+            self.errors += 1
+            server_logger.error(f"Unacknowledged write failed: {e}")
+            return None
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "maxQueued": self.max_queued,
+            "submitted": self._submitted,
+            "completed": self._completed,
+            "blocked": self.blocked,
+            "insertBatches": self.batches,
+            "insertedDocuments": self.documents,
+            "errors": self.errors,
+        }
@@ -0,0 +1,225 @@
+import copy
+import datetime
+
+from backend.op_code import ErrorCode
+from backend.tinymongodb.query import get_field, set_field, unset_field, has_field
+
+
+class UpdateError(Exception):
+
+    def __init__(self, message, code=ErrorCode.BadValue):
+        super().__init__(message)
+        self.code = code
+
+
+def is_operator_update(update):
+    """
+    An update document either only contains update operators like `$set`,
+    or is a replacement document without any of them.
+    """
+    return bool(update) and next(iter(update)).startswith("$")
+
+
+def _number(value, operator, path):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise UpdateError(f"Cannot apply {operator} to a value of non-numeric type at '{path}'")
+    return value
+
+
+def _apply_inc(document, path, value):
+    current = get_field(document, path, 0)
+    set_field(document, path, _number(current, "$inc", path) + _number(value, "$inc", path))
+
+
+def _apply_mul(document, path, value):
+    current = get_field(document, path, 0)
+    set_field(document, path, _number(current, "$mul", path) * _number(value, "$mul", path))
+
+
+def _apply_min(document, path, value):
+    current = get_field(document, path, None)
+    try:
+        if not has_field(document, path) or value < current:
+            set_field(document, path, value)
+    except TypeError:
+        raise UpdateError(f"Cannot compare {value!r} with the value at '{path}'")
+
+
+def _apply_max(document, path, value):
+    current = get_field(document, path, None)
+    try:
+        if not has_field(document, path) or value > current:
+            set_field(document, path, value)
+    except TypeError:
+        raise UpdateError(f"Cannot compare {value!r} with the value at '{path}'")
+
+
+def _apply_rename(document, path, new_path):
+    if has_field(document, path):
+        set_field(document, new_path, unset_field(document, path))
+
+
+def _array_at(document, path, operator):
+    current = get_field(document, path, None)
+    if current is None:
+        current = []
+        set_field(document, path, current)
+    if not isinstance(current, list):
+        raise UpdateError(f"Cannot apply {operator} to a non-array field '{path}'")
+    return current
+
+
+def _each(value):
+    if isinstance(value, dict) and "$each" in value:
+        return list(value["$each"])
+    return [value]
+
+
+def _apply_push(document, path, value):
+    current = _array_at(document, path, "$push")
+    items = _each(value)
+    position = value.get("$position") if isinstance(value, dict) else None
+    if position is None:
+        current.extend(items)
+    else:
+        current[position:position] = items
+    if isinstance(value, dict) and "$slice" in value:
+        limit = value["$slice"]
+        current[:] = current[:limit] if limit >= 0 else current[limit:]
+
+
+def _apply_add_to_set(document, path, value):
+    current = _array_at(document, path, "$addToSet")
+    for item in _each(value):
+        if item not in current:
+            current.append(item)
+
+
+def _apply_pull(document, path, value, matcher=None):
+    current = get_field(document, path, None)
+    if isinstance(current, list):
+        matches = _pull_condition(value, matcher)
+        current[:] = [item for item in current if not matches(item)]
+
+
+def _apply_pull_all(document, path, value):
+    current = get_field(document, path, None)
+    if isinstance(current, list):
+        current[:] = [item for item in current if item not in value]
+
+
+def _apply_pop(document, path, value):
+    current = get_field(document, path, None)
+    if isinstance(current, list) and current:
+        current.pop(0 if value == -1 else -1)
+
+
+def _apply_current_date(document, path, value):
+    # timestamps are not supported by the storage, both types store a date
+    set_field(document, path, datetime.datetime.now(datetime.timezone.utc))
+
+
+def _pull_condition(condition, matcher):
+    """
+    Predicate of the array elements removed by `$pull`: equal to a value, matching the
+    operators of a condition like {"$gt": 4}, or sub-documents matching a query.
+    :param matcher: function(query) -> predicate of the documents matching a query, the one of find
+    """
+    if not isinstance(condition, dict) or not condition:
+        return lambda item: item == condition
+    if matcher is None:
+        raise UpdateError("$pull with a condition needs the query matcher of the collection")
+    if all(key.startswith("$") for key in condition):
+        # operators apply to the element itself, it is wrapped in a document to be queried
+        predicate = matcher({"value": condition})
+        wrap = True
+    else:
+        predicate = matcher(condition)
+        wrap = False
+    if predicate is None:
+        raise UpdateError(f"Cannot apply $pull with the condition {condition}")
+
+    def matches(item):
+        if not wrap and not isinstance(item, dict):
+            return False
+        try:
+            return bool(predicate({"value": item} if wrap else item))
+        except (AttributeError, TypeError, KeyError):
+            # values which can't be compared with the condition do not match
+            return False
+    return matches
+
+
+UPDATE_OPERATORS = {
+    "$set": set_field,
+    "$unset": lambda document, path, value: unset_field(document, path),
+    "$inc": _apply_inc,
+    "$mul": _apply_mul,
+    "$min": _apply_min,
+    "$max": _apply_max,
+    "$rename": _apply_rename,
+    "$push": _apply_push,
+    "$addToSet": _apply_add_to_set,
+    "$pull": _apply_pull,
+    "$pullAll": _apply_pull_all,
+    "$pop": _apply_pop,
+    "$currentDate": _apply_current_date,
+}
+
+
+def apply_update(document, update, is_upsert=False, matcher=None):
+    """
+    Apply an update to a document.
+    :param document: the current document, it is not modified
+    :param update: operator update like {"$set": {...}} or a replacement document
+    :param is_upsert: the document is being inserted by an upsert, `$setOnInsert` applies
+    :param matcher: function(query) -> predicate of the documents matching a query, used by
+        `$pull` with a condition
+    :return: the updated document
+    """
+    if not is_operator_update(update):
+        # replacement document, `_id` is kept
+        replaced = copy.deepcopy(update)
+        if "_id" in document:
+            if "_id" in replaced and replaced["_id"] != document["_id"]:
+                raise UpdateError("The _id field cannot be changed")
+            replaced = {"_id": document["_id"], **replaced}
+        return replaced
+
+    updated = copy.deepcopy(document)
+    for operator, fields in update.items():
+        if operator == "$setOnInsert":
+            if is_upsert:
+                for path, value in fields.items():
+                    set_field(updated, path, copy.deepcopy(value))
+            continue
+        if operator not in UPDATE_OPERATORS:
+            raise UpdateError(f"Unknown modifier: {operator}")
+        for path, value in fields.items():
+            if path == "_id" or path.startswith("_id."):
+                if operator != "$set" or value != document.get("_id"):
+                    raise UpdateError("Performing an update on the path '_id' would modify the immutable field '_id'")
+            if operator == "$pull":
+                _apply_pull(updated, path, value, matcher)
+                continue
+            UPDATE_OPERATORS[operator](updated, path, copy.deepcopy(value))
+    return updated
+
+
+def upsert_document(query, update):
+    """
+    Build the document inserted by an upsert which did not match anything:
+    the equality conditions of the query, then the update.
+    """
+    base = {}
+    for key, value in query.items():
+        if key.startswith("$"):
+            continue
+        if isinstance(value, dict) and value and all(k.startswith("$") for k in value):
+            if "$eq" in value:
+                set_field(base, key, copy.deepcopy(value["$eq"]))
+            continue
+        set_field(base, key, copy.deepcopy(value))
+    if not is_operator_update(update):
+        return {**({"_id": base["_id"]} if "_id" in base else {}), **copy.deepcopy(update)}
+    return apply_update(base, update, is_upsert=True)
@@ -0,0 +1,209 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+import bson
+from bson import json_util
+
+from backend.tinymongodb.memory import MemoryDatabase, MemoryStorage
+from utils.logger import server_logger
+
+# a record is its length and the crc32 of its BSON body, then the body
+_RECORD_HEADER = struct.Struct("<iI")
+# the log is folded into the snapshot when it grows over this size
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+# seconds between two checkpoints of a database which was written
+CHECKPOINT_INTERVAL = 60.0
+
+
+class WALDatabase(MemoryDatabase):
+    """
+    Tables of one database kept in memory, every change is appended to a write-ahead log
+    and acknowledged once it is on disk. The writers waiting for the disk at the same time
+    share a single fsync (group commit).
+
+    Checkpoints write the tables to a snapshot in the format of the JSON engine and
+    truncate the log. The records hold whole documents, so replaying a record which is
+    already in the snapshot is harmless.
+    """
+
+    _databases = {}
+    _databases_lock = threading.Lock()
+    _checkpointer = None
+
+    @classmethod
+    def open(cls, path):
+        """
+        The database of a snapshot path, loaded once per process.
+        """
+        database = super().open(path)
+        with cls._databases_lock:
+            if cls._checkpointer is None:
+                cls._checkpointer = _Checkpointer(cls._databases, CHECKPOINT_INTERVAL)
+                cls._checkpointer.start()
+        return database
+
+    def __init__(self, path, checkpoint_bytes=CHECKPOINT_BYTES):
+        super().__init__(path)
+        self.wal_path = os.path.splitext(path)[0] + ".wal"
+        self.checkpoint_bytes = checkpoint_bytes
+        # a single writer of the log file
+        self._flush_lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        # records not yet written, guarded by the lock of the tables
+        self._pending = []
+        self._appended = 0
+        self._flushed = 0
+        # number of acknowledged changes and of fsyncs, the ratio shows the grouping
+        self.commits = 0
+        self.fsyncs = 0
+        self._recover()
+        self._wal = open(self.wal_path, "ab")
+        self.wal_size = self._wal.tell()
+
+    def _recover(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, encoding="utf-8") as handle:
+                self.tables = json.load(handle, object_hook=json_util.object_hook)
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, "rb") as handle:
+                data = handle.read()
+            offset = 0
+            while offset + _RECORD_HEADER.size <= len(data):
+                length, checksum = _RECORD_HEADER.unpack_from(data, offset)
+                body = data[offset + _RECORD_HEADER.size:offset + _RECORD_HEADER.size + length]
+                if len(body) < length or zlib.crc32(body) != checksum:
+                    break
+                self._apply(bson.decode(body))
+                offset += _RECORD_HEADER.size + length
+            if offset < len(data):
+                # the last record was torn by a crash, it was never acknowledged
+                server_logger.warning(f"Truncating {len(data) - offset} bytes at the end of {self.wal_path}")
+                with open(self.wal_path, "r+b") as handle:
+                    handle.truncate(offset)
+        for name, table in self.tables.items():
+            self._last_ids[name] = max(map(int, table), default=0)
+
+    def _log(self, record):
+        # apply a change and return once its record is on disk
+        body = bson.encode(record)
+        entry = _RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+        with self._lock:
+            self._apply(record)
+            self._pending.append(entry)
+            self._appended += 1
+            sequence = self._appended
+        with self._flush_lock:
+            # the record may have been written with the records of another writer
+            if self._flushed < sequence:
+                self._write_pending()
+            self.commits += 1
+        if self.wal_size >= self.checkpoint_bytes:
+            self._checkpointer.wakeup.set()
+
+    def _write_pending(self):
+        # called with the flush lock, writes all the pending records with one fsync
+        with self._lock:
+            entries, self._pending = self._pending, []
+            last = self._appended
+        if entries:
+            data = b"".join(entries)
+            self._wal.write(data)
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+            self.wal_size += len(data)
+            self.fsyncs += 1
+        self._flushed = last
+
+    def checkpoint(self):
+        """
+        Write the tables to the snapshot and keep only the records written meanwhile in the log.
+        """
+        with self._checkpoint_lock:
+            with self._flush_lock:
+                self._write_pending()
+                with self._lock:
+                    # the documents are replaced, never changed in place, copying the tables is enough
+                    tables = {name: dict(table) for name, table in self.tables.items()}
+                offset = self.wal_size
+            if not offset:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as handle:
+                json.dump(tables, handle, default=json_util.default)
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(temp_path, self.path)
+            with self._flush_lock:
+                self._write_pending()
+                self._wal.close()
+                with open(self.wal_path, "rb") as handle:
+                    handle.seek(offset)
+                    tail = handle.read()
+                temp_path = self.wal_path + ".tmp"
+                with open(temp_path, "wb") as handle:
+                    handle.write(tail)
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                os.replace(temp_path, self.wal_path)
+                self._wal = open(self.wal_path, "ab")
+                self.wal_size = len(tail)
+
+
+class _Checkpointer(threading.Thread):
+    # checkpoints the databases every `interval` seconds, or earlier when a log grows too much
+
+    def __init__(self, databases, interval):
+        super().__init__(name="tinymongo-checkpoint", daemon=True)
+        self.databases = databases
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            for database in list(self.databases.values()):
+                try:
+                    database.checkpoint()
+                except OSError as e:
+                    server_logger.error(f"Checkpoint of {database.path} failed: {e}")
+
+
+class WALStorage(MemoryStorage):
+    """
+    TinyDB storage of the write-ahead log engine, selected with `--storage wal`.
+    """
+
+    persistent = True
+    database_class = WALDatabase
+
+    @classmethod
+    def database_table_names(cls, path):
+        if cls.database_class.opened(path) is None and not os.path.exists(path) \
+                and not os.path.exists(os.path.splitext(path)[0] + ".wal"):
+            # never written, nothing is created
+            return []
+        return cls.database_class.open(path).table_names()
+
+    @classmethod
+    def stats(cls):
+        stats = super().stats()
+        databases = list(cls.database_class._databases.values())
+        # commits / fsyncs is the number of writes sharing a fsync
+        stats["commits"] = sum(database.commits for database in databases)
+        stats["fsyncs"] = sum(database.fsyncs for database in databases)
+        stats["logBytes"] = sum(database.wal_size for database in databases)
+        return stats
+
+    @staticmethod
+    def database_size(path):
+        size = 0
+        for file_path in (path, os.path.splitext(path)[0] + ".wal"):
+            try:
+                size += os.path.getsize(file_path)
+            except OSError:
+                pass
+        return size
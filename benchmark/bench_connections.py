@@ -0,0 +1,149 @@
+"""
+Connection scaling benchmark: compare the thread-per-connection engine with the
+asyncio engine at an increasing number of concurrent clients.
+
+Usage (from the repository root):
+    python -m benchmark.bench_connections --clients 10 100 1000 --requests 20
+"""
+import asyncio
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+from backend.op_code import OpCode
+from backend.parser import MSGParser
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(ROOT_DIR, "tinymongo_server.py")
+
+
+def _raise_fd_limit():
+    # every client needs one fd here and one in the server process
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def _ping_message(request_id):
+    body = MSGParser().do_encode({
+        "flagBits": 0,
+        "sections": [{"ping": 1, "$db": "admin"}]
+    })
+    header = struct.pack("<iiii", 16 + len(body), request_id, 0, OpCode.OP_MSG)
+    return header + body
+
+
+async def _run_client(port, n_requests, latencies, connect_timeout):
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection("127.0.0.1", port), timeout=connect_timeout
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        for request_id in range(n_requests):
+            start = time.perf_counter()
+            writer.write(_ping_message(request_id))
+            await writer.drain()
+            head = await reader.readexactly(16)
+            message_length = struct.unpack_from("<i", head)[0]
+            await reader.readexactly(message_length - 16)
+            latencies.append(time.perf_counter() - start)
+    except (OSError, asyncio.IncompleteReadError):
+        return False
+    finally:
+        writer.close()
+    return True
+
+
+async def _run_clients(port, n_clients, n_requests, connect_timeout):
+    latencies = []
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        _run_client(port, n_requests, latencies, connect_timeout) for _ in range(n_clients)
+    ])
+    elapsed = time.perf_counter() - start
+    return results, latencies, elapsed
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100.0))
+    return sorted_values[idx]
+
+
+def bench_engine(engine, n_clients, n_requests, connect_timeout=5.0):
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # run the server in a scratch directory so that its database and logs are thrown away
+        server = subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, "--engine", engine, "--port", str(port)],
+            cwd=work_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not _wait_for_port(port):
+                raise RuntimeError(f"server with engine {engine} did not start")
+            results, latencies, elapsed = asyncio.run(
+                _run_clients(port, n_clients, n_requests, connect_timeout)
+            )
+        finally:
+            server.terminate()
+            server.wait()
+    latencies.sort()
+    return {
+        "engine": engine,
+        "clients": n_clients,
+        "ok_clients": sum(results),
+        "failed_clients": len(results) - sum(results),
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    arg_parser = ArgumentParser(description="TinyMongo connection scaling benchmark")
+    arg_parser.add_argument("--engines", nargs="+", default=["thread", "asyncio"])
+    arg_parser.add_argument("--clients", nargs="+", type=int, default=[10, 100, 1000])
+    arg_parser.add_argument("--requests", type=int, default=20, help="ping requests sent by every client")
+    args = arg_parser.parse_args()
+    _raise_fd_limit()
+
+    print(f"{'engine':<8} {'clients':>8} {'ok':>6} {'failed':>7} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for n_clients in args.clients:
+        for engine in args.engines:
+            r = bench_engine(engine, n_clients, args.requests)
+            print(f"{r['engine']:<8} {r['clients']:>8} {r['ok_clients']:>6} {r['failed_clients']:>7} "
+                  f"{r['throughput']:>10.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
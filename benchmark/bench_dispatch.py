@@ -0,0 +1,70 @@
+"""
+Command dispatch microbenchmark: time spent finding the handler of an OP_MSG command
+in the command registry, next to the time of the whole `handle_msg` call.
+
+Usage (from the repository root):
+    python -m benchmark.bench_dispatch --budget 0.5
+"""
+import os
+import struct
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+from backend.op_code import OpCode
+from backend.parser import MSGParser
+from backend.tinymongodb.handler import TinyMongoDBBackend
+
+# the value of the command is not used to find the handler
+COMMANDS = {
+    "ping": {"ping": 1, "$db": "admin"},
+    "ping (true)": {"ping": True, "$db": "admin"},
+    "hello": {"hello": 1.0, "$db": "admin"},
+    "buildInfo": {"buildInfo": 1, "$db": "admin"},
+    "dbStats": {"dbStats": 1, "$db": "bench"},
+    "count": {"count": "items", "$db": "bench"},
+    "find": {"find": "items", "filter": {"_id": 1}, "$db": "bench"},
+    "unknown": {"noSuchCommand": 1, "$db": "admin"},
+}
+
+
+def build_msg(command):
+    body = MSGParser().do_encode({"flagBits": 0, "sections": [command]})
+    return struct.pack("<iiii", 16 + len(body), 1, 0, OpCode.OP_MSG) + body
+
+
+def timed(func, arg, budget):
+    # estimate a repeat count that fits into the time budget
+    start = time.perf_counter()
+    func(arg)
+    once = max(time.perf_counter() - start, 1e-7)
+    repeat = max(1, int(budget / once))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    arg_parser = ArgumentParser(description="TinyMongo command dispatch microbenchmark")
+    arg_parser.add_argument("--budget", type=float, default=0.5, help="seconds spent timing every case")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # the table files are created in the working directory
+        os.chdir(work_dir)
+        backend = TinyMongoDBBackend(hostname="localhost", port=27017)
+        backend.handle_msg(build_msg({"insert": "items", "documents": [{"_id": i} for i in range(100)],
+                                      "$db": "bench"}))
+        print(f"{'command':<14} {'lookup ns':>10} {'handle_msg us':>14} {'dispatch share':>15}")
+        for name, command in COMMANDS.items():
+            data = build_msg(command)
+            lookup = timed(lambda document: backend.commands.get(next(iter(document))), command, args.budget)
+            total = timed(backend.handle_msg, data, args.budget)
+            print(f"{name:<14} {lookup * 1e9:>10.0f} {total * 1e6:>14.1f} {lookup / total:>14.2%}")
+        backend.cursor_manager.stop()
+
+
+if __name__ == "__main__":
+    main()
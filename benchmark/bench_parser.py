@@ -0,0 +1,102 @@
+"""
+Parser microbenchmark: time and memory allocated per decoded message for
+`MSGParser`, `QueryParser` and `InsertParser` at several message sizes.
+
+Usage (from the repository root):
+    python -m benchmark.bench_parser --sizes 1024 65536 16777216
+"""
+import struct
+import time
+import tracemalloc
+
+from argparse import ArgumentParser
+
+import bson
+
+from backend.op_code import OpCode
+from backend.parser import MSGParser, QueryParser, InsertParser
+
+# BSON overhead of a document holding a single string field, used to hit the target size
+_DOC_OVERHEAD = len(bson.encode({"payload": ""}))
+
+
+def _document(size):
+    return {"payload": "x" * max(0, size - _DOC_OVERHEAD)}
+
+
+def _with_header(op_code, body):
+    return struct.pack("<iiii", 16 + len(body), 1, 0, op_code) + body
+
+
+def build_msg(size):
+    # one kind 0 section carrying the whole payload
+    body = MSGParser().do_encode({
+        "flagBits": 0,
+        "sections": [{"insert": "bench", "$db": "test", "doc": _document(size - 64)}]
+    })
+    return _with_header(OpCode.OP_MSG, body)
+
+
+def build_query(size):
+    body = QueryParser().do_encode({
+        "flags": 0,
+        "fullCollectionName": "test.bench",
+        "numberToSkip": 0,
+        "numberToReturn": 0,
+        "query": _document(size - 64),
+    })
+    return _with_header(OpCode.OP_QUERY, body)
+
+
+def build_insert(size, doc_size=1024):
+    # many documents of `doc_size` bytes, as a bulk insert would send
+    documents = [bson.encode(_document(doc_size)) for _ in range(max(1, (size - 64) // doc_size))]
+    body = struct.pack("<i", 0) + b"test.bench\x00" + b"".join(documents)
+    return _with_header(OpCode.OP_INSERT, body)
+
+
+PARSERS = {
+    "MSGParser": (MSGParser(), build_msg),
+    "QueryParser": (QueryParser(), build_query),
+    "InsertParser": (InsertParser(), build_insert),
+}
+
+
+def bench(parser, data, repeat):
+    # timing pass without tracemalloc, which slows allocations down
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parser.do_decode(data)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    parser.do_decode(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak - before
+
+
+def main():
+    arg_parser = ArgumentParser(description="TinyMongo parser microbenchmark")
+    arg_parser.add_argument("--sizes", nargs="+", type=int, default=[1024, 64 * 1024, 16 * 1024 * 1024 - 1024])
+    arg_parser.add_argument("--budget", type=float, default=0.5, help="seconds spent timing every case")
+    args = arg_parser.parse_args()
+
+    print(f"{'parser':<13} {'size':>10} {'us/msg':>12} {'allocated':>12} {'alloc/size':>10}")
+    for name, (parser, build) in PARSERS.items():
+        for size in args.sizes:
+            data = build(size)
+            # estimate a repeat count that fits into the time budget
+            start = time.perf_counter()
+            parser.do_decode(data)
+            once = max(time.perf_counter() - start, 1e-7)
+            repeat = max(1, int(args.budget / once))
+            elapsed, allocated = bench(parser, data, repeat)
+            print(f"{name:<13} {len(data):>10} {elapsed * 1e6:>12.1f} {allocated:>12} "
+                  f"{allocated / len(data):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Storage engine benchmark: write throughput of the JSON, write-ahead log and in-memory
+engines on a collection which already holds 10K, 100K and 1M documents, with one
+writer and with concurrent writers sharing the fsyncs of the log, and the time of a
+query scanning the whole collection.
+
+Usage (from the repository root):
+    python -m benchmark.bench_storage --sizes 10000 100000 --engines json memory --budget 2
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from argparse import ArgumentParser
+
+from backend.tinymongodb.handler import TinyMongoDBBackend
+from backend.tinymongodb.storage import STORAGE_ENGINES
+from backend.tinymongodb.wal import WALDatabase
+
+NAMESPACE = "bench.items"
+
+
+def make_documents(size):
+    return [{"_id": i, "n": i % 100, "name": f"item {i}"} for i in range(size)]
+
+
+def write_snapshot(work_dir, documents):
+    # the existing documents are written as a table file, read by the JSON and WAL engines
+    os.makedirs(os.path.join(work_dir, "tinydb"), exist_ok=True)
+    with open(os.path.join(work_dir, "tinydb", "bench.json"), "w", encoding="utf-8") as handle:
+        json.dump({"_default": {}, "items": {str(i + 1): document for i, document in enumerate(documents)}}, handle)
+
+
+def write_rate(backend, first_id, budget, writers):
+    """
+    Insert single documents from `writers` threads for `budget` seconds.
+    :return: inserts per second
+    """
+    deadline = time.perf_counter() + budget
+    counts = [0] * writers
+
+    def insert(writer):
+        _id = first_id + writer * 10_000_000
+        while time.perf_counter() < deadline or not counts[writer]:
+            backend._insert_documents(NAMESPACE, [{"_id": _id, "n": 0, "name": "new"}])
+            counts[writer] += 1
+            _id += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=insert, args=(writer,)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def scan_time(backend, budget):
+    # seconds of a query which is not answered by an index
+    repeat = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < budget or not repeat:
+        for _ in backend._find_documents(NAMESPACE, {"n": 7}):
+            pass
+        repeat += 1
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    arg_parser = ArgumentParser(description="TinyMongo storage engine benchmark")
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                            help="documents in the collection before the timed writes")
+    arg_parser.add_argument("--budget", type=float, default=3.0, help="seconds spent timing every case")
+    arg_parser.add_argument("--writers", type=int, default=8, help="concurrent writers of the second case")
+    arg_parser.add_argument("--engines", type=str, nargs="+", default=sorted(STORAGE_ENGINES),
+                            choices=sorted(STORAGE_ENGINES), help="storage engines to compare")
+    args = arg_parser.parse_args()
+
+    print(f"{'engine':<6} {'documents':>10} {'1 writer/s':>11} {f'{args.writers} writers/s':>12} "
+          f"{'scan ms':>8} {'fsyncs':>12}")
+    for size in args.sizes:
+        for engine in args.engines:
+            with tempfile.TemporaryDirectory() as work_dir:
+                # the table files are created in the working directory
+                os.chdir(work_dir)
+                documents = make_documents(size)
+                if STORAGE_ENGINES[engine].persistent:
+                    write_snapshot(work_dir, documents)
+                backend = TinyMongoDBBackend(hostname="localhost", port=27017, storage=engine)
+                if not STORAGE_ENGINES[engine].persistent:
+                    for start in range(0, size, 10_000):
+                        backend._insert_documents(NAMESPACE, documents[start:start + 10_000])
+                # load the snapshot and build the `_id` index before timing
+                backend._insert_documents(NAMESPACE, [{"_id": -1}])
+                # scanned before the writes, which add a different number of documents to each engine
+                scan = scan_time(backend, args.budget)
+                single = write_rate(backend, size, args.budget, 1)
+                concurrent = write_rate(backend, size + 1_000_000, args.budget, args.writers)
+                database = WALDatabase.opened(backend.backend.database_path("bench"))
+                fsyncs = f"{database.fsyncs}/{database.commits}" if database is not None else "-"
+                print(f"{engine:<6} {size:>10} {single:>11.1f} {concurrent:>12.1f} {scan * 1e3:>8.1f} {fsyncs:>12}")
+                backend.cursor_manager.stop()
+                os.chdir("/")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+YCSB-style workload benchmark: N connections of the wire-level test client send
+pipelined OP_MSG requests to a server and the throughput and the p50/p99/p999
+latencies are reported as JSON, so that two versions of the server can be compared
+on the same machine without an external driver.
+
+Workloads:
+- read-heavy: 95% reads of one document by `_id`, 5% updates (YCSB B)
+- update-heavy: 50% reads, 50% updates (YCSB A)
+- scan: 95% short `_id` range scans, 5% inserts (YCSB E)
+- insert-only: 100% inserts
+
+Usage (from the repository root):
+    python -m benchmark.bench_workload --workload read-heavy --connections 8 --pipeline 4 --duration 10
+    python -m benchmark.bench_workload --port 27019 --workload scan --output scan.json
+"""
+import itertools
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from argparse import ArgumentParser
+
+from backend.op_code import OpCode
+from backend.tinymongodb.storage import STORAGE_ENGINES
+from benchmark.bench_connections import SERVER_SCRIPT, _free_port, _percentile, _wait_for_port
+from test_code.fake_client import MongoDBClient
+
+DATABASE = "bench"
+COLLECTION = "usertable"
+# fraction of the operations of every type
+WORKLOADS = {
+    "read-heavy": {"read": 0.95, "update": 0.05},
+    "update-heavy": {"read": 0.5, "update": 0.5},
+    "scan": {"scan": 0.95, "insert": 0.05},
+    "insert-only": {"insert": 1.0},
+}
+# documents inserted per request during the load phase
+LOAD_BATCH_SIZE = 1000
+# YCSB's zipfian constant
+ZIPFIAN_CONSTANT = 0.99
+
+
+def make_document(key, fields, field_length):
+    return {"_id": key, **{f"field{i}": random.randbytes(field_length // 2).hex() for i in range(fields)}}
+
+
+class KeyChooser:
+    """
+    Keys of the reads, updates and scans, among the loaded records.
+    `zipfian` favours the small keys like YCSB's zipfian generator, `uniform` picks any.
+    """
+
+    def __init__(self, records, distribution="uniform"):
+        self.records = records
+        self._cum_weights = None
+        if distribution == "zipfian":
+            self._cum_weights = list(itertools.accumulate(1.0 / (rank ** ZIPFIAN_CONSTANT)
+                                                          for rank in range(1, records + 1)))
+
+    def next(self, rng):
+        if self._cum_weights is None:
+            return rng.randrange(self.records)
+        return rng.choices(range(self.records), cum_weights=self._cum_weights)[0]
+
+
+class Workload:
+    """
+    Commands of one workload, every connection thread draws its operations from here.
+    """
+
+    def __init__(self, name, records, fields=10, field_length=100, scan_length=100, distribution="uniform"):
+        self.name = name
+        self.fields = fields
+        self.field_length = field_length
+        self.scan_length = scan_length
+        self.keys = KeyChooser(records, distribution)
+        # keys of the inserted documents follow the loaded ones, `next` on a count is atomic
+        self._insert_keys = itertools.count(records)
+        self._operations = list(WORKLOADS[name])
+        self._weights = list(WORKLOADS[name].values())
+
+    def next_command(self, rng):
+        """
+        :return: the operation type and its command document
+        """
+        operation = rng.choices(self._operations, weights=self._weights)[0]
+        if operation == "read":
+            command = {"find": COLLECTION, "filter": {"_id": self.keys.next(rng)}, "limit": 1, "singleBatch": True}
+        elif operation == "update":
+            field = f"field{rng.randrange(self.fields)}"
+            command = {"update": COLLECTION, "updates": [{
+                "q": {"_id": self.keys.next(rng)},
+                "u": {"$set": {field: random.randbytes(self.field_length // 2).hex()}},
+            }]}
+        elif operation == "scan":
+            command = {"find": COLLECTION, "filter": {"_id": {"$gte": self.keys.next(rng)}}, "sort": {"_id": 1},
+                       "limit": rng.randint(1, self.scan_length), "singleBatch": True}
+        else:
+            command = {"insert": COLLECTION,
+                       "documents": [make_document(next(self._insert_keys), self.fields, self.field_length)]}
+        command["$db"] = DATABASE
+        return operation, command
+
+
+def load(client, records, fields, field_length):
+    # the documents of the previous workload are removed, the server may have been used before
+    client.run_command({"delete": COLLECTION, "deletes": [{"q": {}, "limit": 0}], "$db": DATABASE})
+    for start in range(0, records, LOAD_BATCH_SIZE):
+        documents = [make_document(key, fields, field_length)
+                     for key in range(start, min(start + LOAD_BATCH_SIZE, records))]
+        reply = client.run_command({"insert": COLLECTION, "documents": documents, "$db": DATABASE})
+        if reply.get("ok") != 1.0 or reply.get("writeErrors"):
+            raise RuntimeError(f"load failed: {reply}")
+
+
+def run_connection(host, port, workload, pipeline, deadline, seed, results):
+    """
+    Keep `pipeline` requests in flight on one connection until the deadline.
+    :param results: list receiving (operation, seconds, ok) of every reply
+    """
+    rng = random.Random(seed)
+    client = MongoDBClient(host=host, port=port, verbose=False)
+    # request_id -> (operation, send time)
+    in_flight = {}
+    recorded = []
+    try:
+        while True:
+            while len(in_flight) < pipeline and time.perf_counter() < deadline:
+                operation, command = workload.next_command(rng)
+                message = client.msg_handler.do_encode({"flagBits": 0, "sections": [command]})
+                in_flight[client.send_message(OpCode.OP_MSG, message)] = (operation, time.perf_counter())
+            if not in_flight:
+                break
+            header, response_raw = client.recv_message()
+            operation, sent = in_flight.pop(header["response_to"])
+            elapsed = time.perf_counter() - sent
+            reply = client.msg_handler.do_decode(response_raw)["sections"][0]
+            recorded.append((operation, elapsed, reply.get("ok") == 1.0 and not reply.get("writeErrors")))
+    finally:
+        client.close()
+        results.extend(recorded)
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "p999_ms": _percentile(latencies, 99.9) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def run_workload(host, port, workload, connections, pipeline, duration, seed=0):
+    results = []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_connection,
+                                args=(host, port, workload, pipeline, deadline, seed + idx, results))
+               for idx in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    by_operation = {}
+    for operation, latency, _ in results:
+        by_operation.setdefault(operation, []).append(latency)
+    return {
+        "workload": workload.name,
+        "connections": connections,
+        "pipeline": pipeline,
+        "seconds": elapsed,
+        "operations": len(results),
+        "errors": sum(1 for _, _, ok in results if not ok),
+        "throughput": len(results) / elapsed if elapsed else 0.0,
+        "latency": latency_summary([latency for _, latency, _ in results]),
+        "by_operation": {operation: latency_summary(latencies) for operation, latencies in sorted(by_operation.items())},
+    }
+
+
+def main():
+    arg_parser = ArgumentParser(description="TinyMongo YCSB-style workload benchmark")
+    arg_parser.add_argument("--workload", type=str, nargs="+", default=["read-heavy"], choices=sorted(WORKLOADS))
+    arg_parser.add_argument("--host", type=str, default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=None,
+                            help="port of a running server, by default a server is started in a scratch directory")
+    arg_parser.add_argument("--storage", type=str, default="json", choices=sorted(STORAGE_ENGINES),
+                            help="storage engine of the started server")
+    arg_parser.add_argument("--server-args", type=str, nargs="*", default=[],
+                            help="other arguments of the started server, like --engine=asyncio")
+    arg_parser.add_argument("--connections", type=int, default=8)
+    arg_parser.add_argument("--pipeline", type=int, default=1, help="requests in flight on every connection")
+    arg_parser.add_argument("--duration", type=float, default=10.0, help="seconds every workload runs")
+    arg_parser.add_argument("--records", type=int, default=10_000, help="documents loaded before every workload")
+    arg_parser.add_argument("--fields", type=int, default=10)
+    arg_parser.add_argument("--field-length", type=int, default=100, help="characters of every field")
+    arg_parser.add_argument("--scan-length", type=int, default=100, help="maximum documents of a scan")
+    arg_parser.add_argument("--distribution", type=str, default="uniform", choices=["uniform", "zipfian"])
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--output", type=str, default=None, help="file receiving the JSON results")
+    args = arg_parser.parse_args()
+
+    server = None
+    work_dir = None
+    port = args.port
+    if port is None:
+        port = _free_port()
+        work_dir = tempfile.TemporaryDirectory()
+        # run the server in a scratch directory so that its database and logs are thrown away
+        server = subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, "--port", str(port), "--storage", args.storage, *args.server_args],
+            cwd=work_dir.name,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if not _wait_for_port(port):
+            server.terminate()
+            raise RuntimeError("the server did not start")
+    try:
+        random.seed(args.seed)
+        results = []
+        for name in args.workload:
+            workload = Workload(name, args.records, fields=args.fields, field_length=args.field_length,
+                                scan_length=args.scan_length, distribution=args.distribution)
+            client = MongoDBClient(host=args.host, port=port, verbose=False)
+            try:
+                load(client, args.records, args.fields, args.field_length)
+            finally:
+                client.close()
+            result = run_workload(args.host, port, workload, args.connections, args.pipeline, args.duration,
+                                  seed=args.seed)
+            result.update(records=args.records, distribution=args.distribution,
+                          storage=args.storage if server is not None else None)
+            results.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            work_dir.cleanup()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import struct
+
+import bson
+import pytest
+
+from backend.op_code import OpCode
+from backend.parser import MSGParser
+from backend.tinymongodb.handler import TinyMongoDBBackend
+from tinymongo_server import TinyMongoServer
+
+
+def with_header(op_code, body, request_id=1):
+    return struct.pack("<iiii", 16 + len(body), request_id, 0, op_code) + body
+
+
+def msg_request(request_id, command, flag_bits=0, sequences=None):
+    """
+    :param sequences: dict of identifier -> documents sent as kind 1 sections
+    """
+    body = MSGParser().do_encode({"flagBits": flag_bits, "sections": [command]})
+    for identifier, documents in (sequences or {}).items():
+        sequence = identifier.encode("utf-8") + b"\x00" + b"".join(bson.encode(doc) for doc in documents)
+        body += b"\x01" + struct.pack("<i", 4 + len(sequence)) + sequence
+    return with_header(OpCode.OP_MSG, body, request_id)
+
+
+def reply_document(raw):
+    # OP_MSG reply: header, flag bits, then the kind 0 section
+    return bson.decode(raw[21:])
+
+
+def run(server, request_id, command):
+    reply = server._process_message(msg_request(request_id, command), server._new_connection(("127.0.0.1", 0)))
+    return reply_document(reply)
+
+
+def run_command(backend, command, sequences=None):
+    return backend.handle_msg(msg_request(1, command, sequences=sequences))["sections"][0]
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # the table files are created in the working directory
+    monkeypatch.chdir(tmp_path)
+    server = TinyMongoServer(port=0)
+    yield server
+    server.handler.cursor_manager.stop()
+    server.server_socket.close()
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    # the table files are created in the working directory
+    monkeypatch.chdir(tmp_path)
+    handler = TinyMongoDBBackend(hostname="localhost", port=27017)
+    yield handler
+    handler.cursor_manager.stop()
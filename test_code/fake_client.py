@@ -13,10 +13,12 @@ def read_binary_request(file_path):
     return data
 
 class MongoDBClient:
-    def __init__(self, host='127.0.0.1', port=27017):
+    def __init__(self, host='127.0.0.1', port=27017, verbose=True):
         self.client_socket = None
         self.host = host
         self.port = port
+        # print the connection events, the load generator opens many connections
+        self.verbose = verbose
         self.request_id = 0
         self.query_handler = QueryParser()
         self.head_handler = HeadParser()
@@ -27,11 +29,14 @@ class MongoDBClient:
     def connect(self):
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((self.host, self.port))
-        print(f"Connected to MongoDB server at {self.host}:{self.port}")
+        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.verbose:
+            print(f"Connected to MongoDB server at {self.host}:{self.port}")
 
     def close(self):
         self.client_socket.close()
-        print("Connection closed")
+        if self.verbose:
+            print("Connection closed")
 
     def send_message(self, op_code, message):
         # 构造消息头
@@ -41,8 +46,33 @@ class MongoDBClient:
         header = struct.pack('<iiii', message_length, request_id, response_to, op_code)
 
         # 发送消息
-        self.client_socket.send(header + message)
+        self.client_socket.sendall(header + message)
         self.request_id += 1
+        return request_id
+
+    def recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.client_socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by the server")
+            data += chunk
+        return bytes(data)
+
+    def recv_message(self):
+        """
+        Read one whole reply, however many `recv` calls it takes.
+        :return: the decoded header and the raw message, header included
+        """
+        header_raw = self.recv_exactly(16)
+        header = self.head_handler.do_decode(header_raw)
+        return header, header_raw + self.recv_exactly(header["message_length"] - 16)
+
+    def run_command(self, command):
+        # send an OP_MSG command and wait for its reply document
+        self.send_message(OpCode.OP_MSG, self.msg_handler.do_encode({"flagBits": 0, "sections": [command]}))
+        _, response_raw = self.recv_message()
+        return self.msg_handler.do_decode(response_raw)["sections"][0]
 
     # def recv_header(self):
     #     header_raw = self.client_socket.recv(16)
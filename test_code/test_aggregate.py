@@ -0,0 +1,82 @@
+import pytest
+
+from backend.tinymongodb.aggregate import AggregationError, run_pipeline, split_pipeline
+from conftest import run
+
+
+def aggregate(documents, pipeline):
+    _, _, _, stages = split_pipeline(pipeline)
+    return list(run_pipeline(iter(documents), stages, None))
+
+
+SALES = [
+    {"_id": 1, "item": "a", "qty": 2, "price": 10, "tags": ["x", "y"]},
+    {"_id": 2, "item": "b", "qty": 1, "price": 20, "tags": []},
+    {"_id": 3, "item": "a", "qty": 5, "price": 10, "tags": ["x"]},
+    {"_id": 4, "item": "c", "qty": 3, "price": 5},
+]
+
+
+def test_group_accumulators():
+    result = aggregate(SALES, [
+        {"$group": {"_id": "$item", "total": {"$sum": {"$multiply": ["$qty", "$price"]}}, "n": {"$count": {}},
+                    "avg": {"$avg": "$qty"}, "low": {"$min": "$qty"}, "high": {"$max": "$qty"},
+                    "ids": {"$push": "$_id"}}},
+        {"$sort": {"total": -1}},
+    ])
+    assert result == [
+        {"_id": "a", "total": 70, "n": 2, "avg": 3.5, "low": 2, "high": 5, "ids": [1, 3]},
+        {"_id": "b", "total": 20, "n": 1, "avg": 1.0, "low": 1, "high": 1, "ids": [2]},
+        {"_id": "c", "total": 15, "n": 1, "avg": 3.0, "low": 3, "high": 3, "ids": [4]},
+    ]
+
+
+def test_project_unwind_count():
+    result = aggregate(SALES, [
+        {"$unwind": "$tags"},
+        {"$project": {"_id": 0, "item": 1, "tag": {"$toUpper": "$tags"}}},
+        {"$addFields": {"label": {"$concat": ["$item", "-", "$tag"]}}},
+    ])
+    assert result == [{"item": "a", "tag": "X", "label": "a-X"}, {"item": "a", "tag": "Y", "label": "a-Y"},
+                      {"item": "a", "tag": "X", "label": "a-X"}]
+    assert aggregate(SALES, [{"$unwind": {"path": "$tags", "preserveNullAndEmptyArrays": True}},
+                             {"$count": "n"}]) == [{"n": 5}]
+    # the source documents are not modified
+    assert SALES[0]["tags"] == ["x", "y"]
+
+
+def test_sort_limit_keeps_top():
+    documents = [{"_id": i, "v": (i * 37) % 101} for i in range(101)]
+    result = aggregate(documents, [{"$sort": {"v": -1}}, {"$limit": 3}, {"$skip": 1}])
+    assert [document["v"] for document in result] == [99, 98]
+
+
+def test_split_pipeline():
+    query, sort, limit, stages = split_pipeline([{"$match": {"a": 1}}, {"$match": {"b": 2}}, {"$sort": {"a": 1}},
+                                                 {"$limit": 5}])
+    assert (query, sort, limit) == ({"a": 1, "b": 2}, {"a": 1}, 5)
+    assert stages == [("$sort", {"a": 1}), ("$limit", 5)]
+    with pytest.raises(AggregationError):
+        aggregate(SALES, [{"$out": "other"}])
+
+
+def test_aggregate_command(server):
+    run(server, 1, {"insert": "sales", "documents": [dict(document) for document in SALES], "$db": "test"})
+    run(server, 2, {"createIndexes": "sales", "indexes": [{"key": {"qty": 1}, "name": "qty_1"}], "$db": "test"})
+    reply = run(server, 3, {"aggregate": "sales", "pipeline": [
+        {"$match": {"qty": {"$gte": 2}}},
+        {"$sort": {"qty": 1}},
+        {"$project": {"qty": 1}},
+    ], "cursor": {"batchSize": 2}, "$db": "test"})
+    assert reply["cursor"]["firstBatch"] == [{"_id": 1, "qty": 2}, {"_id": 4, "qty": 3}]
+    cursor_id = reply["cursor"]["id"]
+    assert cursor_id
+    reply = run(server, 4, {"getMore": cursor_id, "collection": "sales", "$db": "test"})
+    assert reply["cursor"]["nextBatch"] == [{"_id": 3, "qty": 5}]
+    assert reply["cursor"]["id"] == 0
+
+    reply = run(server, 5, {"aggregate": "sales", "pipeline": [{"$group": {"_id": None, "n": {"$sum": 1}}}],
+                            "cursor": {}, "$db": "test"})
+    assert reply["cursor"]["firstBatch"] == [{"_id": None, "n": 4}]
+    reply = run(server, 6, {"aggregate": "sales", "pipeline": [{"$bogus": {}}], "cursor": {}, "$db": "test"})
+    assert reply["ok"] == 0.0 and reply["code"] == 40324
@@ -0,0 +1,115 @@
+import struct
+import time
+
+import bson
+import pytest
+
+from backend.tinymongodb.cursor import CursorManager, CursorNotFound
+from conftest import msg_request
+
+
+@pytest.fixture
+def cursor_manager():
+    manager = CursorManager(timeout=60, reap_interval=0)
+    yield manager
+    manager.stop()
+
+
+def test_cursor_batches(cursor_manager):
+    batch, cursor_id = cursor_manager.create("db.coll", ({"n": i} for i in range(250)), batch_size=101)
+    assert [doc["n"] for doc in batch] == list(range(101))
+    assert cursor_id != 0
+
+    batch, cursor_id, starting_from = cursor_manager.get_more(cursor_id, 100, namespace="db.coll")
+    assert starting_from == 101
+    assert len(batch) == 100
+
+    batch, cursor_id, starting_from = cursor_manager.get_more(cursor_id, 100, namespace="db.coll")
+    assert starting_from == 201
+    assert len(batch) == 49
+    assert cursor_id == 0
+    assert len(cursor_manager) == 0
+
+
+def test_single_batch_and_limit(cursor_manager):
+    batch, cursor_id = cursor_manager.create("db.coll", range(10), batch_size=3, single_batch=True)
+    assert batch == [0, 1, 2]
+    assert cursor_id == 0
+
+    batch, cursor_id = cursor_manager.create("db.coll", range(10), batch_size=3, limit=5)
+    assert batch == [0, 1, 2]
+    batch, cursor_id, _ = cursor_manager.get_more(cursor_id, 3)
+    assert batch == [3, 4]
+    assert cursor_id == 0
+
+
+def test_cursor_is_lazy(cursor_manager):
+    consumed = []
+
+    def documents():
+        for i in range(1000):
+            consumed.append(i)
+            yield i
+
+    batch, cursor_id = cursor_manager.create("db.coll", documents(), batch_size=10)
+    assert len(consumed) == 10
+
+
+def test_kill_and_wrong_namespace(cursor_manager):
+    _, cursor_id = cursor_manager.create("db.coll", range(10), batch_size=2)
+    with pytest.raises(CursorNotFound):
+        cursor_manager.get_more(cursor_id, 2, namespace="db.other")
+    killed, not_found = cursor_manager.kill([cursor_id, 12345])
+    assert killed == [cursor_id]
+    assert not_found == [12345]
+    with pytest.raises(CursorNotFound):
+        cursor_manager.get_more(cursor_id, 2)
+
+
+def test_idle_cursor_timeout():
+    manager = CursorManager(timeout=0.05, reap_interval=0.01)
+    _, cursor_id = manager.create("db.coll", range(10), batch_size=2)
+    time.sleep(0.2)
+    with pytest.raises(CursorNotFound):
+        manager.get_more(cursor_id, 2)
+    manager.stop()
+
+
+def test_exhaust_cursor(server):
+    connection = server._new_connection(("127.0.0.1", 0))
+    server._process_message(msg_request(1, {"insert": "items", "documents": [{"_id": i} for i in range(25)],
+                                            "$db": "test"}), connection)
+    reply = server._process_message(msg_request(2, {"find": "items", "batchSize": 5, "$db": "test"}), connection)
+    cursor_id = bson.decode(reply[21:])["cursor"]["id"]
+    get_more = {"getMore": cursor_id, "collection": "items", "batchSize": 10, "$db": "test"}
+    # bit 16: exhaustAllowed
+    reply = server._process_message(msg_request(3, get_more, flag_bits=1 << 16), connection)
+    batches = []
+    response_to = 3
+    while True:
+        length, reply_id, reply_to, _, flag_bits = struct.unpack_from("<iiiiI", reply)
+        assert reply_to == response_to
+        batches.append([document["_id"] for document in bson.decode(reply[21:])["cursor"]["nextBatch"]])
+        # bit 1: moreToCome, the server sends the next batch without a request
+        if not flag_bits & 2:
+            assert connection.exhaust_request is None
+            break
+        response_to = reply_id
+        reply = server._process_message(connection.exhaust_request, connection, streamed=True)
+    # the lazy cursor may only find out that it is exhausted with an empty last batch
+    assert batches[:2] == [list(range(5, 15)), list(range(15, 25))]
+    assert sum(batches, []) == list(range(5, 25))
+    assert len(server.handler.cursor_manager) == 0
+
+
+def test_exhaust_cursor_closed_by_client(server):
+    connection = server._new_connection(("127.0.0.1", 0))
+    server._process_message(msg_request(1, {"insert": "items", "documents": [{"_id": i} for i in range(25)],
+                                            "$db": "test"}), connection)
+    reply = server._process_message(msg_request(2, {"find": "items", "batchSize": 5, "$db": "test"}), connection)
+    cursor_id = bson.decode(reply[21:])["cursor"]["id"]
+    get_more = {"getMore": cursor_id, "collection": "items", "batchSize": 5, "$db": "test"}
+    server._process_message(msg_request(3, get_more, flag_bits=1 << 16), connection)
+    assert connection.exhaust_request is not None
+    server._close_exhaust(connection)
+    assert len(server.handler.cursor_manager) == 0
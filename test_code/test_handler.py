@@ -0,0 +1,166 @@
+import bson
+
+from backend.tinymongodb.commands import command_registry
+from backend.tinymongodb.handler import TinyMongoDBBackend
+from conftest import run_command
+
+
+def test_insert_document_sequence_and_find(backend):
+    documents = [{"_id": i, "n": i % 10} for i in range(300)]
+    reply = run_command(backend, {"insert": "items", "$db": "test"}, {"documents": documents})
+    assert reply == {"n": 300, "ok": 1.0}
+
+    reply = run_command(backend, {"find": "items", "filter": {"n": 3}, "sort": {"_id": -1},
+                                  "batchSize": 10, "$db": "test"})
+    cursor = reply["cursor"]
+    assert [doc["_id"] for doc in cursor["firstBatch"]] == list(range(293, 193, -10))
+    assert cursor["id"] != 0
+
+    reply = run_command(backend, {"getMore": cursor["id"], "collection": "items", "$db": "test"})
+    assert len(reply["cursor"]["nextBatch"]) == 20
+    assert reply["cursor"]["id"] == 0
+
+
+def test_insert_duplicate_key(backend):
+    run_command(backend, {"insert": "items", "documents": [{"_id": 1}], "$db": "test"})
+    reply = run_command(backend, {"insert": "items", "documents": [{"_id": 2}, {"_id": 1}, {"_id": 3}],
+                                  "ordered": False, "$db": "test"})
+    assert reply["n"] == 2
+    assert reply["writeErrors"][0]["index"] == 1
+    assert reply["writeErrors"][0]["code"] == 11000
+
+
+def test_update_and_delete(backend):
+    run_command(backend, {"insert": "items", "documents": [{"_id": i, "n": i} for i in range(10)], "$db": "test"})
+    reply = run_command(backend, {"update": "items", "$db": "test"}, {"updates": [
+        {"q": {"_id": 1}, "u": {"$inc": {"n": 10}, "$set": {"tag": "one"}}},
+        {"q": {"n": 5}, "u": {"$push": {"list": 1}}, "multi": True},
+        {"q": {"_id": 100}, "u": {"$set": {"n": 100}}, "upsert": True},
+    ]})
+    assert reply["n"] == 3
+    assert reply["nModified"] == 2
+    assert reply["upserted"] == [{"index": 2, "_id": 100}]
+
+    reply = run_command(backend, {"find": "items", "filter": {"_id": 1}, "$db": "test"})
+    assert reply["cursor"]["firstBatch"] == [{"_id": 1, "n": 11, "tag": "one"}]
+
+    reply = run_command(backend, {"delete": "items", "deletes": [{"q": {"_id": 100}, "limit": 1}], "$db": "test"})
+    assert reply == {"n": 1, "ok": 1.0}
+    reply = run_command(backend, {"find": "items", "filter": {}, "$db": "test"})
+    assert len(reply["cursor"]["firstBatch"]) == 10
+
+
+def test_indexes(backend):
+    run_command(backend, {"insert": "items", "documents": [{"_id": i, "n": i % 10} for i in range(30)], "$db": "test"})
+    reply = run_command(backend, {"createIndexes": "items", "indexes": [{"key": {"n": 1}, "name": "n_1"}],
+                                  "$db": "test"})
+    assert reply["numIndexesBefore"] == 1
+    assert reply["numIndexesAfter"] == 2
+
+    reply = run_command(backend, {"find": "items", "filter": {"n": 3}, "$db": "test"})
+    assert [doc["_id"] for doc in reply["cursor"]["firstBatch"]] == [3, 13, 23]
+    # the index follows the writes
+    run_command(backend, {"update": "items", "updates": [{"q": {"_id": 3}, "u": {"$set": {"n": 4}}}], "$db": "test"})
+    run_command(backend, {"delete": "items", "deletes": [{"q": {"_id": 13}, "limit": 1}], "$db": "test"})
+    reply = run_command(backend, {"find": "items", "filter": {"n": 3}, "$db": "test"})
+    assert [doc["_id"] for doc in reply["cursor"]["firstBatch"]] == [23]
+
+    # the indexes are rebuilt by a new backend
+    restarted = TinyMongoDBBackend(hostname="localhost", port=27017)
+    reply = run_command(restarted, {"listIndexes": "items", "$db": "test"})
+    assert [spec["name"] for spec in reply["cursor"]["firstBatch"]] == ["_id_", "n_1"]
+    reply = run_command(restarted, {"find": "items", "filter": {"n": 4}, "$db": "test"})
+    assert [doc["_id"] for doc in reply["cursor"]["firstBatch"]] == [3, 4, 14, 24]
+    restarted.cursor_manager.stop()
+
+    reply = run_command(backend, {"dropIndexes": "items", "index": "n_1", "$db": "test"})
+    assert reply == {"nIndexesWas": 2, "ok": 1.0}
+    reply = run_command(backend, {"dropIndexes": "items", "index": "_id_", "$db": "test"})
+    assert reply["ok"] == 0.0
+
+
+def test_explain_and_hint(backend):
+    run_command(backend, {"insert": "items", "documents": [{"_id": i, "n": i % 10} for i in range(50)], "$db": "test"})
+    run_command(backend, {"createIndexes": "items", "indexes": [{"key": {"n": 1}, "name": "n_1"}], "$db": "test"})
+
+    reply = run_command(backend, {"explain": {"find": "items", "filter": {"n": {"$gte": 8}}}, "$db": "test"})
+    assert reply["queryPlanner"]["winningPlan"]["inputStage"]["indexName"] == "n_1"
+    stats = reply["executionStats"]
+    assert (stats["nReturned"], stats["totalKeysExamined"], stats["totalDocsExamined"]) == (10, 10, 10)
+
+    reply = run_command(backend, {"explain": {"find": "items", "filter": {"n": 3}, "hint": {"$natural": 1}},
+                                  "$db": "test"})
+    assert reply["queryPlanner"]["winningPlan"]["stage"] == "COLLSCAN"
+    assert reply["executionStats"]["totalDocsExamined"] == 50
+
+    reply = run_command(backend, {"find": "items", "filter": {}, "hint": "missing", "$db": "test"})
+    assert reply["code"] == 2
+
+
+def test_top(backend):
+    run_command(backend, {"insert": "items", "documents": [{"_id": 1}, {"_id": 2}], "$db": "test"})
+    run_command(backend, {"find": "items", "filter": {}, "$db": "test"})
+    run_command(backend, {"find": "items", "filter": {"_id": 1}, "$db": "test"})
+    run_command(backend, {"ping": 1, "$db": "admin"})
+    totals = run_command(backend, {"top": 1, "$db": "admin"})["totals"]
+    assert totals["test.items"]["queries"]["count"] == 2
+    assert totals["test.items"]["insert"]["count"] == 1
+    assert totals["test.items"]["total"]["count"] == 3
+
+
+def test_stats_and_count(backend):
+    documents = [{"_id": i, "n": i % 10, "tag": "x" * i} for i in range(20)]
+    run_command(backend, {"insert": "items", "documents": documents, "$db": "test"})
+    run_command(backend, {"createIndexes": "items", "indexes": [{"key": {"n": 1}, "name": "n_1"}], "$db": "test"})
+    run_command(backend, {"delete": "items", "deletes": [{"q": {"_id": 0}, "limit": 1}], "$db": "test"})
+    run_command(backend, {"update": "items", "updates": [{"q": {"_id": 1}, "u": {"$set": {"tag": "long" * 10}}}],
+                          "$db": "test"})
+    documents = [{"_id": 1, "n": 1, "tag": "long" * 10}] + documents[2:]
+    data_size = sum(len(bson.encode(document)) for document in documents)
+
+    stats = run_command(backend, {"collStats": "items", "$db": "test"})
+    assert (stats["count"], stats["size"], stats["nindexes"]) == (19, data_size, 2)
+    assert stats["indexSizes"]["n_1"] > 0
+    assert stats["totalIndexSize"] == sum(stats["indexSizes"].values())
+
+    stats = run_command(backend, {"dbStats": 1, "$db": "test"})
+    assert (stats["db"], stats["collections"], stats["objects"], stats["dataSize"]) == ("test", 1, 19, data_size)
+    assert stats["storageSize"] > 0
+    assert run_command(backend, {"dbStats": 1, "scale": 0, "$db": "test"})["ok"] == 0.0
+
+    assert run_command(backend, {"count": "items", "$db": "test"})["n"] == 19
+    assert run_command(backend, {"count": "items", "query": {"n": 1}, "$db": "test"})["n"] == 2
+    assert run_command(backend, {"count": "items", "skip": 15, "limit": 10, "$db": "test"})["n"] == 4
+    assert run_command(backend, {"count": "missing", "$db": "test"})["n"] == 0
+    assert run_command(backend, {"collStats": "missing", "$db": "test"})["count"] == 0
+
+
+def test_command_registry(backend):
+    assert run_command(backend, {"ping": True, "$db": "admin"}) == {"ok": 1.0}
+    assert run_command(backend, {"ping": 1.0, "$db": "admin"}) == {"ok": 1.0}
+    assert run_command(backend, {"isMaster": True, "$db": "admin"})["ismaster"] is True
+    reply = run_command(backend, {"noSuchCommand": 1, "$db": "admin"})
+    assert (reply["code"], reply["errmsg"]) == (59, "no such command: 'noSuchCommand'")
+    assert run_command(backend, {"listDatabases": 1, "$db": "test"})["code"] == 13
+
+    @command_registry.command("echo", kind="read", cacheable=True)
+    def handle_echo(handler, payload):
+        return [{"echo": payload["sections"][0]["echo"], "ok": 1.0}]
+
+    try:
+        assert command_registry.get("echo").cacheable
+        assert run_command(backend, {"echo": "hi", "$db": "test"}) == {"echo": "hi", "ok": 1.0}
+    finally:
+        command_registry.unregister("echo")
+
+
+def test_failing_command_replies_with_error(backend):
+    @command_registry.command("broken", kind="read")
+    def handle_broken(handler, payload):
+        raise RuntimeError("boom")
+
+    try:
+        reply = run_command(backend, {"broken": "items", "$db": "test"})
+        assert reply == {"ok": 0.0, "errmsg": "boom", "code": 1, "codeName": "InternalError"}
+    finally:
+        command_registry.unregister("broken")
@@ -0,0 +1,84 @@
+import pytest
+
+from backend.tinymongodb.index import (
+    CollectionIndexes, DuplicateKeyError, HashIndex, IndexOptionsConflict, IndexSpecError, SortedIndex,
+    default_index_name, range_bounds
+)
+
+
+def test_hash_index_keys():
+    index = HashIndex("a_1", {"a": 1})
+    index.add(1, {"a": 1})
+    index.add(2, {"a": [1, 2]})
+    index.add(3, {"b": 1})
+    assert index.lookup([1]) == {1, 2}
+    assert index.lookup([2]) == {2}
+    # missing fields are indexed as null
+    assert index.lookup([None]) == {3}
+    index.remove(2)
+    assert index.lookup([1]) == {1}
+    assert index.lookup([2]) == set()
+
+
+def test_unique_index():
+    documents = {1: {"_id": 1, "a": 1}, 2: {"_id": 2, "a": 1}}
+    indexes = CollectionIndexes("test.items")
+    indexes.build(documents)
+    with pytest.raises(DuplicateKeyError):
+        indexes.create("a_1", {"a": 1}, documents, unique=True)
+    del documents[2]
+    assert indexes.create("a_1", {"a": 1}, documents, unique=True)
+    assert not indexes.create("a_1", {"a": 1}, documents, unique=True)
+    with pytest.raises(IndexOptionsConflict):
+        indexes.create("a_1", {"a": 1}, documents)
+
+    pending = {}
+    indexes.claim_unique_keys({"_id": 3, "a": 2}, pending)
+    with pytest.raises(DuplicateKeyError) as error:
+        indexes.claim_unique_keys({"_id": 4, "a": 2}, pending)
+    assert error.value.key_value == {"a": 2}
+    # a document does not conflict with itself
+    indexes.claim_unique_keys({"_id": 1, "a": 1, "b": 1}, {}, doc_id=1)
+
+
+def test_index_spec():
+    assert default_index_name({"a": 1, "b.c": -1}) == "a_1_b.c_-1"
+    with pytest.raises(IndexSpecError):
+        HashIndex("text", {"a": "text"})
+    with pytest.raises(IndexSpecError):
+        CollectionIndexes("test.items").drop("_id_")
+
+
+def test_sorted_index_scan():
+    documents = {i: {"_id": i, "t": (i * 7) % 10} for i in range(1, 11)}
+    documents[11] = {"_id": 11, "t": "text"}
+    for direction in (1, -1):
+        index = SortedIndex("t", {"t": direction})
+        for doc_id, document in documents.items():
+            index.add(doc_id, document)
+        # values in ascending order, the scans follow the order of the index
+        values = lambda doc_ids: [documents[doc_id]["t"] for doc_id in doc_ids][::direction]
+        assert values(index.scan(*range_bounds({"$gte": 3, "$lt": 6}))) == [3, 4, 5]
+        assert values(index.scan(*range_bounds({"$gt": 7}), reverse=True)) == [9, 8]
+        # the range only covers values of the same type
+        assert values(index.scan(*range_bounds({"$gt": "a"}))) == ["text"]
+        assert list(index.scan(*range_bounds({"$gt": 1, "$lt": "a"}))) == []
+        index.remove(3)
+        assert values(index.scan(*range_bounds({"$lte": 2}))) == [0, 2]
+
+
+
+def test_sorted_index_scan_resumes_after_writes():
+    for reverse in (False, True):
+        index = SortedIndex("a_1", {"a": 1})
+        for doc_id in range(1, 11):
+            index.add(doc_id, {"a": doc_id * 10})
+        scan = index.scan(*range_bounds({"$gte": 20, "$lte": 90}), reverse=reverse)
+        first = [next(scan), next(scan)]
+        # writes between two getMore batches: a key before the position, one after it, a removal
+        index.add(11, {"a": 85 if reverse else 15})
+        index.add(12, {"a": 55})
+        index.remove(6)
+        rest = list(scan)
+        expected = [9, 8, 7, 12, 5, 4, 3, 2] if reverse else [2, 3, 4, 5, 12, 7, 8, 9]
+        assert first + rest == expected
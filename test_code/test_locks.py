@@ -0,0 +1,97 @@
+import json
+import threading
+
+from backend.tinymongodb.locks import READ, WRITE, RWLock
+from conftest import run_command
+from tinymongo_server import IDGenerator
+
+
+def test_rw_lock():
+    lock = RWLock()
+    lock.acquire_read()
+    lock.acquire_read()
+    entered = threading.Event()
+
+    def write():
+        lock.acquire_write()
+        entered.set()
+        lock.release_write()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    assert not entered.wait(0.05)
+    lock.release_read()
+    lock.release_read()
+    writer.join()
+    assert entered.is_set()
+    assert lock.acquire_count == {READ: 2, WRITE: 1}
+    assert lock.wait_count[WRITE] == 1
+    # the writer may read what it is writing
+    lock.acquire_write()
+    lock.acquire_read()
+    lock.release_read()
+    lock.release_write()
+
+
+def test_id_generator_threads():
+    generator = IDGenerator()
+    ids = []
+
+    def take():
+        ids.extend(generator.get_one() for _ in range(10000))
+
+    threads = [threading.Thread(target=take) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(ids) == list(range(1, 80001))
+
+
+def test_concurrent_writes_and_reads(backend):
+    # writers of two collections stored in the same table file, and readers of one of them
+    errors = []
+    stop = threading.Event()
+
+    def write(collection, writer):
+        try:
+            for i in range(25):
+                reply = run_command(backend, {"insert": collection, "documents": [{"_id": f"{writer}-{i}", "n": i}],
+                                              "$db": "stress"})
+                assert reply["n"] == 1, reply
+                run_command(backend, {"update": collection, "updates": [
+                    {"q": {"_id": f"{writer}-{i}"}, "u": {"$inc": {"n": 1}}}], "$db": "stress"})
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            while not stop.is_set():
+                run_command(backend, {"find": "a", "filter": {"n": {"$gt": 3}}, "$db": "stress"})
+                run_command(backend, {"count": "a", "$db": "stress"})
+        except Exception as e:
+            errors.append(e)
+
+    writers = [threading.Thread(target=write, args=(collection, writer))
+               for collection in ("a", "b") for writer in range(4)]
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    for thread in writers + readers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+    assert not errors
+
+    with open("tinydb/stress.json", encoding="utf-8") as handle:
+        tables = json.load(handle)
+    for collection in ("a", "b"):
+        assert len(tables[collection]) == 100
+        assert sorted(doc["n"] for doc in tables[collection].values()) == sorted(list(range(1, 26)) * 4)
+
+    locks = run_command(backend, {"serverStatus": 1, "$db": "admin"})["locks"]["Collection"]
+    assert locks["acquireCount"][WRITE] == 400
+    assert locks["acquireCount"][READ] > 0
+    top = run_command(backend, {"top": 1, "$db": "admin"})["totals"]
+    assert set(top["stress.a"]["writeLockWait"]) == {"time", "count"}
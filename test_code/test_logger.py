@@ -0,0 +1,43 @@
+import logging
+
+from utils.logger import RequestLog, truncated
+
+
+class CountingRepr:
+
+    def __init__(self):
+        self.calls = 0
+
+    def __repr__(self):
+        self.calls += 1
+        return "counted"
+
+
+def test_truncated_payload():
+    payload = {"insert": "items", "documents": [{"_id": i, "text": "x" * 10000} for i in range(1000)]}
+    text = str(truncated(payload, max_length=200))
+    assert len(text) < 250
+    assert text.startswith("{'documents': [{'_id': 0")
+
+
+def test_request_log_levels(caplog):
+    logger = logging.getLogger("test_request_log")
+    request_log = RequestLog(logger, slow_ms=10)
+    value = CountingRepr()
+    logger.setLevel(logging.INFO)
+    # not formatted when the level is disabled
+    logger.debug("payload: %s", truncated(value))
+    assert value.calls == 0
+    assert not request_log.sampled()
+
+    logger.setLevel(logging.DEBUG)
+    assert request_log.sampled()
+    request_log.sample_rate = 0.0
+    assert not request_log.sampled()
+
+    with caplog.at_level(logging.INFO, logger="test_request_log"):
+        request_log.slow("find", {"find": "items"}, 5.0)
+        request_log.slow("find", {"find": "items"}, 12.0)
+    assert [record.getMessage() for record in caplog.records] == [
+        "Slow operation find: 12.0 ms, payload: {'find': 'items'}"
+    ]
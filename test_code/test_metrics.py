@@ -0,0 +1,46 @@
+import threading
+
+import bson
+
+from conftest import msg_request
+from utils.metrics import ServerMetrics, format_metrics
+
+
+def test_metrics_threads():
+    metrics = ServerMetrics()
+
+    def record():
+        for micros in (50, 300, 2000000):
+            metrics.record_request("query", "reads", micros, 100, 200)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    status = metrics.snapshot()
+    assert status["opcounters"]["query"] == 12
+    assert status["network"] == {"bytesIn": 1200, "bytesOut": 2400, "numRequests": 12}
+    assert status["opLatencies"]["reads"]["histogram"] == [
+        {"micros": 0, "count": 4}, {"micros": 250, "count": 4}, {"micros": 1000000, "count": 4}
+    ]
+    text = format_metrics(status)
+    assert 'tinymongo_opLatencies_reads_bucket{le="500"} 8' in text
+    assert 'tinymongo_opLatencies_reads_bucket{le="+Inf"} 12' in text
+
+
+def test_server_status(server):
+    connection = server._new_connection(("127.0.0.1", 0))
+    server._process_message(msg_request(1, {"insert": "items", "documents": [{"_id": 1}], "$db": "test"}),
+                            connection)
+    server._process_message(msg_request(2, {"find": "items", "filter": {}, "$db": "test"}), connection)
+    reply = server._process_message(msg_request(3, {"serverStatus": 1, "$db": "admin"}), connection)
+    status = bson.decode(reply[21:])
+    assert status["opcounters"]["insert"] == 1
+    assert status["opcounters"]["query"] == 1
+    assert status["opLatencies"]["writes"]["ops"] == 1
+    assert status["connections"]["current"] == 1
+    assert status["network"]["numRequests"] == 2
+    assert status["storageEngine"]["name"] == "json"
+    assert "json" in status and "responseCache" in status and "mem" in status
+    server._close_connection(connection)
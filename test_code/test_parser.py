@@ -0,0 +1,90 @@
+import struct
+import zlib
+
+import bson
+import pytest
+
+from backend.compression import negotiate_compressors
+from backend.op_code import OpCode, Compressor
+from backend.parser import (
+    MAX_MESSAGE_SIZE, HeadParser, MSGParser, InsertParser, QueryParser, CompressedParser, byte2string
+)
+from conftest import with_header
+
+
+def test_byte2string_utf8():
+    data = b"\x01\x02" + "数据库.collection".encode("utf-8") + b"\x00\x03"
+    offset, value = byte2string(data, 2)
+    assert value == "数据库.collection"
+    assert data[offset] == 3
+
+
+def test_head_parser_with_offset():
+    data = b"\x00" * 4 + struct.pack("<iiii", 100, 7, 3, OpCode.OP_MSG)
+    header = HeadParser().do_decode(memoryview(data), 4)
+    assert header == {"message_length": 100, "request_id": 7, "response_to": 3, "op_code": OpCode.OP_MSG}
+
+
+def test_msg_document_sequence_section():
+    documents = [{"_id": i, "value": "v" * i} for i in range(3)]
+    sequence = b"documents\x00" + b"".join(bson.encode(doc) for doc in documents)
+    body = (
+        struct.pack("<I", 0)
+        + b"\x00" + bson.encode({"insert": "coll", "$db": "test"})
+        + b"\x01" + struct.pack("<i", 4 + len(sequence)) + sequence
+    )
+    payload = MSGParser().do_decode(with_header(OpCode.OP_MSG, body))
+    assert payload["sections"][0] == {"insert": "coll", "$db": "test"}
+    assert payload["sections"][1] == {"documents": documents}
+
+
+def test_msg_encode_decode_roundtrip():
+    parser = MSGParser()
+    payload = {"flagBits": 0, "sections": [{"ping": 1, "$db": "admin"}]}
+    assert parser.do_decode(with_header(OpCode.OP_MSG, parser.do_encode(payload))) == payload
+
+
+def test_insert_and_query_parser():
+    documents = [{"a": 1}, {"b": "two"}]
+    body = struct.pack("<i", 0) + b"test.coll\x00" + b"".join(bson.encode(doc) for doc in documents)
+    payload = InsertParser().do_decode(with_header(OpCode.OP_INSERT, body))
+    assert payload["fullCollectionName"] == "test.coll"
+    assert payload["documents"] == documents
+
+    query_parser = QueryParser()
+    query = {"flags": 0, "fullCollectionName": "test.coll", "numberToSkip": 2,
+             "numberToReturn": 5, "query": {"a": {"$gt": 1}}}
+    payload = query_parser.do_decode(with_header(OpCode.OP_QUERY, query_parser.do_encode(query)))
+    assert payload["numberToSkip"] == 2
+    assert payload["query"] == {"a": {"$gt": 1}}
+    assert payload["returnFieldsSelector"] is None
+
+
+def test_compressed_roundtrip():
+    inner_body = MSGParser().do_encode({"flagBits": 0, "sections": [{"find": "coll", "filter": {"a": "x" * 2000}}]})
+    parser = CompressedParser()
+    body = parser.do_encode({"originalOpcode": OpCode.OP_MSG, "compressorId": Compressor.ZLIB, "message": inner_body})
+    assert len(body) < len(inner_body)
+    payload = parser.do_decode(with_header(OpCode.OP_COMPRESSED, body, request_id=42))
+    assert payload["originalOpcode"] == OpCode.OP_MSG
+    assert payload["compressorId"] == Compressor.ZLIB
+    assert HeadParser().do_decode(payload["message"])["request_id"] == 42
+    assert payload["message"][16:] == inner_body
+
+
+def test_compressed_size_is_bounded():
+    parser = CompressedParser()
+    bomb = zlib.compress(b"\0" * 10_000_000)
+    # the announced size is checked before anything is decompressed
+    body = struct.pack("<iiB", OpCode.OP_MSG, MAX_MESSAGE_SIZE, Compressor.ZLIB) + bomb
+    with pytest.raises(ValueError):
+        parser.do_decode(with_header(OpCode.OP_COMPRESSED, body))
+    # decompression stops at the announced size
+    body = struct.pack("<iiB", OpCode.OP_MSG, 1000, Compressor.ZLIB) + bomb
+    with pytest.raises(ValueError):
+        parser.do_decode(with_header(OpCode.OP_COMPRESSED, body))
+
+
+def test_negotiate_compressors():
+    assert negotiate_compressors(["snappy", "zlib", "noop"]) == ["zlib"]
+    assert negotiate_compressors(None) == []
@@ -0,0 +1,73 @@
+import pytest
+
+from backend.tinymongodb.index import CollectionIndexes
+from backend.tinymongodb.planner import ExecutionStats, PlanError, QueryPlanner, query_shape
+
+
+@pytest.fixture
+def indexes():
+    documents = {i: {"_id": i, "a": i % 3, "b": i % 2, "t": i % 5} for i in range(1, 13)}
+    collection_indexes = CollectionIndexes("test.items")
+    collection_indexes.build(documents)
+    collection_indexes.create("a_1_b_1", {"a": 1, "b": 1}, documents)
+    collection_indexes.create("t_1_b_-1", {"t": 1, "b": -1}, documents)
+    return collection_indexes
+
+
+def run_plan(plan):
+    stats = ExecutionStats()
+    return list(plan.doc_ids(stats)), stats
+
+
+def test_equality_plan(indexes):
+    planner = QueryPlanner()
+    plan = planner.plan(indexes, {"a": 1, "b": 0})
+    assert (plan.index_name, plan.kind) == ("a_1_b_1", "equality")
+    doc_ids, stats = run_plan(plan)
+    assert doc_ids == [4, 10]
+    assert stats.keys_examined == 2
+
+    plan = planner.plan(indexes, {"a": {"$in": [1, 2]}, "b": 0, "c": {"$gt": 1}})
+    assert run_plan(plan)[0] == [2, 4, 8, 10]
+    # the unique `_id` lookup examines a single key
+    assert planner.plan(indexes, {"_id": 5, "a": 1}).index_name == "_id_"
+    assert planner.plan(indexes, {"b": {"$gt": 0}}).index is None
+
+
+def test_range_and_sort_plans(indexes):
+    planner = QueryPlanner()
+    plan = planner.plan(indexes, {}, sort={"t": -1, "b": 1})
+    assert (plan.index_name, plan.kind, plan.ordered, plan.reverse) == ("t_1_b_-1", "full", True, True)
+    assert run_plan(plan)[0][:4] == [4, 9, 8, 3]
+
+    plan = planner.plan(indexes, {"t": {"$lt": 2}}, sort={"a": 1})
+    assert (plan.index_name, plan.kind, plan.ordered) == ("t_1_b_-1", "range", False)
+    assert sorted(run_plan(plan)[0]) == [1, 5, 6, 10, 11]
+
+    # a single value of the first field gives the order of the second one
+    plan = planner.plan(indexes, {"t": 1}, sort={"b": 1})
+    assert (plan.kind, plan.ordered, plan.reverse) == ("range", True, True)
+    doc_ids = run_plan(plan)[0]
+    assert doc_ids[0] == 6
+    assert sorted(doc_ids[1:]) == [1, 11]
+
+
+def test_hint_and_plan_cache(indexes):
+    planner = QueryPlanner()
+    assert planner.plan(indexes, {"a": 1}, hint={"$natural": 1}).index is None
+    plan = planner.plan(indexes, {"a": 1}, hint="t_1_b_-1")
+    assert (plan.index_name, plan.kind) == ("t_1_b_-1", "full")
+    with pytest.raises(PlanError):
+        planner.plan(indexes, {"a": 1}, hint="missing")
+
+    assert not planner.plan(indexes, {"t": {"$gte": 3}}).from_cache
+    plan = planner.plan(indexes, {"t": {"$gte": 1}})
+    assert plan.from_cache
+    assert sorted(run_plan(plan)[0]) == [1, 2, 3, 4, 6, 7, 8, 9, 11, 12]
+    planner.invalidate("test.items")
+    assert not planner.plan(indexes, {"t": {"$gte": 1}}).from_cache
+
+
+def test_query_shape():
+    assert query_shape({"a": 1, "b": {"$in": [1, 2]}}) == query_shape({"a": "x", "b": {"$in": [3]}})
+    assert query_shape({"a": 1}) != query_shape({"a": {"$gt": 1}})
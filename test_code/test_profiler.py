@@ -0,0 +1,50 @@
+from conftest import run
+
+
+def profile_entries(server):
+    server.handler.profiler.flush()
+    return run(server, 99, {"find": "system.profile", "filter": {}, "$db": "test"})["cursor"]["firstBatch"]
+
+
+def test_profile_levels(server):
+    assert run(server, 1, {"profile": -1, "$db": "test"}) == {"was": 0, "slowms": 100, "sampleRate": 1.0, "ok": 1.0}
+    run(server, 2, {"insert": "items", "documents": [{"_id": i, "a": i} for i in range(10)], "$db": "test"})
+    assert run(server, 3, {"profile": 2, "$db": "test"})["was"] == 0
+    run(server, 4, {"createIndexes": "items", "indexes": [{"key": {"a": 1}, "name": "a_1"}], "$db": "test"})
+    run(server, 5, {"find": "items", "filter": {"a": {"$gte": 7}}, "$db": "test"})
+    run(server, 6, {"find": "items", "filter": {"_id": {"$lt": 3}, "b": None}, "$db": "test"})
+    run(server, 7, {"delete": "items", "deletes": [{"q": {"a": 0}, "limit": 1}], "$db": "test"})
+    # not profiled, another database
+    run(server, 8, {"find": "items", "filter": {}, "$db": "other"})
+
+    entries = profile_entries(server)
+    assert [entry["op"] for entry in entries] == ["command", "query", "query", "remove"]
+    index_find = entries[1]
+    assert index_find["ns"] == "test.items"
+    assert index_find["planSummary"] == "IXSCAN { a: 1 }"
+    assert index_find["command"]["filter"] == {"a": {"$gte": 7}}
+    assert index_find["nreturned"] == 3
+    assert index_find["docsExamined"] == 3
+    assert index_find["responseLength"] > 0
+    assert entries[2]["planSummary"] in ("COLLSCAN", "IXSCAN { _id: 1 }")
+    assert entries[3]["ndeleted"] == 1
+
+    # level 1 only records the operations slower than slowms
+    run(server, 9, {"profile": 1, "slowms": 10000, "$db": "test"})
+    run(server, 10, {"find": "items", "filter": {}, "$db": "test"})
+    assert len(profile_entries(server)) == 4
+
+
+def test_profile_capped(server, monkeypatch):
+    monkeypatch.setattr("backend.tinymongodb.handler.PROFILE_MAX_DOCUMENTS", 5)
+    server.handler.profiler.set_level("test", 2)
+    for i in range(12):
+        run(server, i, {"find": "items", "filter": {"a": i}, "$db": "test"})
+    server.handler.profiler.flush()
+    server.handler.profiler.set_level("test", 0)
+    entries = profile_entries(server)
+    assert [entry["command"]["filter"]["a"] for entry in entries] == list(range(7, 12))
+
+
+def test_profile_invalid_level(server):
+    assert run(server, 1, {"profile": 3, "$db": "test"})["ok"] == 0.0
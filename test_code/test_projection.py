@@ -0,0 +1,50 @@
+import bson
+import pytest
+
+from backend.op_code import OpCode
+from backend.parser import QueryParser
+from backend.tinymongodb.projection import Projection, ProjectionError
+from conftest import run, with_header
+
+DOCUMENT = {"_id": 1, "a": {"b": 1, "c": "xx"}, "items": [{"x": 1, "y": 2}, 5, {"x": 3}], "blob": "z" * 100}
+
+
+@pytest.mark.parametrize("spec, expected", [
+    ({"a.b": 1}, {"_id": 1, "a": {"b": 1}}),
+    ({"items.x": 1, "_id": 0}, {"items": [{"x": 1}, {"x": 3}]}),
+    ({"blob": 0, "a.c": 0}, {"_id": 1, "a": {"b": 1}, "items": [{"x": 1, "y": 2}, 5, {"x": 3}]}),
+    ({"_id": 0}, {key: value for key, value in DOCUMENT.items() if key != "_id"}),
+])
+def test_projection(spec, expected):
+    assert Projection(spec).apply(DOCUMENT) == expected
+
+
+def test_invalid_projection():
+    with pytest.raises(ProjectionError):
+        Projection({"a": 1, "blob": 0})
+    with pytest.raises(ProjectionError):
+        Projection({"a": 1, "a.b": 1})
+
+
+def test_find_and_query_projection(server):
+    run(server, 1, {"insert": "items", "documents": [dict(DOCUMENT, _id=i) for i in range(3)], "$db": "test"})
+    reply = run(server, 2, {"find": "items", "filter": {}, "projection": {"a.b": 1, "_id": 0}, "batchSize": 2,
+                            "$db": "test"})
+    assert reply["cursor"]["firstBatch"] == [{"a": {"b": 1}}] * 2
+    # the cursor keeps projecting the next batches
+    reply = run(server, 3, {"getMore": reply["cursor"]["id"], "collection": "items", "$db": "test"})
+    assert reply["cursor"]["nextBatch"] == [{"a": {"b": 1}}]
+    assert run(server, 4, {"find": "items", "projection": {"a": 1, "blob": 0}, "$db": "test"})["ok"] == 0.0
+
+    query = QueryParser().do_encode({"flags": 0, "fullCollectionName": "test.items", "numberToSkip": 0,
+                                     "numberToReturn": 0, "query": {"_id": 1}, "returnFieldsSelector": {"blob": 0}})
+    reply = server._process_message(with_header(OpCode.OP_QUERY, query), server._new_connection(("127.0.0.1", 0)))
+    # OP_REPLY: header, flags, cursor id, starting from, number returned, then the documents
+    assert bson.decode_all(reply[36:]) == [{key: value for key, value in DOCUMENT.items() if key != "blob"}]
+
+    projection = run(server, 5, {"serverStatus": 1, "$db": "admin"})["projection"]
+    assert projection["documents"] == 4
+    # the stored size of the documents minus the size of the projected ones
+    full_size = len(bson.encode(dict(DOCUMENT, _id=0)))
+    assert projection["bytesSaved"] == 3 * (full_size - len(bson.encode({"a": {"b": 1}}))) + (
+        full_size - len(bson.encode({key: value for key, value in DOCUMENT.items() if key != "blob"})))
@@ -0,0 +1,53 @@
+import struct
+
+from backend.op_code import OpCode
+from conftest import msg_request, reply_document
+from utils.connection import ClientConnection
+from utils.response_cache import ResponseCache, command_cache_key, render_reply
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_and_render():
+    clock = FakeClock()
+    cache = ResponseCache(clock=clock)
+    key = command_cache_key(OpCode.OP_MSG, 0, {"hello": 1, "lsid": {"id": 1}})
+    assert key == command_cache_key(OpCode.OP_MSG, 0, {"hello": 1, "lsid": {"id": 2}})
+    raw = struct.pack("<iiii", 20, 7, 3, OpCode.OP_MSG) + b"body"
+    cache.put(key, raw, {}, ttl=1.0)
+    assert render_reply(cache.get(key), 42, 43) == struct.pack("<iiii", 20, 43, 42, OpCode.OP_MSG) + b"body"
+    clock.now = 1.0
+    assert cache.get(key) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cached_replies(server):
+    calls = []
+    handle_msg = server.allowed_commands[OpCode.OP_MSG]
+    server.allowed_commands[OpCode.OP_MSG] = lambda data: calls.append(data) or handle_msg(data)
+    connection = ClientConnection(1, ("127.0.0.1", 0))
+
+    first = server._process_message(msg_request(1, {"buildInfo": 1, "$db": "admin"}), connection)
+    second = server._process_message(msg_request(2, {"buildInfo": 1, "$db": "admin"}), connection)
+    assert len(calls) == 1
+    assert struct.unpack_from("<i", second, 8)[0] == 2
+    assert first[16:] == second[16:]
+
+    # data dependent and failed commands are not cached
+    for request_id in (3, 4):
+        server._process_message(msg_request(request_id, {"listDatabases": 1, "$db": "admin"}), connection)
+        server._process_message(msg_request(request_id, {"top": 1, "$db": "test"}), connection)
+    assert len(calls) == 5
+    reply = reply_document(server._process_message(msg_request(5, {"hello": 1, "compression": ["zlib"],
+                                                                   "$db": "admin"}), connection))
+    assert reply["compression"] == ["zlib"]
+    server._process_message(msg_request(6, {"hello": 1, "compression": ["zlib"], "$db": "admin"}), connection)
+    assert len(calls) == 6
+    assert connection.compressors == ["zlib"]
@@ -0,0 +1,68 @@
+import socket
+import struct
+import threading
+
+import pytest
+
+from utils.socket_buffer import ReceiveBuffer
+
+
+def build_message(request_id, body_size):
+    body = bytes([request_id % 256]) * body_size
+    return struct.pack("<iiii", 16 + body_size, request_id, 0, 2013) + body
+
+
+@pytest.fixture
+def socket_pair():
+    server_side, client_side = socket.socketpair()
+    yield server_side, client_side
+    server_side.close()
+    client_side.close()
+
+
+def test_pipelined_messages_in_one_read(socket_pair):
+    server_side, client_side = socket_pair
+    messages = [build_message(i, 10 * i) for i in range(1, 6)]
+    client_side.sendall(b"".join(messages))
+    client_side.close()
+    received = list(ReceiveBuffer(server_side).messages())
+    assert received == messages
+
+
+def test_message_split_across_reads(socket_pair):
+    server_side, client_side = socket_pair
+    message = build_message(7, 100)
+
+    def send_slowly():
+        for i in range(0, len(message), 3):
+            client_side.sendall(message[i:i + 3])
+        client_side.close()
+
+    sender = threading.Thread(target=send_slowly)
+    sender.start()
+    received = list(ReceiveBuffer(server_side, buffer_size=32).messages())
+    sender.join()
+    assert received == [message]
+
+
+def test_message_larger_than_buffer(socket_pair):
+    server_side, client_side = socket_pair
+    messages = [build_message(1, 200 * 1024), build_message(2, 16), build_message(3, 300 * 1024)]
+
+    def send_all():
+        client_side.sendall(b"".join(messages))
+        client_side.close()
+
+    sender = threading.Thread(target=send_all)
+    sender.start()
+    receive_buffer = ReceiveBuffer(server_side, buffer_size=1024)
+    received = list(receive_buffer.messages())
+    sender.join()
+    assert received == messages
+
+
+def test_invalid_message_length(socket_pair):
+    server_side, client_side = socket_pair
+    client_side.sendall(struct.pack("<iiii", 8, 0, 0, 2013))
+    with pytest.raises(ValueError):
+        list(ReceiveBuffer(server_side).messages())
@@ -0,0 +1,109 @@
+import os
+import threading
+
+import pytest
+
+from backend.tinymongodb.handler import TinyMongoDBBackend
+from backend.tinymongodb.storage import BSONJSONStorage
+from backend.tinymongodb.wal import WALDatabase
+
+
+@pytest.fixture
+def wal_backend(tmp_path, monkeypatch):
+    # the table files are created in the working directory
+    monkeypatch.chdir(tmp_path)
+    handler = TinyMongoDBBackend(hostname="localhost", port=27017, storage="wal")
+    yield handler
+    handler.cursor_manager.stop()
+
+
+def test_recovery_truncates_torn_record(tmp_path):
+    path = str(tmp_path / "test.json")
+    database = WALDatabase(path)
+    doc_ids = database.insert_multiple("items", [{"_id": i} for i in range(5)])
+    database.update("items", {doc_ids[0]: {"_id": 0, "n": 1}})
+    database.remove("items", doc_ids[-1:])
+    with open(database.wal_path, "ab") as handle:
+        # a record cut by a crash
+        handle.write(b"\x40\x00\x00\x00\x00\x00\x00\x00partial")
+
+    recovered = WALDatabase(path)
+    assert recovered.read_table("items") == {"1": {"_id": 0, "n": 1}, "2": {"_id": 1}, "3": {"_id": 2},
+                                             "4": {"_id": 3}}
+    assert recovered.wal_size == database.wal_size
+    assert recovered.insert_multiple("items", [{"_id": 5}]) == [5]
+
+
+def test_group_commit(tmp_path):
+    database = WALDatabase(str(tmp_path / "test.json"))
+
+    def insert(writer):
+        for i in range(50):
+            database.insert_multiple("items", [{"writer": writer, "i": i}])
+
+    threads = [threading.Thread(target=insert, args=(writer,)) for writer in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert database.commits == 400
+    assert database.fsyncs <= database.commits
+    assert sorted(map(int, WALDatabase(database.path).read_table("items"))) == list(range(1, 401))
+
+
+def test_snapshot_is_copy_on_write(tmp_path):
+    database = WALDatabase(str(tmp_path / "test.json"))
+    database.insert_multiple("items", [{"_id": i} for i in range(3)])
+    table = database.read_table("items")
+    database.insert_multiple("items", [{"_id": 3}])
+    # no scan holds the table, it is changed in place
+    assert database.read_table("items") is table
+
+    scan = iter(database.snapshot_table("items").values())
+    assert next(scan) == {"_id": 0}
+    database.insert_multiple("items", [{"_id": 4}])
+    database.remove("items", [2])
+    assert list(scan) == [{"_id": 1}, {"_id": 2}, {"_id": 3}]
+    assert database.read_table("items") is not table
+    assert sorted(database.read_table("items")) == ["1", "3", "4", "5"]
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / "test.json")
+    database = WALDatabase(path)
+    database.insert_multiple("items", [{"_id": i} for i in range(10)])
+    database.checkpoint()
+    assert database.wal_size == 0
+    database.remove("items", [1])
+
+    # the snapshot is in the format of the JSON engine
+    assert len(BSONJSONStorage(path).read_table("items")) == 10
+    assert len(WALDatabase(path).read_table("items")) == 9
+
+
+def test_wal_backend(wal_backend):
+    namespace = "test.items"
+    inserted, _ = wal_backend._insert_documents(namespace, [{"_id": i, "n": i % 3} for i in range(30)])
+    assert inserted == 30
+    assert wal_backend._update_documents(namespace, {"n": 1}, {"$set": {"n": 4}}, multi=True)[:2] == (10, 10)
+    assert wal_backend._delete_documents(namespace, {"n": 2}) == 10
+    assert sorted(doc["_id"] for doc in wal_backend._find_documents(namespace, {"n": 4})) == list(range(1, 30, 3))
+    # system databases stay in the JSON files shared by the workers
+    assert "items" in wal_backend.backend.table_names("test")
+    assert "database" in BSONJSONStorage.database_table_names(wal_backend.backend.database_path("admin"))
+    assert not os.path.exists("tinydb/admin.wal")
+
+
+def test_memory_backend(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    handler = TinyMongoDBBackend(hostname="localhost", port=27017, storage="memory")
+    namespace = "cache.items"
+    handler._insert_documents(namespace, [{"_id": i, "n": i % 3} for i in range(30)])
+    assert handler._update_documents(namespace, {"_id": {"$gte": 25}}, {"$set": {"n": 5}}, multi=True)[:2] == (5, 5)
+    assert handler._delete_documents(namespace, {"n": {"$in": [0, 5]}}) == 14
+    assert len(list(handler._find_documents(namespace, {"n": {"$ne": 1}}))) == 8
+    assert "items" in handler.backend.table_names("cache")
+    assert "database" in handler.backend.table_names("admin")
+    handler.cursor_manager.stop()
+    # nothing is written to disk
+    assert os.listdir(tmp_path) == []
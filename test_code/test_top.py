@@ -0,0 +1,29 @@
+import threading
+
+from utils.top import TopCounters
+
+
+def test_top_counters_threads():
+    top = TopCounters()
+
+    def record():
+        for _ in range(1000):
+            top.record("test.items", "queries", 2)
+            top.record("test.items", "insert", 3)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    top.record("test.other", "commands", 5)
+
+    stats = top.snapshot()
+    items = stats["test.items"]
+    assert items["queries"] == {"time": 16000, "count": 8000}
+    assert items["readLock"] == {"time": 16000, "count": 8000}
+    assert items["writeLock"] == {"time": 24000, "count": 8000}
+    assert items["total"] == {"time": 40000, "count": 16000}
+    assert stats["test.other"]["commands"]["count"] == 1
+    # the buffers of the exited threads are kept
+    assert top.snapshot()["test.items"]["total"]["count"] == 16000
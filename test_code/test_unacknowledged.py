@@ -0,0 +1,102 @@
+import threading
+import time
+
+import bson
+
+from backend.tinymongodb.unacknowledged import UnacknowledgedWrite, UnacknowledgedWriter
+from conftest import msg_request
+
+
+def test_writer_batches_inserts():
+    batches = []
+    release = threading.Event()
+
+    def insert(namespace, documents, ordered):
+        batches.append((namespace, [document["n"] for document in documents]))
+
+    writer = UnacknowledgedWriter(insert, max_queued=100)
+    # keeps the writer busy while the next writes are queued
+    writer.submit(UnacknowledgedWrite(None, None, release.wait))
+    for n in range(3):
+        writer.submit(UnacknowledgedWrite("db.a", [{"n": n}], None))
+    writer.submit(UnacknowledgedWrite(None, None, lambda: batches.append("update")))
+    ticket = writer.submit(UnacknowledgedWrite("db.b", [{"n": 3}], None))
+    release.set()
+    writer.wait(ticket)
+    assert batches == [("db.a", [0, 1, 2]), "update", ("db.b", [3])]
+    assert writer.stats()["insertBatches"] == 2
+
+
+def test_writer_ordered_inserts():
+    stored = []
+    release = threading.Event()
+
+    def insert(namespace, documents, ordered):
+        # a duplicate `_id` fails like in `_insert_documents`
+        write_errors = []
+        for idx, document in enumerate(documents):
+            if document["_id"] in stored:
+                write_errors.append({"index": idx})
+                if ordered:
+                    break
+                continue
+            stored.append(document["_id"])
+        return write_errors
+
+    writer = UnacknowledgedWriter(insert, max_queued=100)
+    writer.submit(UnacknowledgedWrite(None, None, release.wait))
+    writer.submit(UnacknowledgedWrite("db.a", [{"_id": 1}], None))
+    # an ordered insert stops at its duplicate, the next ordered insert is still written
+    writer.submit(UnacknowledgedWrite("db.a", [{"_id": 2}, {"_id": 1}, {"_id": 3}], None))
+    writer.submit(UnacknowledgedWrite("db.a", [{"_id": 4}], None))
+    # an unordered insert skips its duplicate
+    writer.submit(UnacknowledgedWrite("db.a", [{"_id": 5}, {"_id": 1}, {"_id": 6}], None, ordered=False))
+    release.set()
+    writer.flush()
+    assert stored == [1, 2, 4, 5, 6]
+    assert writer.stats()["errors"] == 2
+
+
+def test_writer_blocks_when_full():
+    release = threading.Event()
+    writer = UnacknowledgedWriter(lambda namespace, documents, ordered: None, max_queued=2)
+    writer.submit(UnacknowledgedWrite(None, None, release.wait))
+    while writer.stats()["queued"]:
+        # the writer takes the first write
+        time.sleep(0.01)
+    submitted = []
+
+    def submit():
+        for n in range(5):
+            submitted.append(writer.submit(UnacknowledgedWrite("db.a", [{"n": n}], None)))
+
+    thread = threading.Thread(target=submit, daemon=True)
+    thread.start()
+    thread.join(0.2)
+    # the writer is busy, the queue only takes two writes
+    assert thread.is_alive()
+    assert len(submitted) == 2
+    release.set()
+    thread.join()
+    writer.flush()
+    assert writer.stats()["blocked"] >= 1
+    assert writer.stats()["completed"] == 6
+
+
+def test_more_to_come_writes(server):
+    connection = server._new_connection(("127.0.0.1", 0))
+    for i in range(20):
+        # bit 1: moreToCome, nothing is sent back
+        assert server._process_message(msg_request(i, {"insert": "items", "documents": [{"_id": i}], "$db": "test"},
+                                                   flag_bits=1 << 1), connection) is None
+    reply = server._process_message(msg_request(20, {"update": "items", "updates": [{"q": {"_id": 1},
+                                                                                      "u": {"$set": {"a": 1}}}],
+                                                     "writeConcern": {"w": 0}, "$db": "test"}), connection)
+    assert bson.decode(reply[21:]) == {"ok": 1.0}
+    # the connection reads its own writes
+    reply = server._process_message(msg_request(21, {"find": "items", "filter": {}, "$db": "test"}), connection)
+    documents = bson.decode(reply[21:])["cursor"]["firstBatch"]
+    assert len(documents) == 20
+    assert documents[1] == {"_id": 1, "a": 1}
+    stats = server.handler.unacknowledged.stats()
+    assert stats["submitted"] == 21 and stats["insertedDocuments"] == 20
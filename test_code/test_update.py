@@ -0,0 +1,53 @@
+import pytest
+
+from tinymongo import TinyMongoClient
+
+from backend.tinymongodb.update import UpdateError, apply_update, upsert_document
+
+
+def test_update_operators():
+    document = {"_id": 1, "a": 1, "b": {"c": 2}, "list": [1, 2, 3], "old": "x"}
+    updated = apply_update(document, {
+        "$set": {"b.d": 3},
+        "$inc": {"a": 2},
+        "$unset": {"b.c": ""},
+        "$push": {"list": {"$each": [4, 5]}},
+        "$addToSet": {"set": 1},
+        "$rename": {"old": "new"},
+        "$max": {"a": 10},
+    })
+    assert updated == {"_id": 1, "a": 10, "b": {"d": 3}, "list": [1, 2, 3, 4, 5], "new": "x", "set": [1]}
+    # the original document is not modified
+    assert document["a"] == 1
+
+
+def test_replacement_keeps_id():
+    assert apply_update({"_id": 1, "a": 1}, {"b": 2}) == {"_id": 1, "b": 2}
+    with pytest.raises(UpdateError):
+        apply_update({"_id": 1}, {"_id": 2, "b": 2})
+
+
+def test_invalid_updates():
+    with pytest.raises(UpdateError):
+        apply_update({"a": "x"}, {"$inc": {"a": 1}})
+    with pytest.raises(UpdateError):
+        apply_update({"a": 1}, {"$unknown": {"a": 1}})
+
+
+def test_pull_conditions(tmp_path):
+    matcher = TinyMongoClient(str(tmp_path)).db.items.parse_query
+    document = {"t": [1, 5, 9, "x"], "s": [{"a": 1, "b": 3}, {"a": 1, "b": 1}, 2]}
+    assert apply_update(document, {"$pull": {"t": {"$gt": 4}}}, matcher=matcher)["t"] == [1, "x"]
+    assert apply_update(document, {"$pull": {"t": {"$in": [1, "x"]}}}, matcher=matcher)["t"] == [5, 9]
+    assert apply_update(document, {"$pull": {"s": {"a": 1, "b": {"$gt": 2}}}},
+                        matcher=matcher)["s"] == [{"a": 1, "b": 1}, 2]
+    assert apply_update(document, {"$pull": {"t": 5}})["t"] == [1, 9, "x"]
+    with pytest.raises(UpdateError):
+        # a condition can't be matched without the matcher of the collection
+        apply_update(document, {"$pull": {"t": {"$gt": 4}}})
+
+
+def test_upsert_document():
+    document = upsert_document({"a": 1, "b": {"$gt": 2}, "c": {"$eq": 3}},
+                               {"$set": {"d": 4}, "$setOnInsert": {"e": 5}})
+    assert document == {"a": 1, "c": 3, "d": 4, "e": 5}
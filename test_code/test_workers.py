@@ -0,0 +1,48 @@
+import struct
+
+import pytest
+
+from backend.op_code import OpCode
+from conftest import msg_request, reply_document
+from tinymongo_server import TinyMongoServer
+from utils.connection import ClientConnection
+from utils.workers import WorkerPeers, database_owner
+
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch):
+    # two workers in the same process, the table files are created in the working directory
+    monkeypatch.chdir(tmp_path)
+    servers = [TinyMongoServer(port=0, peers=WorkerPeers(str(tmp_path), 2, worker_id)) for worker_id in range(2)]
+    yield servers
+    for server in servers:
+        server.peers.close()
+        server.handler.cursor_manager.stop()
+        server.server_socket.close()
+
+
+def test_database_owner():
+    owners = [database_owner(f"db{i}", 4) for i in range(100)]
+    assert owners == [database_owner(f"db{i}", 4) for i in range(100)]
+    assert set(owners) == {0, 1, 2, 3}
+
+
+def test_forward_to_owner(workers):
+    database = next(f"db{i}" for i in range(100) if database_owner(f"db{i}", 2) == 1)
+    connection = ClientConnection(1, ("127.0.0.1", 0))
+    calls = []
+    handle_msg = workers[1].allowed_commands[OpCode.OP_MSG]
+    workers[1].allowed_commands[OpCode.OP_MSG] = lambda data: calls.append(data) or handle_msg(data)
+
+    reply = workers[0]._process_message(msg_request(1, {"insert": "items", "documents": [{"_id": 1}],
+                                                        "$db": database}), connection)
+    assert reply_document(reply) == {"n": 1, "ok": 1.0}
+    reply = workers[0]._process_message(msg_request(2, {"find": "items", "filter": {}, "$db": database}),
+                                        connection)
+    assert struct.unpack_from("<i", reply, 8)[0] == 2
+    assert reply_document(reply)["cursor"]["firstBatch"] == [{"_id": 1}]
+    assert len(calls) == 2
+
+    # server commands are answered by the worker which received them
+    workers[0]._process_message(msg_request(3, {"ping": 1, "$db": database}), connection)
+    assert len(calls) == 2
@@ -1,53 +1,93 @@
+import asyncio
+import functools
+import importlib
+import shutil
 import socket
 import struct
+import tempfile
 import threading
+import time
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 
-from backend.op_code import OpCode
+from backend.compression import HANDSHAKE_COMMANDS, UNCOMPRESSED_COMMANDS, compressor_name
+from backend.op_code import ErrorCode, OpCode
 from backend.parser import HeadParser, byte2string
 from backend.tinymongodb.handler import TinyMongoDBBackend
+from backend.tinymongodb.profiler import DEFAULT_SLOW_MS
+from backend.tinymongodb.storage import STORAGE_ENGINES
+from backend.tinymongodb.unacknowledged import DEFAULT_QUEUE_SIZE
 from utils.http_utils import payload2response, payload2compressed_response, payload2msg_response
-from utils.logger import server_logger
-from utils.multi_thread_wrapper import LoopThread
+from utils.logger import LOG_MAX_LENGTH, configure_logging, request_log, server_logger, truncated
+from utils.metrics import LEGACY_OPCOUNTERS, MSG_OPCOUNTERS, serve_metrics
+from utils.response_cache import ResponseCache, command_cache_key, render_reply
+from utils.connection import ClientConnection
+from utils.socket_buffer import ReceiveBuffer, HEADER_SIZE, MAX_MESSAGE_SIZE
+from utils.workers import WorkerPeers, run_workers
 
 
 class IDGenerator:
     def __init__(self):
         self.id = 0
+        # the connection threads take ids at the same time, `+=` alone may hand out an id twice
+        self._lock = threading.Lock()
 
     def get_one(self):
-        self.id += 1
-        return self.id
+        with self._lock:
+            self.id += 1
+            return self.id
 
 class TinyMongoServer:
 
-    def __init__(self, host='127.0.0.1', port=27017):
+    def __init__(self, host='127.0.0.1', port=27017, backlog=socket.SOMAXCONN, compression_threshold=1024,
+                 peers=None, storage="json", profile=0, slow_ms=DEFAULT_SLOW_MS,
+                 unacknowledged_queue_size=DEFAULT_QUEUE_SIZE):
         self.host = host
         self.port = port
+        self.backlog = backlog
+        # other worker processes of `--workers`, they share the listen port
+        self.peers = peers
+        # replies smaller than this number of bytes are not worth compressing
+        self.compression_threshold = compression_threshold
         self.hostname = socket.gethostname()
         #
         self.handler = TinyMongoDBBackend(
             hostname=self.hostname,
-            port=self.port)
+            port=self.port,
+            storage=storage,
+            shared=peers is not None,
+            profile=profile,
+            slow_ms=slow_ms,
+            unacknowledged_queue_size=unacknowledged_queue_size)
         self.logger = server_logger
         self.head_handler = HeadParser()
         # demo list that stores allowed commands
         self.allowed_commands = self.handler.allowed_commands
         self.id_generator = IDGenerator()
+        self.connection_id_generator = IDGenerator()
+        # encoded replies of the commands which don't depend on the data
+        self.response_cache = ResponseCache()
+        self.handler.metrics.add_section("responseCache", self.response_cache.stats)
 
         self._build_socket()
+        if self.peers is not None:
+            # requests for the databases of this worker forwarded by the other workers
+            self._peer_connection = ClientConnection(0, "workers")
+            self.peers.serve(lambda data: self._process_message(data, self._peer_connection, forwarded=True))
         # self.response_parse = payload2response
         self.response_parse_msg = payload2msg_response
         self.response_parse = payload2response
-        self.looper_threads = []
 
     def _build_socket(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.peers is not None:
+            # the kernel spreads the connections over the workers
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        # set maximum number of connections
-        self.server_socket.listen(5)
+        # set maximum number of pending connections
+        self.server_socket.listen(self.backlog)
         # log server start
         self.logger.info(f"Server started on {self.host}:{self.port}")
         print(f"Server started on {self.host}:{self.port}")
@@ -66,51 +106,422 @@ class TinyMongoServer:
 
 
     def __del__(self):
-        self.server_socket.close()
+        server_socket = getattr(self, "server_socket", None)
+        if server_socket is not None:
+            server_socket.close()
 
-    def _handle_request(self, client_socket, client_address):
-        while True:
-            try:
-                data = client_socket.recv(4096)
-                if not data:
-                    break
-            except ConnectionResetError as e:
-                self.logger.error(f"Connection closed by client")
-                break
-            except ConnectionAbortedError as e:
-                self.logger.error(f"Connection aborted by client")
-                break
+    def _command_name(self, op_code, payload):
+        # the command name is the first key of the command document
+        if op_code == OpCode.OP_MSG and payload.get("sections"):
+            return next(iter(payload["sections"][0]), None)
+        if op_code == OpCode.OP_QUERY:
+            return next(iter(payload["query"]), None)
+        return None
+
+    @staticmethod
+    def _cacheable_response(op_code, response):
+        # errors are not cached, the next request may succeed
+        if op_code == OpCode.OP_MSG:
+            return response["sections"][0].get("ok") == 1
+        return response["responseFlags"] & 2 == 0
+
+    def _cache_key(self, op_code, payload, command_name):
+        """
+        :return: key of the cached reply of a command and its time to live,
+            None as key if the reply can't be cached
+        """
+        if op_code == OpCode.OP_MSG and len(payload.get("sections", ())) == 1:
+            flags, command_document = payload["flagBits"], payload["sections"][0]
+        elif op_code == OpCode.OP_QUERY and command_name in HANDSHAKE_COMMANDS:
+            flags, command_document = payload["flags"], payload["query"]
+        else:
+            return None, None
+        command = self.handler.commands.get(command_name)
+        if command is None or not command.cacheable:
+            return None, None
+        return command_cache_key(op_code, flags, command_document), command.cache_ttl
+
+    def _record_compressors(self, op_code, response, connection):
+        # remember the compressors the backend accepted in hello for this connection
+        if op_code == OpCode.OP_MSG:
+            reply_document = response["sections"][0]
+        else:
+            reply_document = response["documents"][0]
+        connection.compressors = reply_document.get("compression", [])
+
+    def _owner(self, op_code, payload, command_name):
+        """
+        :return: the worker which owns the database of a request, None if it is handled by this worker
+        """
+        if self.peers is None:
+            return None
+        if op_code == OpCode.OP_MSG:
+            # handshake and server commands don't read any table
+            command = self.handler.commands.get(command_name)
+            if command is None or command.kind == "admin" or not payload.get("sections"):
+                return None
+            database = payload["sections"][0].get("$db")
+        elif op_code == OpCode.OP_QUERY and command_name in HANDSHAKE_COMMANDS:
+            return None
+        else:
+            database = payload.get("fullCollectionName", "").split(".", 1)[0]
+        if not database:
+            return None
+        owner = self.peers.owner(database)
+        return None if owner == self.peers.worker_id else owner
+
+    def _forward(self, owner, op_code, data, request_id):
+        try:
+            return self.peers.forward(owner, data)
+        except OSError as e:
+            self.logger.error(f"Can't forward to worker {owner}: {e}")
+            if op_code != OpCode.OP_MSG:
+                return None
+            response = {"flagBits": 0, "sections": self.handler.handle_error(
+                f"worker {owner} is not available", ErrorCode.HostUnreachable)}
+            return self.response_parse_msg(request_id, self.id_generator.get_one(), response)
+
+    def _reply(self, op_code, data, payload, command_name, request_id):
+        """
+        Handle a request by the backend of this worker.
+        :return: reply payload and the encoded reply, None if there is no reply
+        """
+        cache_key, cache_ttl = self._cache_key(op_code, payload, command_name)
+        cached = self.response_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            # only the ids of the header change
+            return cached.response, render_reply(cached, request_id, self.id_generator.get_one())
+        handler_func = self.allowed_commands[op_code]
+        response = handler_func(data)
+        # some of the command may not need to return any response
+        # the request_id for response is generated by the server itself
+        if not response:
+            return None, None
+        if op_code in (OpCode.OP_QUERY, OpCode.OP_GET_MORE):
+            # legacy operations are answered with OP_REPLY
+            response_raw = self.response_parse(request_id, self.id_generator.get_one(), response)
+        elif op_code == OpCode.OP_MSG:
+            response_raw = self.response_parse_msg(request_id, self.id_generator.get_one(), response)
+        else:
+            return None, None
+        if cache_key is not None and self._cacheable_response(op_code, response):
+            self.response_cache.put(cache_key, response_raw, response, ttl=cache_ttl)
+        return response, response_raw
+
+    def _process_message(self, data, connection, forwarded=False, streamed=False):
+        """
+        Dispatch one complete wire message to the backend and encode the reply.
+        Shared by every connection engine.
+        :param data: raw message including the 16 bytes header
+        :param connection: state of the client connection which sent the message
+        :param forwarded: the message was forwarded by another worker, it is handled here
+        :param streamed: the message was made by the server to stream an exhaust cursor,
+            it was not received from the client
+        :return: binary reply, or None if the command does not need to be answered
+        """
+        wire_size = 0 if streamed else len(data)
+        header = self.head_handler.do_decode(data)
+        compressor_id = None
+        if header["op_code"] == OpCode.OP_COMPRESSED:
+            # unwrap the original message, the reply is compressed with the same compressor
+            compressed_payload = self.handler.handle_decode(OpCode.OP_COMPRESSED, data)
+            compressor_id = compressed_payload["compressorId"]
+            data = compressed_payload["message"]
             header = self.head_handler.do_decode(data)
-            op_code = header["op_code"]
-            request_id = header["request_id"]
-            # self.logger.info(f"Received request with op_code {op_code}")
-            if op_code in self.allowed_commands:
-                payload = self.handler.handle_decode(op_code, data)
-                # TODO: reorganize code here for adding additional information to payload
-                # payload["client_address"] = client_address
-                self.logger.info(f"Request payload: {payload}")
-                handler_func = self.allowed_commands[op_code]
-                response = handler_func(data)
-                self.logger.info(f"Sending Response: {response}")
-            else:
-                response = {}
-            # some of the command may not need to return any response
-            # the request_id for response is generated by the server itself
-            if response:
-                if op_code == OpCode.OP_QUERY:
-                    response_raw = self.response_parse(request_id, self.id_generator.get_one(), response)
-                    client_socket.sendall(response_raw)
+        if not streamed:
+            connection.record_in(wire_size, len(data))
+        op_code = header["op_code"]
+        request_id = header["request_id"]
+        # self.logger.info(f"Received request with op_code {op_code}")
+        if op_code not in self.allowed_commands:
+            return None
+        start = time.perf_counter()
+        payload = self.handler.handle_decode(op_code, data)
+        # TODO: reorganize code here for adding additional information to payload
+        # payload["client_address"] = client_address
+        sampled = request_log.sampled()
+        if sampled:
+            self.logger.debug("Request payload: %s", truncated(payload))
+        command_name = self._command_name(op_code, payload)
+        owner = None if forwarded else self._owner(op_code, payload, command_name)
+        if owner is not None:
+            response = None
+            response_raw = self._forward(owner, op_code, data, request_id)
+        else:
+            if op_code == OpCode.OP_KILL_CURSORS and self.peers is not None and not forwarded:
+                # the cursors may belong to any worker
+                self.peers.broadcast(data)
+            if connection.unacknowledged_ticket and not self.handler.unacknowledged_request(op_code, payload):
+                # like the requests of a connection to MongoDB, a request sees the previous writes of its
+                # connection, even the ones the client didn't wait for
+                self.handler.unacknowledged.wait(connection.unacknowledged_ticket)
+                connection.unacknowledged_ticket = 0
+            response, response_raw = self._reply(op_code, data, payload, command_name, request_id)
+            ticket = self.handler.take_unacknowledged_ticket()
+            if ticket is not None and not forwarded:
+                connection.unacknowledged_ticket = ticket
+            if sampled and response is not None:
+                self.logger.debug("Sending Response: %s", truncated(response))
+        request_log.slow(command_name, payload, (time.perf_counter() - start) * 1000)
+        reply = None
+        if response_raw is not None:
+            reply = self._encode_reply(response_raw, response, command_name, compressor_id, request_id, op_code,
+                                       connection)
+        if not forwarded:
+            # a forwarded request was counted by the worker which received it
+            self._record_request(op_code, payload, command_name, start, wire_size, len(reply) if reply else 0)
+            # the worker which received the request streams the cursor, even if another worker owns it
+            connection.exhaust_request = self._exhaust_request(op_code, data, response_raw)
+            if connection.exhaust_request is not None:
+                connection.exhaust_delay = payload["sections"][0].get("maxAwaitTimeMS", 0) / 1000
+        return reply
+
+    @staticmethod
+    def _exhaust_request(op_code, data, response_raw):
+        """
+        The request giving the next streamed reply (next batch of an exhaust cursor, next hello),
+        the same command as the request under the id of the reply, so that the next reply
+        answers the previous one.
+        :return: the message, None if the reply doesn't have `moreToCome` set
+        """
+        if op_code != OpCode.OP_MSG or response_raw is None:
+            return None
+        # flagBits of the reply follow its header, bit 1 is moreToCome
+        if not struct.unpack_from("<I", response_raw, 16)[0] & (1 << 1):
+            return None
+        reply_id = struct.unpack_from("<i", response_raw, 4)[0]
+        return struct.pack("<iiii", len(data), reply_id, 0, OpCode.OP_MSG) + data[16:]
+
+    def _close_exhaust(self, connection):
+        """
+        Kill the exhaust cursor of a client which went away before the last batch.
+        """
+        request = connection.exhaust_request
+        if request is None:
+            return
+        connection.exhaust_request = None
+        command = self.handler.handle_decode(OpCode.OP_MSG, request)["sections"][0]
+        if "getMore" not in command:
+            return
+        body = self.handler.op_parser_mapping[OpCode.OP_MSG].do_encode({"flagBits": 0, "sections": [{
+            "killCursors": command["collection"], "cursors": [command["getMore"]], "$db": command["$db"]
+        }]})
+        # goes through the dispatch so that the worker owning the cursor kills it
+        self._process_message(struct.pack("<iiii", 16 + len(body), 0, 0, OpCode.OP_MSG) + body, connection,
+                              streamed=True)
+
+    def _encode_reply(self, response_raw, response, command_name, compressor_id, request_id, op_code, connection):
+        if command_name in HANDSHAKE_COMMANDS and response is not None:
+            self._record_compressors(op_code, response, connection)
+        if (compressor_id is not None
+                and command_name not in UNCOMPRESSED_COMMANDS
+                and compressor_name(compressor_id) in connection.compressors + ["noop"]
+                and len(response_raw) >= self.compression_threshold):
+            reply_id = struct.unpack_from("<i", response_raw, 4)[0]
+            compressed_raw = payload2compressed_response(request_id, reply_id, response_raw, compressor_id)
+            if len(compressed_raw) < len(response_raw):
+                connection.record_out(len(compressed_raw), len(response_raw))
+                return compressed_raw
+        connection.record_out(len(response_raw), len(response_raw))
+        return response_raw
+
+    def _record_request(self, op_code, payload, command_name, start, bytes_in, bytes_out):
+        if op_code == OpCode.OP_MSG or (op_code == OpCode.OP_QUERY and payload["fullCollectionName"].endswith(".$cmd")):
+            opcounter = MSG_OPCOUNTERS.get(command_name, "command") if op_code == OpCode.OP_MSG else "command"
+            command = self.handler.commands.get(command_name)
+            kind = command.kind if command is not None else "admin"
+        else:
+            opcounter = LEGACY_OPCOUNTERS.get(op_code, "command")
+            kind = "write" if opcounter in ("insert", "update", "delete") else "read"
+        if op_code == OpCode.OP_KILL_CURSORS:
+            kind = "admin"
+        latency_class = {"read": "reads", "write": "writes"}.get(kind, "commands")
+        self.handler.metrics.record_request(opcounter, latency_class, int((time.perf_counter() - start) * 1e6),
+                                            bytes_in, bytes_out)
 
-                elif op_code == OpCode.OP_MSG:
-                    response_raw = self.response_parse_msg(request_id, self.id_generator.get_one(), response)
+    def _new_connection(self, client_address):
+        self.handler.metrics.connection_opened()
+        return ClientConnection(self.connection_id_generator.get_one(), client_address)
+
+    def _close_connection(self, connection):
+        self.handler.metrics.connection_closed()
+        self.logger.info(f"Connection {connection.connection_id} from {connection.client_address} closed, "
+                         f"traffic: {connection.compression_stats()}")
+
+    def _handle_request(self, client_socket, client_address):
+        connection = self._new_connection(client_address)
+        receive_buffer = ReceiveBuffer(client_socket)
+        try:
+            # one read may carry several pipelined messages, and one message may span several reads
+            for data in receive_buffer.messages():
+                response_raw = self._process_message(data, connection)
+                if response_raw:
                     client_socket.sendall(response_raw)
-        client_socket.close()
+                # exhaust cursor: a batch is only read once the previous one fits in the socket buffer,
+                # `sendall` blocks while the client doesn't read, so the result set is never buffered
+                while connection.exhaust_request is not None:
+                    time.sleep(connection.exhaust_delay)
+                    response_raw = self._process_message(connection.exhaust_request, connection, streamed=True)
+                    if response_raw:
+                        client_socket.sendall(response_raw)
+        except (ConnectionResetError, BrokenPipeError):
+            self.logger.error("Connection closed by client")
+        except ConnectionAbortedError:
+            self.logger.error("Connection aborted by client")
+        except ValueError as e:
+            self.logger.error(f"Malformed message from {client_address}: {e}")
+        finally:
+            receive_buffer.close()
+            client_socket.close()
+            self._close_exhaust(connection)
+            self._close_connection(connection)
+
+
+class AsyncTinyMongoServer(TinyMongoServer):
+    """
+    Connection engine built on `asyncio.start_server`, every connection is a coroutine
+    instead of a thread. The backend is still blocking, so the backend calls are
+    handed to a bounded thread pool.
+    """
+
+    def __init__(self, *args, executor_workers=16, **kwargs):
+        self.executor = ThreadPoolExecutor(
+            max_workers=executor_workers,
+            thread_name_prefix="tinymongo-backend"
+        )
+        super().__init__(*args, **kwargs)
+
+    def _build_socket(self):
+        # the listening socket is created by `asyncio.start_server` when the loop starts
+        self.server_socket = None
+
+    def start_server(self):
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def _serve(self):
+        server = await asyncio.start_server(
+            self._handle_connection,
+            host=self.host,
+            port=self.port,
+            backlog=self.backlog,
+            reuse_port=self.peers is not None
+        )
+        self.logger.info(f"Server started on {self.host}:{self.port} (asyncio engine)")
+        print(f"Server started on {self.host}:{self.port} (asyncio engine)")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        print(f'Accept new connection from {client_address}...')
+        connection = self._new_connection(client_address)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                head = await reader.readexactly(HEADER_SIZE)
+                message_length = self.head_handler.do_decode(head)["message_length"]
+                if message_length < HEADER_SIZE or message_length > MAX_MESSAGE_SIZE:
+                    self.logger.error(f"Malformed message from {client_address}: "
+                                      f"invalid message length {message_length}")
+                    break
+                body = await reader.readexactly(message_length - HEADER_SIZE)
+                response_raw = await loop.run_in_executor(
+                    self.executor, self._process_message, head + body, connection
+                )
+                if response_raw:
+                    writer.write(response_raw)
+                    await writer.drain()
+                # exhaust cursor: `drain` waits while the client doesn't read, the next batch is read after it
+                while connection.exhaust_request is not None:
+                    await asyncio.sleep(connection.exhaust_delay)
+                    response_raw = await loop.run_in_executor(
+                        self.executor,
+                        functools.partial(self._process_message, connection.exhaust_request, connection,
+                                          streamed=True)
+                    )
+                    if response_raw:
+                        writer.write(response_raw)
+                        await writer.drain()
+        except asyncio.IncompleteReadError:
+            # client closed the connection, possibly in the middle of a message
+            pass
+        except (ConnectionResetError, BrokenPipeError):
+            self.logger.error("Connection closed by client")
+        except ConnectionAbortedError:
+            self.logger.error("Connection aborted by client")
+        except ValueError as e:
+            self.logger.error(f"Malformed message from {client_address}: {e}")
+        finally:
+            writer.close()
+            await loop.run_in_executor(self.executor, self._close_exhaust, connection)
+            self._close_connection(connection)
 
 
 if __name__ == '__main__':
     arg_parser = ArgumentParser(description="TinyMongo Server")
     arg_parser.add_argument("--port", type=int, default=27019, help="Server port")
     arg_parser.add_argument("--host", type=str, default='127.0.0.1', help="Server host")
+    arg_parser.add_argument("--engine", type=str, default="thread", choices=["thread", "asyncio"],
+                            help="Connection engine: one thread per connection or one asyncio coroutine per connection")
+    arg_parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN, help="Listen backlog of the server socket")
+    arg_parser.add_argument("--executor-workers", type=int, default=16,
+                            help="Size of the backend thread pool used by the asyncio engine")
+    arg_parser.add_argument("--compression-threshold", type=int, default=1024,
+                            help="Replies smaller than this number of bytes are sent uncompressed")
+    arg_parser.add_argument("--plugins", type=str, nargs="*", default=[],
+                            help="Modules imported at startup, they can register their own commands")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="Number of server processes sharing the port, each database is owned by one of them")
+    arg_parser.add_argument("--storage", type=str, default="json", choices=sorted(STORAGE_ENGINES),
+                            help="Storage engine of the databases: whole JSON files, an append-only write-ahead log "
+                                 "or memory only")
+    arg_parser.add_argument("--log-level", type=str, default="info", choices=["debug", "info", "warning", "error"],
+                            help="Level of the server log, request payloads and replies are logged at debug level")
+    arg_parser.add_argument("--log-sample-rate", type=float, default=1.0,
+                            help="Fraction of the requests whose payloads are logged at debug level")
+    arg_parser.add_argument("--log-slow-ms", type=float, default=None,
+                            help="Log the requests slower than this number of milliseconds with their payload")
+    arg_parser.add_argument("--log-max-length", type=int, default=LOG_MAX_LENGTH,
+                            help="Characters of a payload written to the log")
+    arg_parser.add_argument("--profile", type=int, default=0, choices=[0, 1, 2],
+                            help="Profiling level of the databases until the `profile` command changes it: "
+                                 "0 off, 1 slow operations, 2 all operations")
+    arg_parser.add_argument("--slowms", type=int, default=DEFAULT_SLOW_MS,
+                            help="Operations slower than this number of milliseconds are profiled at level 1")
+    arg_parser.add_argument("--unacknowledged-queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                            help="Writes with w:0 (moreToCome, legacy OP_INSERT/OP_UPDATE/OP_DELETE) waiting for the "
+                                 "background writer, the connections sending them block when it is full")
+    arg_parser.add_argument("--metrics-port", type=int, default=None,
+                            help="Serve the serverStatus counters as plain-text metrics on http://host:port/metrics, "
+                                 "worker N of --workers uses port + N")
     args = arg_parser.parse_args()
-    server = TinyMongoServer(host=args.host, port=args.port)
-    server.start_server()
+    configure_logging(args.log_level, sample_rate=args.log_sample_rate, slow_ms=args.log_slow_ms,
+                      max_length=args.log_max_length)
+    for plugin in args.plugins:
+        importlib.import_module(plugin)
+    server_kwargs = dict(host=args.host, port=args.port, backlog=args.backlog,
+                         compression_threshold=args.compression_threshold, storage=args.storage,
+                         profile=args.profile, slow_ms=args.slowms,
+                         unacknowledged_queue_size=args.unacknowledged_queue_size)
+
+    def start_server(peers=None):
+        if args.engine == "asyncio":
+            server = AsyncTinyMongoServer(executor_workers=args.executor_workers, peers=peers, **server_kwargs)
+        else:
+            server = TinyMongoServer(peers=peers, **server_kwargs)
+        if args.metrics_port is not None:
+            metrics_port = args.metrics_port + (peers.worker_id if peers is not None else 0)
+            serve_metrics(args.host, metrics_port, server.handler.server_status)
+        server.start_server()
+
+    if args.workers > 1:
+        socket_dir = tempfile.mkdtemp(prefix="tinymongo-workers-")
+        try:
+            run_workers(args.workers, lambda worker_id: start_server(WorkerPeers(socket_dir, args.workers, worker_id)))
+        finally:
+            shutil.rmtree(socket_dir, ignore_errors=True)
+    else:
+        start_server()
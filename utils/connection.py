@@ -0,0 +1,40 @@
+class ClientConnection:
+    """
+    State that belongs to one client connection, shared by all the connection engines.
+    """
+
+    def __init__(self, connection_id, client_address):
+        self.connection_id = connection_id
+        self.client_address = client_address
+        # compressors accepted in hello, in order of client preference
+        self.compressors = []
+        # bytes on the wire and bytes of the messages once decompressed
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.uncompressed_bytes_in = 0
+        self.uncompressed_bytes_out = 0
+        # request repeated by the server while it streams replies with moreToCome (the getMore of an
+        # exhaust cursor or an awaitable hello), None when nothing is streamed
+        self.exhaust_request = None
+        # seconds between two streamed replies, the maxAwaitTimeMS of a hello
+        self.exhaust_delay = 0.0
+        # ticket of the last write of the connection left to the background writer, 0 if none is pending
+        self.unacknowledged_ticket = 0
+
+    def record_in(self, wire_size, message_size):
+        self.bytes_in += wire_size
+        self.uncompressed_bytes_in += message_size
+
+    def record_out(self, wire_size, message_size):
+        self.bytes_out += wire_size
+        self.uncompressed_bytes_out += message_size
+
+    def compression_stats(self):
+        return {
+            "bytesIn": self.bytes_in,
+            "bytesOut": self.bytes_out,
+            "uncompressedBytesIn": self.uncompressed_bytes_in,
+            "uncompressedBytesOut": self.uncompressed_bytes_out,
+            "bytesInSaved": self.uncompressed_bytes_in - self.bytes_in,
+            "bytesOutSaved": self.uncompressed_bytes_out - self.bytes_out,
+        }
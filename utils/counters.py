@@ -0,0 +1,59 @@
+import threading
+
+
+def add_number(target, key, value):
+    target[key] = target.get(key, 0) + value
+
+
+class ThreadLocalCounters:
+    """
+    Counters written without a lock: every thread adds into its own buffer, and the buffers
+    are only merged when the counters are read. The buffers of the threads which exited are
+    folded into one, so the number of buffers follows the number of live threads.
+    """
+
+    def __init__(self, add_value=add_number):
+        """
+        :param add_value: function(target, key, value) adding a buffered value into the totals
+        """
+        self._add_value = add_value
+        self._local = threading.local()
+        # (thread, buffer) of the threads which recorded something
+        self._buffers = []
+        # counters of the threads which exited
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def buffer(self):
+        """
+        :return: dict of the counters of the current thread, only written by this thread
+        """
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = {}
+            with self._lock:
+                self._buffers.append((threading.current_thread(), buffer))
+        return buffer
+
+    def _merge(self, target, buffer):
+        # the buffer may be written by its thread while it is copied, `dict()` copies it atomically
+        for key, value in dict(buffer).items():
+            self._add_value(target, key, value)
+
+    def totals(self):
+        """
+        :return: dict of key -> value summed over all the threads
+        """
+        totals = {}
+        with self._lock:
+            alive = []
+            for thread, buffer in self._buffers:
+                if thread.is_alive():
+                    alive.append((thread, buffer))
+                else:
+                    self._merge(self._retired, buffer)
+            self._buffers = alive
+            self._merge(totals, self._retired)
+            for _, buffer in alive:
+                self._merge(totals, buffer)
+        return totals
@@ -1,7 +1,7 @@
 import struct
 import bson
 
-from backend.parser import MSGParser
+from backend.parser import MSGParser, CompressedParser
 from backend.op_code import OpCode
 
 
@@ -28,9 +28,26 @@ def payload2response(response_to, request_id, response_json):
     response_body = struct.pack("<iqii", flags, cursor_id, starting_from, number_documents)
     return response_header + response_body + response_payload
 
-def payload2compressed_response(response_to, request_id, response_json):
-    # used for version 5.1+
-    pass
+def payload2compressed_response(response_to, request_id, response_raw, compressor_id):
+    """
+    Wrap an encoded reply into an `OP_COMPRESSED` message.
+    :param response_to: reqeust_id of the original request
+    :param request_id: identifier for this response
+    :param response_raw: complete `OP_REPLY` or `OP_MSG` message, header included
+    :param compressor_id: compressor negotiated with the client
+    :return: binary string
+    """
+    original_opcode = struct.unpack_from("<i", response_raw, 12)[0]
+    parser = CompressedParser()
+    msg = parser.do_encode({
+        "originalOpcode": original_opcode,
+        "compressorId": compressor_id,
+        # the header of the original message is not compressed
+        "message": memoryview(response_raw)[16:]
+    })
+    message_length = len(msg) + 16
+    response_header = struct.pack("<iiii", message_length, request_id, response_to, OpCode.OP_COMPRESSED)
+    return response_header + msg
 
 
 def payload2msg_response(response_to, request_id, response_json):
@@ -1,16 +1,146 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import reprlib
 
-__all__ = ["server_logger"]
+__all__ = ["server_logger", "request_log", "truncated", "configure_logging"]
+
+# records waiting for the background writer, new records are dropped when it falls behind
+LOG_QUEUE_SIZE = 10000
+# characters of a payload written to the log
+LOG_MAX_LENGTH = 1024
 
 server_logger = logging.getLogger("tinymongo_server")
 _server_logger_handler = logging.FileHandler("tinymongo_server.log")
-_server_logger_handler.setLevel(logging.INFO)
+_server_logger_handler.setLevel(logging.DEBUG)
 # record thread id in file
 server_logger_formatter = logging.Formatter(
     "[%(thread)d] %(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 _server_logger_handler.setFormatter(server_logger_formatter)
-server_logger.addHandler(
-    _server_logger_handler
-)
 server_logger.setLevel(logging.INFO)
+
+# bounded repr: a large document is cut while it is formatted, not formatted whole and then cut
+_payload_repr = reprlib.Repr()
+_payload_repr.maxlevel = 4
+_payload_repr.maxdict = 16
+_payload_repr.maxlist = 16
+_payload_repr.maxtuple = 16
+_payload_repr.maxstring = 128
+_payload_repr.maxother = 128
+
+
+class truncated:
+    """
+    Log argument formatting a payload only when the record is emitted, cut to `max_length` characters.
+        server_logger.debug("Request payload: %s", truncated(payload))
+    """
+
+    __slots__ = ("value", "max_length")
+
+    def __init__(self, value, max_length=None):
+        self.value = value
+        self.max_length = max_length
+
+    def __str__(self):
+        text = _payload_repr.repr(self.value)
+        max_length = self.max_length or request_log.max_length
+        if len(text) > max_length:
+            return f"{text[:max_length]}... ({len(text)} characters)"
+        return text
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    # a full queue drops the record instead of blocking the request or printing a traceback
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _BackgroundWriter:
+    """
+    The records are put in a queue by the request threads and written to the file by a
+    listener thread. The message is formatted when the record is queued, with the arguments
+    bounded by `truncated`, so that the payloads can change after the call.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.queue_handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        self.listener = None
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, self.handler,
+                                                       respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_in_child(self):
+        # the listener thread is not copied by fork and the queue may be locked by it
+        self.queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.listener = None
+        self.start()
+
+
+_writer = _BackgroundWriter(_server_logger_handler)
+server_logger.addHandler(_writer.queue_handler)
+_writer.start()
+atexit.register(_writer.stop)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_writer.restart_in_child)
+
+
+class RequestLog:
+    """
+    Which requests have their payload and reply logged (at debug level):
+    - every request, or a `sample_rate` fraction of them;
+    - with `slow_ms`, the requests slower than that are logged at info level whatever the sampling.
+    """
+
+    def __init__(self, logger, sample_rate=1.0, slow_ms=None, max_length=LOG_MAX_LENGTH):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_length = max_length
+
+    def sampled(self):
+        """
+        :return: True if the payload of the next request is logged
+        """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def slow(self, command_name, payload, elapsed_ms):
+        if self.slow_ms is not None and elapsed_ms >= self.slow_ms:
+            self.logger.info("Slow operation %s: %.1f ms, payload: %s", command_name, elapsed_ms, truncated(payload))
+
+
+request_log = RequestLog(server_logger)
+
+
+def configure_logging(level="info", sample_rate=1.0, slow_ms=None, max_length=LOG_MAX_LENGTH):
+    """
+    :param level: name of the level of the server log, "debug" writes the request payloads
+    :param sample_rate: fraction of the requests whose payloads are logged at debug level
+    :param slow_ms: log the requests slower than this number of milliseconds, None to disable
+    :param max_length: characters of a payload written to the log
+    """
+    server_logger.setLevel(level.upper())
+    request_log.sample_rate = sample_rate
+    request_log.slow_ms = slow_ms
+    request_log.max_length = max_length
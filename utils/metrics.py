@@ -0,0 +1,195 @@
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bson
+
+from backend.op_code import OpCode
+from utils.counters import ThreadLocalCounters
+
+# upper bounds in microseconds of the latency buckets, the last bucket has no bound
+LATENCY_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000)
+OPCOUNTERS = ("insert", "query", "update", "delete", "getmore", "command")
+LATENCY_CLASSES = ("reads", "writes", "commands")
+# opcounter of the legacy operations, the OP_QUERY on "db.$cmd" are commands
+LEGACY_OPCOUNTERS = {
+    OpCode.OP_QUERY: "query",
+    OpCode.OP_GET_MORE: "getmore",
+    OpCode.OP_INSERT: "insert",
+    OpCode.OP_UPDATE: "update",
+    OpCode.OP_DELETE: "delete",
+}
+# opcounter of the OP_MSG commands, the other commands are counted as "command"
+MSG_OPCOUNTERS = {
+    "find": "query",
+    "getMore": "getmore",
+    "insert": "insert",
+    "update": "update",
+    "delete": "delete",
+}
+
+
+def latency_bucket(micros):
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if micros < bound:
+            return index
+    return len(LATENCY_BUCKETS)
+
+
+class ServerMetrics:
+    """
+    Counters of `serverStatus`: operations, network traffic, latencies and connections.
+
+    The requests are counted in `ThreadLocalCounters` like `TopCounters`, so a request takes no lock.
+    """
+
+    def __init__(self):
+        self._counters = ThreadLocalCounters()
+        self._lock = threading.Lock()
+        # connections are counted under the lock, they are opened far less often than requests
+        self.connections_current = 0
+        self.connections_created = 0
+        # name -> function returning a section of serverStatus
+        self._sections = {}
+
+    def record_request(self, opcounter, latency_class, micros, bytes_in, bytes_out):
+        """
+        :param opcounter: one of `OPCOUNTERS`
+        :param latency_class: one of `LATENCY_CLASSES`
+        :param micros: time spent on the request
+        :param bytes_in: size of the request on the wire
+        :param bytes_out: size of the reply on the wire, 0 without reply
+        """
+        buffer = self._counters.buffer()
+        for key, value in ((("opcounters", opcounter), 1),
+                           (("network", "bytesIn"), bytes_in),
+                           (("network", "bytesOut"), bytes_out),
+                           (("network", "numRequests"), 1),
+                           (("latency", latency_class, "micros"), micros),
+                           (("latency", latency_class, "ops"), 1),
+                           (("latency", latency_class, latency_bucket(micros)), 1)):
+            buffer[key] = buffer.get(key, 0) + value
+
+    def record_projection(self, bytes_saved):
+        """
+        :param bytes_saved: size of the fields a projection removed from a returned document
+        """
+        buffer = self._counters.buffer()
+        for key, value in ((("projection", "documents"), 1), (("projection", "bytesSaved"), bytes_saved)):
+            buffer[key] = buffer.get(key, 0) + value
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections_current += 1
+            self.connections_created += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.connections_current -= 1
+
+    def add_section(self, name, section):
+        """
+        :param section: function() -> dict, added to serverStatus under `name`
+        """
+        self._sections[name] = section
+
+    def snapshot(self, available_connections=None):
+        """
+        :return: the sections of serverStatus counted here and the added sections
+        """
+        totals = self._counters.totals()
+        latencies = {}
+        for latency_class in LATENCY_CLASSES:
+            histogram = []
+            for index in range(len(LATENCY_BUCKETS) + 1):
+                count = totals.get(("latency", latency_class, index), 0)
+                if count:
+                    # `micros` is the lower bound of the bucket, same as MongoDB
+                    histogram.append({"micros": bson.int64.Int64(LATENCY_BUCKETS[index - 1] if index else 0),
+                                      "count": bson.int64.Int64(count)})
+            latencies[latency_class] = {
+                "latency": bson.int64.Int64(totals.get(("latency", latency_class, "micros"), 0)),
+                "ops": bson.int64.Int64(totals.get(("latency", latency_class, "ops"), 0)),
+                "histogram": histogram,
+            }
+        with self._lock:
+            connections = {"current": self.connections_current, "totalCreated": self.connections_created}
+        if available_connections is not None:
+            connections["available"] = max(available_connections - connections["current"], 0)
+        status = {
+            "opcounters": {name: bson.int64.Int64(totals.get(("opcounters", name), 0)) for name in OPCOUNTERS},
+            "connections": connections,
+            "network": {name: bson.int64.Int64(totals.get(("network", name), 0))
+                        for name in ("bytesIn", "bytesOut", "numRequests")},
+            "opLatencies": latencies,
+            # documents returned through a projection and the bytes it kept off the wire
+            "projection": {name: bson.int64.Int64(totals.get(("projection", name), 0))
+                           for name in ("documents", "bytesSaved")},
+        }
+        for name, section in list(self._sections.items()):
+            status[name] = section()
+        return status
+
+
+def format_metrics(status, prefix="tinymongo"):
+    """
+    Plain-text exposition of the numeric fields of a serverStatus document, one
+    `prefix_section_field value` line each, the histograms as cumulative `_bucket{le=...}` lines.
+    """
+    lower_bounds = (0,) + LATENCY_BUCKETS
+    lines = []
+
+    def walk(name, value):
+        if isinstance(value, bool):
+            lines.append(f"{name} {int(value)}")
+        elif isinstance(value, (int, float)):
+            lines.append(f"{name} {value}")
+        elif isinstance(value, dict):
+            for key, item in value.items():
+                walk(f"{name}_{key}", item)
+
+    for section, value in status.items():
+        if section == "opLatencies":
+            for latency_class, latency in value.items():
+                name = f"{prefix}_opLatencies_{latency_class}"
+                cumulative = 0
+                for bucket in latency["histogram"]:
+                    cumulative += bucket["count"]
+                    index = lower_bounds.index(bucket["micros"])
+                    if index < len(LATENCY_BUCKETS):
+                        lines.append(f'{name}_bucket{{le="{LATENCY_BUCKETS[index]}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {latency["ops"]}')
+                lines.append(f"{name}_latency {latency['latency']}")
+                lines.append(f"{name}_ops {latency['ops']}")
+        else:
+            walk(f"{prefix}_{section}", value)
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(host, port, get_status):
+    """
+    Serve `format_metrics(get_status())` on http://host:port/metrics from a background thread.
+    :return: the HTTP server, `shutdown()` stops it
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = format_metrics(get_status()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are not written to the server log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="tinymongo-metrics", daemon=True).start()
+    return server
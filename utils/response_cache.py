@@ -0,0 +1,79 @@
+import struct
+import threading
+import time
+
+from collections import namedtuple
+
+# number of distinct commands whose reply is kept
+RESPONSE_CACHE_SIZE = 256
+# fields of a command which don't change its reply
+SESSION_FIELDS = ("lsid", "$clusterTime", "$readPreference")
+
+# raw: the whole encoded reply, header included
+# response: the reply payload it was encoded from
+# expires: monotonic time after which the reply is built again, None if it never changes
+CachedReply = namedtuple("CachedReply", ["raw", "response", "expires"])
+
+
+def command_cache_key(op_code, flags, command_document):
+    # replies only depend on the flags and the command document, apart from the session fields
+    return op_code, flags, tuple((key, repr(value)) for key, value in command_document.items()
+                                 if key not in SESSION_FIELDS)
+
+
+def render_reply(cached, response_to, request_id):
+    """
+    Copy a cached reply with the ids of the new request, the rest of the message is sent as encoded.
+    :param response_to: request_id of the request
+    :param request_id: identifier of this reply
+    """
+    raw = bytearray(cached.raw)
+    struct.pack_into("<ii", raw, 4, request_id, response_to)
+    return bytes(raw)
+
+
+class ResponseCache:
+    """
+    Encoded replies of the commands whose reply doesn't depend on the data, like
+    `buildInfo` or the `hello` handshake sent by every new connection of a pool.
+    Replies with a time to live (`localTime` of hello, `hostInfo`) are built again when they expire.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, clock=time.monotonic):
+        self.max_size = max_size
+        self._clock = clock
+        self._replies = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        cached = self._replies.get(key)
+        if cached is None or (cached.expires is not None and cached.expires <= self._clock()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached
+
+    def put(self, key, raw, response, ttl=None):
+        """
+        :param ttl: seconds the reply stays valid, None if it never changes
+        """
+        expires = None if ttl is None else self._clock() + ttl
+        cached = CachedReply(bytes(raw), response, expires)
+        with self._lock:
+            if key not in self._replies and len(self._replies) >= self.max_size:
+                # the oldest command is evicted
+                del self._replies[next(iter(self._replies))]
+            self._replies[key] = cached
+        return cached
+
+    def stats(self):
+        return {"entries": len(self._replies), "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._replies.clear()
+
+    def __len__(self):
+        return len(self._replies)
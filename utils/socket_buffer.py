@@ -0,0 +1,78 @@
+from backend.parser import MAX_MESSAGE_SIZE, HeadParser
+
+# a message header is always 16 bytes: (message length), (request id), (response to), (op code)
+HEADER_SIZE = 16
+
+
+class ReceiveBuffer:
+    """
+    Per-connection receive buffer that splits the TCP byte stream into complete wire messages.
+    Data is read with `recv_into` into one preallocated `bytearray`, so a single read may
+    carry several pipelined messages and a large message may span several reads.
+    """
+
+    def __init__(self, client_socket, buffer_size=64 * 1024):
+        self.client_socket = client_socket
+        self.default_size = buffer_size
+        self.head_handler = HeadParser()
+        self._reset_buffer(buffer_size)
+        # [start, end) is the received data which is not consumed yet
+        self.start = 0
+        self.end = 0
+
+    def _reset_buffer(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def _pending(self):
+        return self.end - self.start
+
+    def _next_message_length(self):
+        if self._pending() < HEADER_SIZE:
+            return None
+        header = self.head_handler.do_decode(self.view[self.start:self.start + HEADER_SIZE])
+        message_length = header["message_length"]
+        if message_length < HEADER_SIZE or message_length > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Invalid message length: {message_length}")
+        return message_length
+
+    def _make_room(self, needed):
+        """
+        Move the pending bytes to the head of the buffer, and grow the buffer
+        if one message does not fit into it.
+        """
+        pending = self._pending()
+        if needed > len(self.buffer):
+            old_view = self.view
+            self._reset_buffer(needed)
+            self.view[:pending] = old_view[self.start:self.end]
+            old_view.release()
+        elif pending == 0 and len(self.buffer) > self.default_size:
+            # give back the memory of a previous large message
+            self._reset_buffer(self.default_size)
+        elif self.start > 0:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def messages(self):
+        """
+        Generator of the complete messages received from the socket, header included.
+        Ends when the client closes the connection.
+        """
+        while True:
+            message_length = self._next_message_length()
+            while message_length is not None and self._pending() >= message_length:
+                message = bytes(self.view[self.start:self.start + message_length])
+                self.start += message_length
+                yield message
+                message_length = self._next_message_length()
+
+            self._make_room(message_length or HEADER_SIZE)
+            received = self.client_socket.recv_into(self.view[self.end:])
+            if received == 0:
+                return
+            self.end += received
+
+    def close(self):
+        self.view.release()
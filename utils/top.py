@@ -0,0 +1,66 @@
+from utils.counters import ThreadLocalCounters
+
+# operation types reported by `top`, same as MongoDB
+READ_OPS = ("queries", "getmore", "commands")
+WRITE_OPS = ("insert", "update", "remove")
+TOP_OPS = READ_OPS + WRITE_OPS
+
+
+def _add_counter(target, key, counter):
+    # a counter is [micros, count]
+    total = target.setdefault(key, [0, 0])
+    total[0] += counter[0]
+    total[1] += counter[1]
+
+
+class TopCounters:
+    """
+    Time and count of the operations per namespace and operation type.
+
+    Each thread records into its own buffer of `ThreadLocalCounters` so that the hot path
+    takes no lock, the buffers are only merged when `top` is read.
+    """
+
+    def __init__(self):
+        self._counters = ThreadLocalCounters(add_value=_add_counter)
+
+    def record(self, namespace, op_type, micros):
+        """
+        :param namespace: "db.collection"
+        :param op_type: one of `TOP_OPS`
+        :param micros: time spent in microseconds
+        """
+        buffer = self._counters.buffer()
+        counter = buffer.get((namespace, op_type))
+        if counter is None:
+            buffer[(namespace, op_type)] = [micros, 1]
+        else:
+            counter[0] += micros
+            counter[1] += 1
+
+    def snapshot(self):
+        """
+        :return: dict of namespace -> {op_type: {"time": micros, "count": n}, "readLock", "writeLock", "total"}
+        """
+        totals = self._counters.totals()
+        result = {}
+        for (namespace, op_type), (micros, count) in totals.items():
+            result.setdefault(namespace, empty_namespace_stats())[op_type] = {"time": micros, "count": count}
+        for stats in result.values():
+            for lock_name, op_types in (("readLock", READ_OPS), ("writeLock", WRITE_OPS)):
+                stats[lock_name] = {
+                    "time": sum(stats[op_type]["time"] for op_type in op_types),
+                    "count": sum(stats[op_type]["count"] for op_type in op_types)
+                }
+            stats["total"] = {
+                "time": stats["readLock"]["time"] + stats["writeLock"]["time"],
+                "count": stats["readLock"]["count"] + stats["writeLock"]["count"]
+            }
+        return result
+
+
+def empty_namespace_stats():
+    # readLockWait and writeLockWait: time waited for the lock of the collection and number of waits
+    return {op_type: {"time": 0, "count": 0} for op_type in
+            ("total", "readLock", "writeLock", "queries", "getmore", "insert", "update", "remove", "commands",
+             "readLockWait", "writeLockWait")}
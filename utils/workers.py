@@ -0,0 +1,198 @@
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+import traceback
+import zlib
+
+from utils.logger import server_logger
+from utils.socket_buffer import ReceiveBuffer
+
+# a worker restarting is waited for this long before a forwarded request fails
+CONNECT_TIMEOUT = 2.0
+
+
+def database_owner(database, workers):
+    # stable across processes and restarts, unlike `hash`
+    return zlib.crc32(database.encode("utf-8")) % workers
+
+
+def _recv_exactly(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionResetError("worker closed the connection")
+        received += n
+    return bytes(data)
+
+
+class WorkerPeers:
+    """
+    Unix sockets between the worker processes. A request for a database owned by another
+    worker is forwarded as the raw wire message, the owner answers with the length of the
+    raw reply followed by the reply (length 0 when the message has no reply).
+    """
+
+    def __init__(self, socket_dir, workers, worker_id):
+        self.socket_dir = socket_dir
+        self.workers = workers
+        self.worker_id = worker_id
+        # worker_id -> idle connections to that worker
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.socket_dir, f"worker-{worker_id}.sock")
+
+    def owner(self, database):
+        return database_owner(database, self.workers)
+
+    def serve(self, process_message):
+        """
+        Answer the requests forwarded by the other workers in background threads.
+        :param process_message: function(data) -> raw reply or None
+        """
+        path = self.socket_path(self.worker_id)
+        if os.path.exists(path):
+            # left by the previous process of this worker
+            os.unlink(path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(socket.SOMAXCONN)
+        threading.Thread(target=self._accept, args=(process_message,), daemon=True).start()
+
+    def _accept(self, process_message):
+        while True:
+            try:
+                peer_socket, _ = self._listener.accept()
+            except OSError:
+                # listener closed
+                return
+            threading.Thread(target=self._answer, args=(peer_socket, process_message), daemon=True).start()
+
+    def _answer(self, peer_socket, process_message):
+        receive_buffer = ReceiveBuffer(peer_socket)
+        try:
+            for data in receive_buffer.messages():
+                reply = process_message(data) or b""
+                peer_socket.sendall(struct.pack("<i", len(reply)) + reply)
+        except (ConnectionError, ValueError) as e:
+            server_logger.error(f"Worker connection closed: {e}")
+        finally:
+            receive_buffer.close()
+            peer_socket.close()
+
+    def _connect(self, worker_id):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            peer_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                peer_socket.connect(self.socket_path(worker_id))
+                return peer_socket
+            except (FileNotFoundError, ConnectionRefusedError):
+                peer_socket.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    def forward(self, worker_id, data):
+        """
+        Send a wire message to the worker which owns its database.
+        :return: raw reply of the owner, None if the message has no reply
+        :raise OSError: if the worker can't be reached
+        """
+        with self._lock:
+            idle = self._idle.setdefault(worker_id, [])
+            peer_socket = idle.pop() if idle else None
+        # an idle connection is broken when the worker was restarted, it is tried once more
+        reused = peer_socket is not None
+        while True:
+            if peer_socket is None:
+                peer_socket = self._connect(worker_id)
+            try:
+                peer_socket.sendall(data)
+                length = struct.unpack("<i", _recv_exactly(peer_socket, 4))[0]
+                reply = _recv_exactly(peer_socket, length) if length else None
+                break
+            except OSError:
+                peer_socket.close()
+                if not reused:
+                    raise
+                reused = False
+                peer_socket = None
+        with self._lock:
+            self._idle[worker_id].append(peer_socket)
+        return reply
+
+    def broadcast(self, data):
+        # messages without a namespace, like OP_KILL_CURSORS, are sent to every other worker
+        for worker_id in range(self.workers):
+            if worker_id != self.worker_id:
+                try:
+                    self.forward(worker_id, data)
+                except OSError as e:
+                    server_logger.error(f"Can't forward to worker {worker_id}: {e}")
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+        with self._lock:
+            for idle in self._idle.values():
+                for peer_socket in idle:
+                    peer_socket.close()
+            self._idle.clear()
+
+
+def run_workers(workers, start_worker):
+    """
+    Fork the worker processes and restart the ones which exit, until the parent is stopped.
+    :param start_worker: function(worker_id) run in the child process, serves until it is killed
+    """
+    children = {}
+    stopping = False
+
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            exit_code = 0
+            try:
+                start_worker(worker_id)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children[pid] = worker_id
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for worker_id in range(workers):
+        spawn(worker_id)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = children.pop(pid, None)
+        if worker_id is not None and not stopping:
+            server_logger.error(f"Worker {worker_id} exited with status {status}, restarting it")
+            spawn(worker_id)